@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+#-*-coding:utf-8-*-
+
+# compact_image_cache_packs.py
+#
+# Reclaims the space of images that have been removed (e.g. evicted to keep
+# under [img.ImageCache] quota_bytes) from the pack files that small images
+# are kept in when pack_max_item_bytes is set. Pack segments that are less
+# than half full of live images are rewritten and removed. It can be run
+# while loris is serving requests, e.g. from cron.
+#
+# Syntax: $ compact_image_cache_packs.py [path/to/loris.conf]
+#
+
+from sys import argv
+
+from loris.user_commands import compact_image_cache_packs
+from loris.webapp import read_config
+
+config = None
+if len(argv) > 1:
+    config = read_config(argv[1])
+compact_image_cache_packs(config)
@@ -53,8 +53,9 @@ run=1
 while [ $usage -gt $REDUCE_TO ] && [ $max_age -ge -1 ]; do
 	run=0
 
-	# files. loop (instead of -delete) so that we can keep count
-	for f in $(find $IMG_CACHE_DIR -type f -atime +$max_age); do
+	# files. loop (instead of -delete) so that we can keep count. Dot files
+	# are loris's own (lock files, and the SQLite alias and quota indexes).
+	for f in $(find $IMG_CACHE_DIR -type f -atime +$max_age ! -name '.*'); do
 		rm $f
 		let delete_total+=1
 	done
@@ -65,7 +66,7 @@ while [ $usage -gt $REDUCE_TO ] && [ $max_age -ge -1 ]; do
 	# files, and its use of xargs may make it more tolerant of very large lists.
 	#### begin alternate code ####
 	#tmpfile=/tmp/loris-cache-clean-$max_age.tmp
-	#find $IMG_CACHE_DIR -type f -atime +$max_age > $tmpfile
+	#find $IMG_CACHE_DIR -type f -atime +$max_age ! -name '.*' > $tmpfile
 	#line_count=`wc $tmpfile | awk '{print $1}'`
 	#let delete_total+=$line_count
 	#cat $tmpfile | xargs rm
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+#-*-coding:utf-8-*-
+
+# migrate_image_cache_symlinks.py
+#
+# Replaces the symlinks that the image cache makes for non-canonical requests
+# with rows in an alias index (.aliases.sqlite in the cache), removing the
+# symlinks and the directories left empty. Run it when switching an existing
+# cache to [img.ImageCache] aliases = 'sqlite'. It can be run while loris is
+# serving requests.
+#
+# Syntax: $ migrate_image_cache_symlinks.py [path/to/loris.conf]
+#
+
+from sys import argv
+
+from loris.user_commands import migrate_image_cache_symlinks
+from loris.webapp import read_config
+
+config = None
+if len(argv) > 1:
+    config = read_config(argv[1])
+migrate_image_cache_symlinks(config)
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+#-*-coding:utf-8-*-
+
+# migrate_info_cache.py
+#
+# Imports the info.json and profile.icc files of the info cache into the
+# SQLite databases (.info-00.sqlite, ... in the cache) used with
+# [img_info.InfoCache] storage = 'sqlite', keeping their modification times.
+# The files are left where they are; remove them once loris has been
+# switched over.
+#
+# Syntax: $ migrate_info_cache.py [path/to/loris.conf]
+#
+
+from sys import argv
+
+from loris.user_commands import migrate_info_cache
+from loris.webapp import read_config
+
+config = None
+if len(argv) > 1:
+    config = read_config(argv[1])
+migrate_info_cache(config)
@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+#-*-coding:utf-8-*-
+
+# rebuild_image_cache_index.py
+#
+# Indexes the images already in the image cache, so that loris can keep it
+# under [img.ImageCache] quota_bytes. Run it once when turning the quota on
+# for an existing cache, or if the index is lost.
+#
+# Syntax: $ rebuild_image_cache_index.py [path/to/loris.conf]
+#
+
+from sys import argv
+
+from loris.user_commands import rebuild_image_cache_index
+from loris.webapp import read_config
+
+config = None
+if len(argv) > 1:
+    config = read_config(argv[1])
+rebuild_image_cache_index(config)
@@ -0,0 +1,226 @@
+"""
+A pool of long-lived processes for decoding JP2 regions.
+
+Rather than every request decoding on its own (and, for Kakadu, using its
+own ``-num_threads``), JP2 transformers configured with
+``decoder_pool_workers`` hand (source, region, reduce) jobs to a set of
+worker processes and get back the decoded pixels.  The decoder threads per
+job are derived from a single CPU budget, so concurrent requests can't
+oversubscribe the machine.
+
+The worker processes are started by the first job in each process, and
+again after a fork, so each WSGI process has its own pool and the host runs
+``workers`` times the number of WSGI processes decoders.  The budget is
+enforced across all of them: a job only runs while its worker holds one of
+``cpu_budget // threads_per_job`` slots, which are flock(2)ed files shared
+by every pool on the host that uses the same slot directory.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import fcntl
+from logging import getLogger
+import multiprocessing
+import os
+from threading import Lock
+import time
+
+from PIL import Image
+
+logger = getLogger(__name__)
+
+
+# The transformer used by the worker process this module is loaded into,
+# and the host-wide slot files it takes turns with.
+_worker_transformer = None
+_worker_slots = []
+
+
+def open_slots(slots_dp, slots):
+    """Open the slot files, creating them if need be.
+
+    Returns:
+        [file]
+    """
+    os.makedirs(slots_dp, exist_ok=True)
+    return [open(os.path.join(slots_dp, '%d.lock' % n), 'a') for n in range(slots)]
+
+
+def acquire_slot(slot_files, timeout=None, poll_interval=0.01):
+    """Lock the first free slot, waiting for one if they're all taken.
+
+    Returns:
+        file: The locked slot, or None if timeout (seconds) passed first.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        for slot in slot_files:
+            try:
+                fcntl.flock(slot.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot
+            except BlockingIOError:
+                continue
+        if deadline is not None and time.monotonic() >= deadline:
+            return None
+        time.sleep(poll_interval)
+
+
+def release_slot(slot):
+    fcntl.flock(slot.fileno(), fcntl.LOCK_UN)
+
+
+def _init_worker(transformer_class, config, slots_dp, slots):
+    global _worker_transformer, _worker_slots
+    config = dict(config)
+    # The workers do the decoding themselves, rather than using a pool.
+    config['decoder_pool_workers'] = 0
+    _worker_transformer = transformer_class(config)
+    _worker_slots = open_slots(slots_dp, slots)
+
+
+def _decode_in_worker(image_request, image_info, num_threads):
+    slot = acquire_slot(_worker_slots)
+    try:
+        im = _worker_transformer._decode(
+            image_request, image_info, num_threads=num_threads
+        )
+    finally:
+        release_slot(slot)
+    return (im.mode, im.size, im.tobytes())
+
+
+class DecoderPool:
+    """Decodes JP2 regions in a set of worker processes.
+
+    Slots:
+        workers (int): Number of worker processes in each process that
+            uses the pool.
+        threads_per_job (int): Decoder threads each job may use.
+        slots (int): Jobs that may decode at once on the host, across
+            every process's pool.
+        slots_dp (str): Directory of the slot files.
+        submitted (int): Jobs submitted since the pool was created.
+        completed (int): Jobs that returned an image.
+        failed (int): Jobs that raised an error.
+    """
+    __slots__ = ('workers', 'threads_per_job', 'slots', 'slots_dp',
+        'submitted', 'completed', 'failed', '_initargs', '_executor', '_pid',
+        '_lock')
+
+    def __init__(self, transformer_class, config, workers, cpu_budget=None,
+            slots_dp=None):
+        """
+        Args:
+            transformer_class (type):
+                The _AbstractJP2Transformer subclass to decode with.
+            config (dict):
+                The transformer config, used to build one transformer in
+                each worker.
+            workers (int):
+                Number of worker processes, started by the first job.
+            cpu_budget (int):
+                CPUs to share between all in-flight jobs on the host;
+                defaults to the number of CPUs on the machine.
+            slots_dp (str):
+                Directory for the slot files that enforce the budget across
+                processes; defaults to decoder_slots in the transformer's
+                tmp_dp.
+        """
+        cpu_budget = cpu_budget or os.cpu_count() or 1
+        self.workers = int(workers)
+        self.threads_per_job = max(1, int(cpu_budget) // self.workers)
+        self.slots = max(1, int(cpu_budget) // self.threads_per_job)
+        self.slots_dp = slots_dp or os.path.join(config['tmp_dp'], 'decoder_slots')
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self._lock = Lock()
+        self._initargs = (transformer_class, config, self.slots_dp, self.slots)
+        self._executor = None
+        self._pid = None
+        logger.debug(
+            'Decoder pool with %d workers, %d threads per job, %d slots in %s',
+            self.workers, self.threads_per_job, self.slots, self.slots_dp
+        )
+
+    @property
+    def pending(self):
+        """Jobs that have been submitted, but haven't finished."""
+        with self._lock:
+            return self.submitted - self.completed - self.failed
+
+    @property
+    def in_flight(self):
+        """Jobs that are with a worker (decoding, or waiting for a slot)."""
+        return min(self.pending, self.workers)
+
+    @property
+    def queue_depth(self):
+        """Jobs waiting for a free worker."""
+        return max(0, self.pending - self.workers)
+
+    def metrics(self):
+        with self._lock:
+            submitted, completed, failed = self.submitted, self.completed, self.failed
+        pending = submitted - completed - failed
+        return {
+            'workers': self.workers,
+            'threads_per_job': self.threads_per_job,
+            'slots': self.slots,
+            'queue_depth': max(0, pending - self.workers),
+            'in_flight': min(pending, self.workers),
+            'submitted': submitted,
+            'completed': completed,
+            'failed': failed,
+        }
+
+    def decode(self, image_request, image_info, timeout=None):
+        """Decode the requested region in a worker.
+
+        Args:
+            image_request (ImageRequest)
+            image_info (ImageInfo)
+            timeout (int): Seconds to wait for the job.
+        Returns:
+            PIL.Image
+        """
+        with self._lock:
+            self.submitted += 1
+            executor = self._get_executor()
+        future = executor.submit(
+            _decode_in_worker, image_request, image_info, self.threads_per_job
+        )
+        # Count the job as finished when the worker is done with it, even
+        # if we stop waiting for it first.
+        future.add_done_callback(self._job_done)
+        logger.debug('Decoder pool queue depth: %d', self.queue_depth)
+        mode, size, data = future.result(timeout=timeout)
+        return Image.frombytes(mode, size, data)
+
+    def _get_executor(self):
+        # The pool is often built before a WSGI server forks its workers; an
+        # executor inherited from the parent shares its call queue and
+        # result pipes, so each process starts its own. Call with _lock.
+        if self._executor is None or self._pid != os.getpid():
+            # Workers are spawned rather than forked, because the WSGI
+            # server that owns us is likely to be running other threads.
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=self._initargs
+            )
+            self._pid = os.getpid()
+        return self._executor
+
+    def _job_done(self, future):
+        with self._lock:
+            if future.cancelled() or future.exception() is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+    def close(self):
+        with self._lock:
+            executor = self._executor if self._pid == os.getpid() else None
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=True)
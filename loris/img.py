@@ -1,15 +1,24 @@
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 import errno
+import fcntl
+from functools import lru_cache
+import hashlib
 from logging import getLogger
 from os import path
 import os
+from threading import Lock
+import time
 from urllib.parse import quote_plus, unquote
 
 import attr
 
+from loris.constants import FORMATS_BY_EXTENSION
 from loris.identifiers import CacheNamer
+from loris.loris_exception import ConfigError
 from loris.parameters import RegionParameter, RotationParameter, SizeParameter
-from loris.utils import safe_rename, symlink
+from loris.utils import connect_sqlite, safe_rename, symlink
 
 logger = getLogger(__name__)
 
@@ -104,26 +113,1026 @@ class ImageRequest(object):
         return (size_param.w > max_width) or (size_param.h > max_height)
 
 
-class ImageCache(dict):
+class DerivativeIndex:
+    """Remembers the full-region, unrotated derivatives in the image cache
+    for the n most recently used identifiers, so smaller sizes can be made
+    from them instead of from the source.
+
+    Each entry records the generation of the derivative: 0 if it was made
+    from the source image, 1 if it was made from another derivative. Only
+    generation 0 derivatives are offered as sources, so an image is never
+    more than one step removed from the source.
+
+    A source is only used to make a smaller image in its own format, or from
+    a lossless format, so no compression artefacts are encoded twice over.
+    Upscaled derivatives aren't recorded, and requests for the full size are
+    always made from the source.
+
+    Slots:
+        size (int): Max identifiers before we start popping (LRU).
+        _dict (OrderedDict): ident -> {canonical_fp: (w, h, quality, format, generation)}
+        _lock (Lock): The lock.
+    """
+    __slots__ = ('size', '_dict', '_lock')
+
+    LOSSLESS_FORMATS = ('png',)
+
+    def __init__(self, size=1000):
+        self.size = size
+        self._dict = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def is_indexable(image_request, image_info):
+        return (
+            image_request.region_param(image_info).canonical_uri_value == 'full' and
+            image_request.rotation_param().canonical_uri_value == '0'
+        )
+
+    def add(self, image_request, image_info, canonical_fp, generation=0):
+        size_param = image_request.size_param(image_info)
+        w, h = int(size_param.w), int(size_param.h)
+        if w > image_info.width or h > image_info.height:
+            return
+        entry = (w, h, image_request.quality, image_request.format, generation)
+        with self._lock:
+            derivatives = self._dict.pop(image_request.ident, {})
+            derivatives[canonical_fp] = entry
+            self._dict[image_request.ident] = derivatives
+            while len(self._dict) > self.size:
+                self._dict.popitem(last=False)
+
+    def source_for(self, image_request, image_info):
+        '''
+        Returns (str):
+            The path of the smallest generation 0 derivative at least as large
+            as the request, in the same quality and in the same or a lossless
+            format, or None.
+        '''
+        size_param = image_request.size_param(image_info)
+        w, h = int(size_param.w), int(size_param.h)
+        if w >= image_info.width or h >= image_info.height:
+            return None
+        with self._lock:
+            derivatives = dict(self._dict.get(image_request.ident, {}))
+
+        candidates = sorted(
+            (d_w * d_h, fp) for fp, (d_w, d_h, quality, fmt, generation) in derivatives.items()
+            if generation == 0 and quality == image_request.quality and
+                fmt in (image_request.format,) + self.LOSSLESS_FORMATS and
+                d_w >= w and d_h >= h
+        )
+        for _, fp in candidates:
+            if path.exists(fp):
+                return fp
+            # Cleaned out of the cache since we saw it.
+            with self._lock:
+                self._dict.get(image_request.ident, {}).pop(fp, None)
+        return None
+
+
+class RenderLocks:
+    """Single-flight locks for making derivatives.
+
+    When many identical requests for an uncached image arrive at once, one
+    of them makes the image while the others wait for it, and then serve
+    what it made. The locks are flock(2)ed files, so this works between the
+    threads of a worker and between worker processes on the same host.
+
+    Keys are hashed onto a fixed number of lock files, so the number of
+    files doesn't grow with the cache. Two images occasionally share a lock
+    file, which only means that one waits for the other.
+
+    Slots:
+        lock_dp (str): Directory for the lock files.
+        stripes (int): Number of lock files.
+        renders (int): Images made while holding a lock, in this process.
+        renders_saved (int): Requests in this process that found their
+            image had been made by someone else while they waited.
+        _lock (Lock): Protects the counters.
+    """
+    __slots__ = ('lock_dp', 'stripes', 'renders', 'renders_saved', '_lock')
+
+    def __init__(self, lock_dp, stripes=4096):
+        self.lock_dp = lock_dp
+        self.stripes = stripes
+        self.renders = 0
+        self.renders_saved = 0
+        self._lock = Lock()
+
+    def lock_path(self, key):
+        digest = hashlib.md5(key.encode('utf8')).hexdigest()
+        return path.join(self.lock_dp, '%d.lock' % (int(digest, 16) % self.stripes))
+
+    @contextmanager
+    def hold(self, key):
+        '''Hold the lock for key until the block exits.'''
+        os.makedirs(self.lock_dp, exist_ok=True)
+        with open(self.lock_path(key), 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def record(self, saved):
+        with self._lock:
+            if saved:
+                self.renders_saved += 1
+            else:
+                self.renders += 1
+
+    def metrics(self):
+        return {
+            'renders': self.renders,
+            'renders_saved': self.renders_saved,
+        }
+
+
+class MemoryTier:
+    """The most recently used small derivatives, held in memory so hits
+    don't touch the file system.
+
+    Entries are evicted least recently used first once the total size of the
+    images goes over max_bytes. Images bigger than max_item_bytes are never
+    admitted, so a few large images can't push out many small tiles and
+    thumbnails.
+
+    Each entry can record the file it was read from, so that the images
+    read from a file that is removed from the cache can be forgotten with
+    it; other processes' tiers keep them until they are evicted.
+
+    Slots:
+        max_bytes (int): The byte budget for all entries.
+        max_item_bytes (int): The largest image that is admitted.
+        current_bytes (int): The size of all entries.
+        hits (int)
+        misses (int)
+        evictions (int)
+        _dict (OrderedDict):
+            key -> (bytes, last_modified, content_type, target fp or None)
+        _targets (dict): target fp -> {key}
+        _lock (Lock): The lock.
+    """
+    __slots__ = ('max_bytes', 'max_item_bytes', 'current_bytes', 'hits',
+        'misses', 'evictions', '_dict', '_targets', '_lock')
+
+    def __init__(self, max_bytes, max_item_bytes=262144):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = min(max_item_bytes, max_bytes)
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._dict = OrderedDict()
+        self._targets = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._dict)
+
+    def admits(self, size):
+        return size <= self.max_item_bytes
+
+    def get(self, key):
+        '''
+        Returns ((bytes, datetime, str)):
+            The image, its last modified time and content type, or None.
+        '''
+        with self._lock:
+            entry = self._dict.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._dict.move_to_end(key)
+            self.hits += 1
+            return entry[:3]
+
+    def put(self, key, data, last_modified, content_type, target=None):
+        '''
+        Args:
+            target (str): The file the image was read from, if any.
+        '''
+        if not self.admits(len(data)):
+            return
+        with self._lock:
+            self._pop(key)
+            self._dict[key] = (data, last_modified, content_type, target)
+            if target is not None:
+                self._targets.setdefault(target, set()).add(key)
+            self.current_bytes += len(data)
+            while self.current_bytes > self.max_bytes:
+                self._pop(next(iter(self._dict)))
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def discard_target(self, target):
+        '''Forget the images that were read from the file target.'''
+        with self._lock:
+            for key in list(self._targets.get(target, ())):
+                self._pop(key)
+
+    def _pop(self, key):
+        # Call with _lock.
+        entry = self._dict.pop(key, None)
+        if entry is None:
+            return
+        self.current_bytes -= len(entry[0])
+        target = entry[3]
+        if target is not None:
+            keys = self._targets[target]
+            keys.discard(key)
+            if not keys:
+                del self._targets[target]
+
+    def metrics(self):
+        return {
+            'entries': len(self._dict),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+_CACHE_INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    fp TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_last_access ON images (last_access);
+CREATE TABLE IF NOT EXISTS links (
+    fp TEXT PRIMARY KEY,
+    target TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS links_target ON links (target);
+CREATE TABLE IF NOT EXISTS totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    bytes INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO totals VALUES (0, 0);
+CREATE TRIGGER IF NOT EXISTS images_inserted AFTER INSERT ON images BEGIN
+    UPDATE totals SET bytes = bytes + NEW.size;
+END;
+CREATE TRIGGER IF NOT EXISTS images_deleted AFTER DELETE ON images BEGIN
+    UPDATE totals SET bytes = bytes - OLD.size;
+END;
+CREATE TRIGGER IF NOT EXISTS images_resized AFTER UPDATE OF size ON images BEGIN
+    UPDATE totals SET bytes = bytes - OLD.size + NEW.size;
+END;
+'''
+
+
+class CacheIndex:
+    """An index of the images in the cache, with their sizes and when they
+    were last used, that keeps the cache under a quota without walking it
+    (or relying on atime).
+
+    The index is a SQLite database in the cache root, shared by all the
+    worker processes. Paths are stored relative to the cache root; the
+    symlinks made for non-canonical requests are stored with the canonical
+    image they point to, and removed with it, as are its aliases when an
+    AliasIndex is used instead of symlinks. Images in a PackStore are
+    indexed by their canonical path, as if they were files.
+
+    Whenever an image is added and the cache is over quota, up to
+    `batch_size` images are removed, until the cache is back under
+    `low_water` of the quota, so no single request does much of the work.
+    The policies are:
+
+        lru: least recently used first
+        size: largest size * time since last use first; this sorts the
+            whole table, but only runs when the cache is over quota.
+
+    Accesses are kept in memory and written every `flush_interval` seconds
+    and before images are removed.
+
+    Slots:
+        cache_root (str)
+        db_fp (str): The SQLite database.
+        quota_bytes (int): 0 for no quota.
+        policy (str): 'lru' or 'size'.
+        low_water (float)
+        batch_size (int)
+        flush_interval (int)
+        _accesses (dict): fp -> time of pending accesses.
+        _last_flush (float)
+        _conn (sqlite3.Connection)
+        _pid (int): The process _conn was opened in.
+        aliases (AliasIndex): Or None.
+        packs (PackStore): Or None.
+        on_remove (callable): Or None; called with the path of each
+            canonical image that is removed.
+        _lock (Lock): The lock.
+    """
+    __slots__ = ('cache_root', 'db_fp', 'quota_bytes', 'policy', 'low_water',
+        'batch_size', 'flush_interval', '_accesses', '_last_flush', '_conn',
+        '_pid', 'aliases', 'packs', 'on_remove', '_lock')
+
+    POLICIES = {
+        'lru': 'SELECT fp, size FROM images ORDER BY last_access LIMIT ?',
+        'size': 'SELECT fp, size FROM images ORDER BY size * (? - last_access) DESC LIMIT ?',
+    }
+
+    def __init__(self, cache_root, quota_bytes=0, policy='lru', low_water=0.9,
+            batch_size=100, flush_interval=10, aliases=None, packs=None,
+            on_remove=None):
+        if policy not in CacheIndex.POLICIES:
+            raise ConfigError(
+                'eviction_policy must be one of %s, not %r' % (
+                    ', '.join(sorted(CacheIndex.POLICIES)), policy
+                )
+            )
+        self.cache_root = path.realpath(cache_root)
+        self.db_fp = path.join(self.cache_root, '.index.sqlite')
+        self.quota_bytes = quota_bytes
+        self.policy = policy
+        self.low_water = low_water
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._accesses = {}
+        self._last_flush = time.time()
+        self._conn = None
+        self._pid = None
+        self.aliases = aliases
+        self.packs = packs
+        self.on_remove = on_remove
+        self._lock = Lock()
+
+    def _connection(self):
+        # Connections can't be shared with forked workers.
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = connect_sqlite(self.db_fp, _CACHE_INDEX_SCHEMA)
+            self._pid = os.getpid()
+        return self._conn
+
+    def _relative(self, fp):
+        return path.relpath(fp, self.cache_root)
+
+    def add(self, fp, size):
+        '''Record a new (or remade) canonical image, then enforce the quota.'''
+        rel_fp = self._relative(fp)
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute('BEGIN')
+                updated = conn.execute(
+                    'UPDATE images SET size = ?, last_access = ? WHERE fp = ?',
+                    (size, time.time(), rel_fp)
+                ).rowcount
+                if not updated:
+                    conn.execute(
+                        'INSERT INTO images VALUES (?, ?, ?)',
+                        (rel_fp, size, time.time())
+                    )
+        self.enforce()
+
+    def add_link(self, link_fp, target_fp):
+        with self._lock:
+            self._connection().execute(
+                'INSERT OR REPLACE INTO links VALUES (?, ?)',
+                (self._relative(link_fp), self._relative(target_fp))
+            )
+
+    def touch(self, fp):
+        '''Record a use of the image at fp, which may be a symlink to it.'''
+        now = time.time()
+        with self._lock:
+            self._accesses[self._relative(fp)] = now
+            if now - self._last_flush < self.flush_interval:
+                return
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            accesses, self._accesses = self._accesses, {}
+            self._last_flush = time.time()
+            if accesses:
+                # Resolved here rather than on each access.
+                updates = [
+                    (t, self._relative(path.realpath(path.join(self.cache_root, fp))))
+                    for fp, t in accesses.items()
+                ]
+                conn = self._connection()
+                with conn:
+                    conn.execute('BEGIN')
+                    conn.executemany(
+                        'UPDATE images SET last_access = ? WHERE fp = ?', updates
+                    )
+
+    @property
+    def total_bytes(self):
+        with self._lock:
+            return self._connection().execute(
+                'SELECT bytes FROM totals'
+            ).fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._connection().execute(
+                'SELECT COUNT(*) FROM images'
+            ).fetchone()[0]
+
+    def enforce(self):
+        '''Remove up to batch_size images if the cache is over quota.
+
+        Returns ([str]):
+            The paths of the images that were removed.
+        '''
+        if not self.quota_bytes or self.total_bytes <= self.quota_bytes:
+            return []
+        self.flush()
+        to_free = self.total_bytes - int(self.quota_bytes * self.low_water)
+        with self._lock:
+            conn = self._connection()
+            if self.policy == 'size':
+                victims = conn.execute(
+                    CacheIndex.POLICIES['size'], (time.time(), self.batch_size)
+                ).fetchall()
+            else:
+                victims = conn.execute(
+                    CacheIndex.POLICIES['lru'], (self.batch_size,)
+                ).fetchall()
+
+        removed = []
+        for rel_fp, size in victims:
+            if to_free <= 0:
+                break
+            self.remove(path.join(self.cache_root, rel_fp))
+            removed.append(path.join(self.cache_root, rel_fp))
+            to_free -= size
+        logger.debug('Evicted %d images from %s', len(removed), self.cache_root)
+        return removed
+
+    def remove(self, fp):
+        '''Remove a canonical image, and the symlinks to it, from the cache
+        and the index.
+        '''
+        rel_fp = self._relative(fp)
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute('BEGIN')
+                links = [
+                    row[0] for row in conn.execute(
+                        'SELECT fp FROM links WHERE target = ?', (rel_fp,)
+                    )
+                ]
+                conn.execute('DELETE FROM links WHERE target = ?', (rel_fp,))
+                conn.execute('DELETE FROM images WHERE fp = ?', (rel_fp,))
+            self._accesses.pop(rel_fp, None)
+        if self.aliases is not None:
+            self.aliases.remove_target(fp)
+        if self.packs is not None:
+            self.packs.remove(rel_fp)
+        for victim in links + [rel_fp]:
+            _remove_file(self.cache_root, path.join(self.cache_root, victim))
+        if self.on_remove is not None:
+            self.on_remove(fp)
+
+    def rebuild(self):
+        '''Replace the index with the images and symlinks that are in the
+        cache now. Images are dated by the later of their atime and mtime.
+
+        Only files with an image format's extension are indexed, so an info
+        cache sharing the directory (info.json, profile.icc) is left alone.
+        Packed images are indexed too, dated by when they were packed.
+
+        Returns ((int, int)):
+            The number of images and symlinks indexed.
+        '''
+        images = []
+        links = []
+        for dp, dirnames, filenames in os.walk(self.cache_root):
+            if dp == self.cache_root and '.locks' in dirnames:
+                dirnames.remove('.locks')
+            for name in filenames:
+                fp = path.join(dp, name)
+                if dp == self.cache_root and name.startswith('.index.sqlite'):
+                    continue
+                if path.splitext(name)[1][1:] not in FORMATS_BY_EXTENSION:
+                    continue
+                if path.islink(fp):
+                    target_fp = path.realpath(fp)
+                    if path.exists(target_fp):
+                        links.append((self._relative(fp), self._relative(target_fp)))
+                    continue
+                st = os.stat(fp)
+                images.append((self._relative(fp), st.st_size, max(st.st_atime, st.st_mtime)))
+        if self.packs is not None:
+            images.extend(self.packs.entries())
+
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute('BEGIN')
+                conn.execute('DELETE FROM links')
+                conn.execute('DELETE FROM images')
+                conn.executemany('INSERT INTO images VALUES (?, ?, ?)', images)
+                conn.executemany('INSERT OR REPLACE INTO links VALUES (?, ?)', links)
+            self._accesses = {}
+        logger.info(
+            'Indexed %d images and %d symlinks in %s',
+            len(images), len(links), self.cache_root
+        )
+        return len(images), len(links)
+
+
+_ALIAS_INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS aliases (
+    fp TEXT PRIMARY KEY,
+    target TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS aliases_target ON aliases (target);
+'''
+
+
+class AliasIndex:
+    """Maps the cache paths of non-canonical requests to the canonical
+    images they were made as, in place of a symlink for each.
+
+    Every symlink costs an inode, and often directories of its own under
+    the identifier's directory, which add up to most of the files in a busy
+    cache. The aliases are rows in a SQLite database (.aliases.sqlite in the
+    cache root) instead, shared by all the worker processes.
+
+    Aliases are looked up by their path relative to the cache root (i.e.
+    the identifier's cache directory and the request's cache path). Targets
+    are stored relative to the cache root, and returned as absolute paths.
+
+    Slots:
+        cache_root (str)
+        db_fp (str): The SQLite database.
+        _conn (sqlite3.Connection)
+        _pid (int): The process _conn was opened in.
+        _lock (Lock): The lock.
+    """
+    __slots__ = ('cache_root', 'db_fp', '_conn', '_pid', '_lock')
 
     def __init__(self, cache_root):
+        self.cache_root = path.realpath(cache_root)
+        self.db_fp = path.join(self.cache_root, '.aliases.sqlite')
+        self._conn = None
+        self._pid = None
+        self._lock = Lock()
+
+    def _connection(self):
+        # Connections can't be shared with forked workers.
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = connect_sqlite(self.db_fp, _ALIAS_INDEX_SCHEMA)
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, rel_fp):
+        '''Returns (str):
+            The canonical image rel_fp is an alias of, or None.
+        '''
+        with self._lock:
+            row = self._connection().execute(
+                'SELECT target FROM aliases WHERE fp = ?', (rel_fp,)
+            ).fetchone()
+        if row is None:
+            return None
+        return path.join(self.cache_root, row[0])
+
+    def add(self, rel_fp, target_fp):
+        with self._lock:
+            self._connection().execute(
+                'INSERT OR REPLACE INTO aliases VALUES (?, ?)',
+                (rel_fp, path.relpath(target_fp, self.cache_root))
+            )
+
+    def remove_target(self, target_fp):
+        '''Forget the aliases of a canonical image that's being removed.'''
+        with self._lock:
+            self._connection().execute(
+                'DELETE FROM aliases WHERE target = ?',
+                (path.relpath(target_fp, self.cache_root),)
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._connection().execute(
+                'SELECT COUNT(*) FROM aliases'
+            ).fetchone()[0]
+
+    def import_symlinks(self, batch_size=10000):
+        '''Replace the symlinks in the cache with aliases.
+
+        Symlinks to images that no longer exist are removed without being
+        imported, and so are the directories that are left empty.
+
+        Returns ((int, int)):
+            The number of aliases imported, and of dangling symlinks removed.
+        '''
+        imported = 0
+        dangling = 0
+        batch = []
+        for dp, dirnames, filenames in os.walk(self.cache_root):
+            if dp == self.cache_root and '.locks' in dirnames:
+                dirnames.remove('.locks')
+            for name in filenames:
+                fp = path.join(dp, name)
+                if not path.islink(fp):
+                    continue
+                target_fp = path.realpath(fp)
+                if path.isfile(target_fp):
+                    batch.append((fp, target_fp))
+                else:
+                    _remove_file(self.cache_root, fp)
+                    dangling += 1
+                if len(batch) >= batch_size:
+                    imported += self._import_batch(batch)
+                    batch = []
+        imported += self._import_batch(batch)
+        logger.info(
+            'Imported %d aliases, and removed %d dangling symlinks, in %s',
+            imported, dangling, self.cache_root
+        )
+        return imported, dangling
+
+    def _import_batch(self, batch):
+        rows = [
+            (path.relpath(fp, self.cache_root), path.relpath(target_fp, self.cache_root))
+            for fp, target_fp in batch
+        ]
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute('BEGIN')
+                conn.executemany('INSERT OR REPLACE INTO aliases VALUES (?, ?)', rows)
+        # Only once they're safely in the database.
+        for fp, _ in batch:
+            _remove_file(self.cache_root, fp)
+        return len(rows)
+
+
+_PACK_STORE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS packed (
+    fp TEXT PRIMARY KEY,
+    segment TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    mtime INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS packed_segment ON packed (segment);
+CREATE TABLE IF NOT EXISTS packed_aliases (
+    fp TEXT PRIMARY KEY,
+    target TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS packed_aliases_target ON packed_aliases (target);
+'''
+
+
+class PackStore:
+    """Small cached images packed into a few files per identifier, rather
+    than a file (and often directories) each.
+
+    Images are appended to segment files (.pack.0, .pack.1, ...) in the
+    identifier's cache directory, under an flock of the directory, and a new
+    segment is started when the last one reaches `segment_bytes`. Where each
+    image lies is recorded in a SQLite database (.packs.sqlite in the cache
+    root), along with the non-canonical requests made as it. Reading an image
+    is a lookup in that and a single pread(2).
+
+    Removing an image only forgets it; compact() reclaims the space by
+    copying the images that are still there into a new segment.
+
+    Paths are relative to the cache root, as for AliasIndex.
+
+    Slots:
+        cache_root (str)
+        db_fp (str): The SQLite database.
+        max_item_bytes (int): The biggest image that's packed.
+        segment_bytes (int): The size at which a new segment is started.
+        _conn (sqlite3.Connection)
+        _pid (int): The process _conn was opened in.
+        _lock (Lock): The lock.
+    """
+    __slots__ = ('cache_root', 'db_fp', 'max_item_bytes', 'segment_bytes',
+        '_conn', '_pid', '_lock')
+
+    def __init__(self, cache_root, max_item_bytes=65536, segment_bytes=67108864):
+        self.cache_root = path.realpath(cache_root)
+        self.db_fp = path.join(self.cache_root, '.packs.sqlite')
+        self.max_item_bytes = max_item_bytes
+        self.segment_bytes = segment_bytes
+        self._conn = None
+        self._pid = None
+        self._lock = Lock()
+
+    def _connection(self):
+        # Connections can't be shared with forked workers.
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = connect_sqlite(self.db_fp, _PACK_STORE_SCHEMA)
+            self._pid = os.getpid()
+        return self._conn
+
+    def admits(self, size):
+        return size <= self.max_item_bytes
+
+    @contextmanager
+    def _hold(self, ident_dp):
+        '''Hold an flock of the identifier's directory.'''
+        dp = path.join(self.cache_root, ident_dp)
+        os.makedirs(dp, exist_ok=True)
+        fd = os.open(dp, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield dp
+        finally:
+            os.close(fd)
+
+    def _segments(self, dp):
+        '''Returns ([int]): the numbers of the segments in dp, in order.'''
+        return sorted(
+            int(name[len('.pack.'):]) for name in os.listdir(dp)
+            if name.startswith('.pack.') and name[len('.pack.'):].isdigit()
+        )
+
+    def _append(self, dp, data, new_segment=False):
+        '''Append data to the last segment in dp, with dp held.
+
+        Returns ((str, int)): The segment, relative to the cache root, and
+            the offset data was written at.
+        '''
+        segments = self._segments(dp)
+        n = segments[-1] if segments else 0
+        fp = path.join(dp, '.pack.%d' % n)
+        if segments and (new_segment or os.stat(fp).st_size >= self.segment_bytes):
+            n += 1
+            fp = path.join(dp, '.pack.%d' % n)
+        fd = os.open(fp, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            offset = os.fstat(fd).st_size
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+        return path.relpath(fp, self.cache_root), offset
+
+    def put(self, ident_dp, rel_fp, temp_fp):
+        '''Pack the image at temp_fp as rel_fp, and remove temp_fp.
+
+        Args:
+            ident_dp (str): The identifier's cache directory.
+            rel_fp (str): The canonical path of the image.
+            temp_fp (str)
+        '''
+        with open(temp_fp, 'rb') as f:
+            data = f.read()
+        with self._hold(ident_dp) as dp:
+            segment, offset = self._append(dp, data)
+            with self._lock:
+                self._connection().execute(
+                    'INSERT OR REPLACE INTO packed VALUES (?, ?, ?, ?, ?)',
+                    (rel_fp, segment, offset, len(data), int(time.time()))
+                )
+        os.unlink(temp_fp)
+
+    def link(self, rel_fp, target_rel_fp):
+        '''Record a non-canonical request made as a packed image.'''
+        with self._lock:
+            self._connection().execute(
+                'INSERT OR REPLACE INTO packed_aliases VALUES (?, ?)',
+                (rel_fp, target_rel_fp)
+            )
+
+    def lookup(self, rel_fp):
+        '''Returns ((str, str, int, int, int)):
+            The canonical path, segment, offset, length and mtime of the
+            image packed as (or aliased by) rel_fp, or None.
+        '''
+        with self._lock:
+            return self._connection().execute(
+                '''SELECT fp, segment, offset, length, mtime FROM packed
+                WHERE fp = COALESCE(
+                    (SELECT target FROM packed_aliases WHERE fp = ?), ?
+                )''',
+                (rel_fp, rel_fp)
+            ).fetchone()
+
+    def read(self, rel_fp):
+        '''Returns ((bytes, int, str)):
+            The image, its mtime and its canonical path, or None if it isn't
+            packed.
+        '''
+        for _ in range(2):
+            entry = self.lookup(rel_fp)
+            if entry is None:
+                return None
+            canonical_rel_fp, segment, offset, length, mtime = entry
+            try:
+                fd = os.open(path.join(self.cache_root, segment), os.O_RDONLY)
+            except FileNotFoundError:
+                # Compacted since we looked it up.
+                continue
+            try:
+                data = os.pread(fd, length, offset)
+            finally:
+                os.close(fd)
+            if len(data) == length:
+                return data, mtime, canonical_rel_fp
+            return None
+        return None
+
+    def remove(self, rel_fp):
+        '''Forget a packed image, and its aliases.'''
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute('BEGIN')
+                conn.execute('DELETE FROM packed_aliases WHERE target = ?', (rel_fp,))
+                conn.execute('DELETE FROM packed WHERE fp = ?', (rel_fp,))
+
+    def entries(self):
+        '''Returns ([(str, int, int)]):
+            The canonical path, length and mtime of each packed image.
+        '''
+        with self._lock:
+            return self._connection().execute(
+                'SELECT fp, length, mtime FROM packed'
+            ).fetchall()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection().execute(
+                'SELECT COUNT(*) FROM packed'
+            ).fetchone()[0]
+
+    def compact(self, min_live_ratio=0.5):
+        '''Rewrite the segments in which less than min_live_ratio of the
+        bytes are images that are still packed, and remove them.
+
+        Returns ((int, int)):
+            The number of segments compacted and of bytes reclaimed.
+        '''
+        with self._lock:
+            live = dict(self._connection().execute(
+                'SELECT segment, SUM(length) FROM packed GROUP BY segment'
+            ).fetchall())
+
+        compacted = 0
+        reclaimed = 0
+        for dp, dirnames, filenames in os.walk(self.cache_root):
+            if dp == self.cache_root and '.locks' in dirnames:
+                dirnames.remove('.locks')
+            for name in filenames:
+                if not name.startswith('.pack.'):
+                    continue
+                segment = path.relpath(path.join(dp, name), self.cache_root)
+                size = os.stat(path.join(dp, name)).st_size
+                if size and live.get(segment, 0) >= size * min_live_ratio:
+                    continue
+                reclaimed += self._compact_segment(dp, segment, size)
+                compacted += 1
+        logger.info(
+            'Compacted %d segments, reclaiming %d bytes, in %s',
+            compacted, reclaimed, self.cache_root
+        )
+        return compacted, reclaimed
+
+    def _compact_segment(self, dp, segment, size):
+        with self._hold(path.relpath(dp, self.cache_root)):
+            with self._lock:
+                entries = self._connection().execute(
+                    'SELECT fp, offset, length FROM packed WHERE segment = ?',
+                    (segment,)
+                ).fetchall()
+            moved = []
+            if entries:
+                with open(path.join(self.cache_root, segment), 'rb') as f:
+                    chunks = []
+                    for fp, offset, length in entries:
+                        f.seek(offset)
+                        chunks.append(f.read(length))
+                new_segment, new_offset = self._append(dp, b''.join(chunks), new_segment=True)
+                for fp, _, length in entries:
+                    moved.append((new_segment, new_offset, fp, segment))
+                    new_offset += length
+            with self._lock:
+                conn = self._connection()
+                with conn:
+                    conn.execute('BEGIN')
+                    conn.executemany(
+                        'UPDATE packed SET segment = ?, offset = ? WHERE fp = ? AND segment = ?',
+                        moved
+                    )
+            # The directory is left, as another process may be about to pack
+            # into it.
+            os.unlink(path.join(self.cache_root, segment))
+        return size - sum(length for _, _, length in entries)
+
+
+def _remove_file(cache_root, fp):
+    try:
+        os.unlink(fp)
+    except FileNotFoundError:
+        return
+    # and any directories that are now empty, up to the cache root
+    dp = path.dirname(fp)
+    while dp.startswith(cache_root) and dp != cache_root:
+        try:
+            os.rmdir(dp)
+        except OSError:
+            break
+        dp = path.dirname(dp)
+
+
+# Hashing the identifier is cheap, but not free, and the same identifiers are
+# requested over and over.
+_cache_directory_name = lru_cache(maxsize=4096)(CacheNamer.cache_directory_name)
+
+
+class ImageCache(dict):
+
+    ALIASES = ('symlinks', 'sqlite')
+
+    def __init__(self, cache_root, memory_max_bytes=0, memory_max_item_bytes=262144,
+            quota_bytes=0, eviction_policy='lru', aliases='symlinks',
+            pack_max_item_bytes=0, pack_segment_bytes=67108864):
+        '''
+        Args:
+            cache_root (str):
+                Directory for the cached images.
+            memory_max_bytes (int):
+                Budget for the in-memory tier; 0 turns it off.
+            memory_max_item_bytes (int):
+                The biggest image kept in memory.
+            quota_bytes (int):
+                Size the cache is kept under, using a CacheIndex; 0 for no
+                quota (and no index).
+            eviction_policy (str):
+                'lru' or 'size', see CacheIndex.
+            aliases (str):
+                How non-canonical requests are mapped to the canonical image:
+                'symlinks' in the cache, or 'sqlite' for an AliasIndex.
+            pack_max_item_bytes (int):
+                Images up to this size are kept in a PackStore rather than a
+                file each; 0 turns this off.
+            pack_segment_bytes (int):
+                The size at which a new pack segment is started.
+        '''
+        if aliases not in ImageCache.ALIASES:
+            raise ConfigError(
+                'aliases must be one of %s, not %r' % (', '.join(ImageCache.ALIASES), aliases)
+            )
         self.cache_root = cache_root
+        self.derivatives = DerivativeIndex()
+        self.render_locks = RenderLocks(path.join(cache_root, '.locks'))
+        if memory_max_bytes:
+            self.memory = MemoryTier(memory_max_bytes, memory_max_item_bytes)
+        else:
+            self.memory = None
+        if aliases == 'sqlite':
+            self.aliases = AliasIndex(cache_root)
+        else:
+            self.aliases = None
+        if pack_max_item_bytes:
+            self.packs = PackStore(cache_root, pack_max_item_bytes, pack_segment_bytes)
+        else:
+            self.packs = None
+        if quota_bytes:
+            self.index = CacheIndex(
+                cache_root, quota_bytes, eviction_policy, aliases=self.aliases,
+                packs=self.packs, on_remove=self._forget_in_memory
+            )
+        else:
+            self.index = None
 
     def __contains__(self, image_request):
-        return path.exists(self.get_request_cache_path(image_request))
+        if path.exists(self.get_request_cache_path(image_request)):
+            return True
+        return self._packed(image_request) is not None
 
     def __getitem__(self, image_request):
         try:
             cache_fp = self.get_request_cache_path(image_request)
             last_mod = datetime.utcfromtimestamp(path.getmtime(cache_fp))
+            if self.index is not None:
+                self.index.touch(cache_fp)
             return (cache_fp, last_mod)
         except OSError as err:
-            if err.errno == errno.ENOENT:
-                raise KeyError(image_request)
-            else:
+            if err.errno != errno.ENOENT:
                 raise
+        entry = self._packed(image_request)
+        if entry is None:
+            raise KeyError(image_request)
+        canonical_rel_fp, _, _, _, mtime = entry
+        return (path.join(self.packs.cache_root, canonical_rel_fp), datetime.utcfromtimestamp(mtime))
+
+    def _packed(self, image_request):
+        if self.packs is None:
+            return None
+        return self.packs.lookup(self._request_rel_fp(image_request))
 
-    def _store(self, image_request, image_info, canonical_fp):
+    def _store(self, image_request, image_info, canonical_fp, packed=False):
         # Because we're working with files, it's more practical to put derived
         # images where the cache expects them when they are created (i.e. by
         # Loris#_make_image()), so __setitem__, as defined by the dict API
@@ -138,16 +1147,55 @@ class ImageCache(dict):
         # So: when Loris#_make_image is called, it gets a path from
         # ImageCache#get_canonical_cache_path and passes that to the
         # transformer.
+        #
+        # With an AliasIndex, the mapping is a row in that instead, and for
+        # a packed image it's a row in the PackStore.
         if not image_request.is_canonical(image_info):
             try:
+                if packed:
+                    self.packs.link(
+                        self._request_rel_fp(image_request),
+                        path.relpath(canonical_fp, self.packs.cache_root)
+                    )
+                    return
+                if self.aliases is not None:
+                    self.aliases.add(self._request_rel_fp(image_request), canonical_fp)
+                    return
                 requested_fp = self.get_request_cache_path(image_request)
                 symlink(src=canonical_fp, dst=requested_fp)
+                if self.index is not None and requested_fp != canonical_fp:
+                    self.index.add_link(requested_fp, canonical_fp)
             except Exception as e:
                 logger.warning('error creating image cache symlink: %s\ncanonical_fp: %s' % (e, canonical_fp))
 
     def __delitem__(self, image_request):
-        # if we ever decide to start cleaning our own cache...
-        pass
+        '''Remove the image, and any symlinks or aliases to it that we know
+        of.'''
+        cache_fp = self.get_request_cache_path(image_request)
+        entry = None if path.exists(cache_fp) else self._packed(image_request)
+        if entry is not None:
+            cache_fp = path.join(self.packs.cache_root, entry[0])
+        self._forget_in_memory(cache_fp, image_request)
+        if entry is not None:
+            if self.index is None:
+                self.packs.remove(entry[0])
+                return
+        if self.index is not None:
+            self.index.remove(cache_fp)
+            return
+        if path.exists(cache_fp):
+            os.unlink(cache_fp)
+        if self.aliases is not None:
+            self.aliases.remove_target(cache_fp)
+
+    def _forget_in_memory(self, fp, image_request=None):
+        '''Drop the images read from fp, and the one for image_request, from
+        the memory tier.'''
+        if self.memory is None:
+            return
+        if image_request is not None:
+            self.memory.discard(image_request.cache_path)
+        self.memory.discard_target(fp)
 
     def get(self, image_request):
         '''Returns (str, ):
@@ -158,14 +1206,119 @@ class ImageCache(dict):
         except KeyError:
             return None
 
+    def _request_rel_fp(self, image_request):
+        return path.join(
+            _cache_directory_name(image_request.ident),
+            unquote(image_request.cache_path)
+        )
+
+    def _resolved_fp(self, image_request):
+        '''The request's path in the cache, or the canonical image it's an
+        alias of.
+        '''
+        rel_fp = self._request_rel_fp(image_request)
+        if self.aliases is not None:
+            target_fp = self.aliases.get(rel_fp)
+            if target_fp is not None:
+                return target_fp
+        return path.join(self.cache_root, rel_fp)
+
+    def open(self, image_request):
+        '''Open the cached image for a request.
+
+        This is a single open(2) and fstat(2) of the request's path (the
+        kernel follows the symlink of a non-canonical request), so there's
+        no window between checking that the image is cached and opening it.
+        With an AliasIndex, a request that isn't found by its own path is
+        looked up there.
+
+        Returns ((int, os.stat_result)):
+            A file descriptor open on the image, which the caller must close,
+            and its stat; or None if the image isn't cached.
+        '''
+        rel_fp = self._request_rel_fp(image_request)
+        request_fp = path.join(self.cache_root, rel_fp)
+        try:
+            fd = os.open(request_fp, os.O_RDONLY)
+        except (FileNotFoundError, NotADirectoryError):
+            if self.aliases is None:
+                return None
+            request_fp = self.aliases.get(rel_fp)
+            if request_fp is None:
+                return None
+            try:
+                fd = os.open(request_fp, os.O_RDONLY)
+            except FileNotFoundError:
+                return None
+        try:
+            stat_result = os.fstat(fd)
+        except OSError:
+            os.close(fd)
+            raise
+        if self.index is not None:
+            self.index.touch(request_fp)
+        return fd, stat_result
+
+    def get_from_memory(self, image_request):
+        '''Returns ((bytes, datetime, str)):
+            The image, its last modified time and content type from the
+            memory tier, or None.
+        '''
+        if self.memory is None:
+            return None
+        entry = self.memory.get(image_request.cache_path)
+        if entry is not None and self.index is not None:
+            # So the file on disk isn't evicted while it's popular.
+            self.index.touch(self._resolved_fp(image_request))
+        return entry
+
+    def get_from_packs(self, image_request):
+        '''Returns ((bytes, datetime, str)):
+            The image, its last modified time and content type from the
+            PackStore, or None. The image is also kept in the memory tier if
+            there is one.
+        '''
+        if self.packs is None:
+            return None
+        packed = self.packs.read(self._request_rel_fp(image_request))
+        if packed is None:
+            return None
+        data, mtime, canonical_rel_fp = packed
+        if self.index is not None:
+            self.index.touch(path.join(self.packs.cache_root, canonical_rel_fp))
+        last_modified = datetime.utcfromtimestamp(mtime)
+        content_type = FORMATS_BY_EXTENSION[image_request.format]
+        if self.memory is not None and self.memory.admits(len(data)):
+            self.memory.put(
+                image_request.cache_path, data, last_modified, content_type,
+                target=path.join(self.packs.cache_root, canonical_rel_fp)
+            )
+        return data, last_modified, content_type
+
+    def add_to_memory(self, image_request, f, size, last_modified, content_type):
+        '''Keep the image in the memory tier, if it's small enough.
+
+        Args:
+            f (file): The image, open for reading.
+            size (int): The size of the image.
+        Returns (bytes):
+            The image, or None if it wasn't admitted.
+        '''
+        if self.memory is None or not self.memory.admits(size):
+            return None
+        data = f.read()
+        self.memory.put(
+            image_request.cache_path, data, last_modified, content_type,
+            target=self.get_request_cache_path(image_request)
+        )
+        return data
+
     def get_request_cache_path(self, image_request):
-        request_fp = image_request.cache_path
-        cache_dir = CacheNamer.cache_directory_name(image_request.ident)
-        return path.realpath(path.join(self.cache_root, cache_dir, unquote(request_fp)))
+        return path.realpath(self._resolved_fp(image_request))
 
     def get_canonical_cache_path(self, image_request, image_info):
         canonical_fp = image_request.canonical_cache_path(image_info=image_info)
-        cache_dir = CacheNamer.cache_directory_name(image_request.ident)
+        cache_dir = _cache_directory_name(image_request.ident)
         return path.realpath(path.join(self.cache_root, cache_dir, unquote(canonical_fp)))
 
     def create_dir_and_return_file_path(self, image_request, image_info):
@@ -174,15 +1327,90 @@ class ImageCache(dict):
         os.makedirs(target_dp, exist_ok=True)
         return target_fp
 
-    def upsert(self, image_request, temp_fp, image_info):
-        target_fp = self.create_dir_and_return_file_path(
-            image_request=image_request,
-            image_info=image_info
-        )
-        safe_rename(temp_fp, target_fp)
+    def upsert(self, image_request, temp_fp, image_info, generation=0):
+        '''
+        Args:
+            generation (int):
+                0 if the image was made from the source, 1 if it was made
+                from another cached derivative.
+        Returns (str):
+            The canonical path of the image, which for a packed image is
+            only its name in the PackStore.
+        '''
+        if self.packs is not None and self.packs.admits(path.getsize(temp_fp)):
+            size = path.getsize(temp_fp)
+            canonical_rel_fp = path.join(
+                _cache_directory_name(image_request.ident),
+                unquote(image_request.canonical_cache_path(image_info))
+            )
+            self.packs.put(
+                _cache_directory_name(image_request.ident), canonical_rel_fp, temp_fp
+            )
+            target_fp = path.join(self.packs.cache_root, canonical_rel_fp)
+            self._forget_in_memory(target_fp, image_request)
+            if self.index is not None:
+                self.index.add(target_fp, size)
+            self._store(image_request, image_info, target_fp, packed=True)
+            return target_fp
+
+        for attempt in range(3):
+            target_fp = self.create_dir_and_return_file_path(
+                image_request=image_request,
+                image_info=image_info
+            )
+            try:
+                safe_rename(temp_fp, target_fp)
+                break
+            except FileNotFoundError:
+                # Eviction removes directories as it empties them, and may
+                # have removed this one since we made it.
+                if attempt == 2 or not path.exists(temp_fp):
+                    raise
+        self._forget_in_memory(target_fp, image_request)
+        if self.index is not None:
+            self.index.add(target_fp, path.getsize(target_fp))
         self._store(
             image_request=image_request,
             image_info=image_info,
             canonical_fp=target_fp
         )
+        if DerivativeIndex.is_indexable(image_request, image_info):
+            self.derivatives.add(image_request, image_info, target_fp, generation)
         return target_fp
+
+    @contextmanager
+    def render_lock(self, image_request, image_info):
+        '''Hold the lock for making image_request, keyed by its canonical
+        cache path, so identical requests are only made once.
+
+        Yields (str):
+            The canonical path of the image if another thread or process made
+            it while we waited for the lock, or None if the caller should make
+            it.
+        '''
+        canonical_fp = self.get_canonical_cache_path(image_request, image_info)
+        with self.render_locks.hold(canonical_fp):
+            packed = (
+                self.packs is not None and not path.exists(canonical_fp) and
+                self.packs.lookup(path.relpath(canonical_fp, self.packs.cache_root)) is not None
+            )
+            if packed or path.exists(canonical_fp):
+                self.render_locks.record(saved=True)
+                self._store(
+                    image_request=image_request,
+                    image_info=image_info,
+                    canonical_fp=canonical_fp,
+                    packed=packed
+                )
+                yield canonical_fp
+            else:
+                self.render_locks.record(saved=False)
+                yield None
+
+    def derivation_source(self, image_request, image_info):
+        '''Returns (str):
+            A cached derivative that image_request can be made from, or None.
+        '''
+        if not DerivativeIndex.is_indexable(image_request, image_info):
+            return None
+        return self.derivatives.source_for(image_request, image_info)
@@ -1,10 +1,18 @@
 from collections import OrderedDict
 from datetime import datetime
+import fcntl
+import hashlib
 from logging import getLogger
+import marshal
 from math import ceil
+import mmap
+import os
+import sqlite3
+import struct
+import tempfile
 from threading import Lock
 import json
-import os
+import time
 from urllib.parse import unquote
 
 import attr
@@ -13,7 +21,9 @@ from PIL import Image
 from loris.constants import COMPLIANCE, CONTEXT, OPTIONAL_FEATURES, PROTOCOL
 from loris.identifiers import CacheNamer
 from loris.jp2_extractor import JP2Extractor, JP2ExtractionError
-from loris.loris_exception import ImageInfoException
+from loris.loris_exception import ConfigError, ImageInfoException
+from loris.tiff_pyramid import TiffPyramid
+from loris.utils import connect_sqlite, icc_profile_digest, safe_rename
 
 logger = getLogger(__name__)
 
@@ -54,6 +64,61 @@ class EnhancedJSONEncoder(json.JSONEncoder):
         return obj
 
 
+class ProfileTable:
+    """Colour profiles by their digest (icc_profile_digest), so every
+    ImageInfo with the same embedded profile shares one bytes object,
+    however many identifiers (and cache reads) it came from. The digest is
+    also the key of the colour transforms made from the profile (see
+    transforms.ColorTransformCache).
+
+    Sources carry few distinct profiles (Adobe RGB, eciRGB, ...), so the
+    table isn't evicted from; profiles beyond max_profiles just aren't
+    shared.
+
+    Slots:
+        max_profiles (int): The most profiles that are held.
+        _dict (dict): digest -> bytes
+        _lock (Lock): The lock.
+    """
+    __slots__ = ('max_profiles', '_dict', '_lock')
+
+    def __init__(self, max_profiles=1024):
+        self.max_profiles = max_profiles
+        self._dict = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._dict)
+
+    def get(self, digest):
+        '''
+        Returns (bytes):
+            The profile with this digest, or None if it isn't held.
+        '''
+        return self._dict.get(digest)
+
+    def intern(self, profile_bytes, digest=None):
+        '''
+        Args:
+            profile_bytes (bytes)
+            digest (str): Its digest, if already known.
+        Returns ((str, bytes)):
+            The digest, and the shared copy of the profile.
+        '''
+        if digest is None:
+            digest = icc_profile_digest(profile_bytes)
+        with self._lock:
+            shared = self._dict.get(digest)
+            if shared is not None:
+                return digest, shared
+            if len(self._dict) < self.max_profiles:
+                self._dict[digest] = profile_bytes
+        return digest, profile_bytes
+
+
+color_profiles = ProfileTable()
+
+
 class ImageInfo(JP2Extractor):
     '''Info about the image.
     See: <http://iiif.io/api/image/>, <https://iiif.io/api/image/2.1/#complete-response>
@@ -76,12 +141,21 @@ class ImageInfo(JP2Extractor):
         src_img_fp (str): the absolute path on the file system [non IIIF]
         src_format (str): the format of the source image file [non IIIF]
         color_profile_bytes []: the embedded color profile, if any [non IIIF]
+        color_profile_digest (str): digest of color_profile_bytes, set with
+            them [non IIIF]
         auth_rules (dict): extra information about authorization [non IIIF]
+        _iiif_json (dict): (base URI, content type) -> the output of
+            iiif_json_and_etag() [non IIIF]
 
     '''
     __slots__ = ('width', 'height', 'scaleFactors', 'sizes', 'tiles',
         'profile', 'service', 'attribution', 'license', 'logo',
-        'src_img_fp', 'src_format', 'color_profile_bytes', 'auth_rules')
+        'src_img_fp', 'src_format', '_color_profile_bytes',
+        'color_profile_digest', 'auth_rules', '_iiif_json')
+
+    # Rendered info.json bodies kept per instance; the base URI comes from
+    # the request, so there's a bound on how many different ones are kept.
+    MAX_IIIF_JSON = 8
 
     def __init__(self, app=None, service=None, attribution=None, license=None, logo=None, src_img_fp="", src_format="", auth_rules=None):
         self.src_img_fp = src_img_fp
@@ -91,6 +165,7 @@ class ImageInfo(JP2Extractor):
         self.license = license
         self.service = service or {}
         self.auth_rules = auth_rules or {}
+        self._iiif_json = {}
 
         # If constructed from JSON, the pixel info will already be processed
         if app:
@@ -104,6 +179,27 @@ class ImageInfo(JP2Extractor):
             # Finish setting up the info from the image file
             self.from_image_file(formats, app.max_size_above_full)
 
+    @property
+    def color_profile_bytes(self):
+        return self._color_profile_bytes
+
+    @color_profile_bytes.setter
+    def color_profile_bytes(self, profile_bytes):
+        self.set_color_profile(profile_bytes)
+
+    def set_color_profile(self, profile_bytes, digest=None):
+        '''Set color_profile_bytes to the shared copy (in color_profiles) of
+        profile_bytes, and color_profile_digest to its digest, which can be
+        passed in if it's already known.
+        '''
+        if profile_bytes:
+            self.color_profile_digest, self._color_profile_bytes = color_profiles.intern(
+                profile_bytes, digest
+            )
+        else:
+            self.color_profile_digest = None
+            self._color_profile_bytes = None
+
     @classmethod
     def from_json_fp(cls, path):
         """Contruct an instance from an existing file.
@@ -145,6 +241,12 @@ class ImageInfo(JP2Extractor):
         new_inst.src_format = j.get('_src_format', '')
         new_inst.auth_rules = j.get('_auth_rules', {})
 
+        # The profile itself is stored by the InfoCache, once for all the
+        # images that have it; info.json files cached before that have no
+        # digest, and a profile.icc of their own.
+        new_inst._color_profile_bytes = None
+        new_inst.color_profile_digest = j.get('_color_profile_digest')
+
         return new_inst
 
     def from_image_file(self, formats=[], max_size_above_full=200):
@@ -191,6 +293,27 @@ class ImageInfo(JP2Extractor):
         self.color_profile_bytes = None
         self.profile.description['qualities'] = PIL_MODES_TO_QUALITIES[im.mode]
         self.sizes = []
+        if self.src_format == 'tif':
+            self._extract_tiff_pyramid(fp)
+
+    def _extract_tiff_pyramid(self, fp):
+        '''Advertise the tiles and levels of a tiled (pyramidal) TIFF, so
+        clients ask for regions we can read without decoding the whole image.
+        '''
+        pyramid = TiffPyramid.open(fp)
+        if pyramid is None:
+            return
+        base = pyramid.levels[0]
+        tile = {'width': base.tile_width}
+        if base.tile_height != base.tile_width:
+            tile['height'] = base.tile_height
+        tile['scaleFactors'] = sorted(set(pyramid.scale_factors))
+        self.tiles = [tile]
+        self.sizes = [
+            {'width': level.width, 'height': level.height}
+            for level in pyramid.levels
+        ]
+        self.sizes.sort(key=lambda size: max([size['width'], size['height']]))
 
     def _from_jp2(self, fp):
         '''Get info about a JP2.
@@ -241,18 +364,460 @@ class ImageInfo(JP2Extractor):
         d['protocol'] = PROTOCOL
         return json.dumps(d, cls=EnhancedJSONEncoder)
 
+    def iiif_json_and_etag(self, base_uri, content_type):
+        '''The output of to_iiif_json(base_uri) as bytes, and a strong ETag
+        for it served as content_type. Both are made once for each base URI
+        and content type, so the info must not be changed after this is
+        called.
+
+        Returns ((bytes, str))
+        '''
+        key = (base_uri, content_type)
+        try:
+            return self._iiif_json[key]
+        except KeyError:
+            pass
+        body = self.to_iiif_json(base_uri).encode('utf8')
+        etag = hashlib.blake2b(
+            body + b'\n' + content_type.encode('utf8'), digest_size=16
+        ).hexdigest()
+        if len(self._iiif_json) >= ImageInfo.MAX_IIIF_JSON:
+            # Forget the oldest; dicts keep insertion order.
+            self._iiif_json.pop(next(iter(self._iiif_json), None), None)
+        self._iiif_json[key] = (body, etag)
+        return body, etag
+
+    def to_record(self):
+        '''The fields that are cached, as a tuple of plain values that can be
+        serialised without JSON (see SharedInfoTier).
+        '''
+        return (
+            self.width, self.height, self.tiles, self.sizes,
+            self.profile.compliance_uri, self.profile.description,
+            self.service, self.src_img_fp, self.src_format, self.auth_rules,
+            self.color_profile_digest,
+        )
+
+    @staticmethod
+    def from_record(record):
+        '''Construct an instance from the output of to_record().'''
+        new_inst = ImageInfo()
+        (
+            new_inst.width, new_inst.height, new_inst.tiles, new_inst.sizes,
+            compliance_uri, description,
+            new_inst.service, new_inst.src_img_fp, new_inst.src_format,
+            new_inst.auth_rules, new_inst.color_profile_digest,
+        ) = record
+        new_inst.profile = Profile(compliance_uri, description)
+        # As with from_json, the InfoCache finds the profile by its digest.
+        new_inst._color_profile_bytes = None
+        return new_inst
+
     def to_full_info_json(self):
         """creates the info JSON that gets cached in the InfoCache"""
         d = self._get_iiif_info()
         d['_src_img_fp'] = self.src_img_fp
         d['_src_format'] = self.src_format
         d['_auth_rules'] = self.auth_rules
+        d['_color_profile_digest'] = self.color_profile_digest
         return json.dumps(d, cls=EnhancedJSONEncoder)
 
 
+class SharedInfoTier:
+    """ImageInfo records shared by all the worker processes on a host, in a
+    memory-mapped file, so a worker that hasn't seen an identifier yet can
+    have its info without reading and parsing info.json.
+
+    The file is a hash table with a fixed number of fixed-size slots. Each
+    identifier has one slot (by a hash of the identifier), so a newer entry
+    can push out an older one; this is a cache in front of the InfoCache's
+    files, not a store. A slot holds the identifier's hash, the mtime of
+    the info.json it was read from, and the marshalled ImageInfo.to_record(),
+    which refers to any colour profile by its digest. Entries too big for a
+    slot (e.g. with a great many sizes) aren't shared.
+
+    Each slot has a sequence number that a writer makes odd while it writes,
+    so readers never use a half-written slot; writers take an fcntl lock of
+    the file. An entry is only used if its mtime matches that of the
+    info.json on disk, so rewritten or removed files aren't served from
+    here.
+
+    Put the file on a local (ideally in-memory) file system, e.g. /dev/shm.
+
+    Slots:
+        fp (str): The file.
+        slots (int): Number of slots.
+        slot_bytes (int): Size of each slot.
+        hits (int): Hits in this process.
+        misses (int): Misses in this process.
+        _fd (int)
+        _mmap (mmap.mmap)
+        _lock (Lock): The lock.
+    """
+    __slots__ = ('fp', 'slots', 'slot_bytes', 'hits', 'misses', '_fd',
+        '_mmap', '_lock')
+
+    MAGIC = b'LORISINF'
+    VERSION = 2
+    # magic, version, slots, slot bytes
+    FILE_HEADER = struct.Struct('<8sIII')
+    # sequence, identifier hash, mtime, length
+    SLOT_HEADER = struct.Struct('<IQdI')
+    HEADER_BYTES = 64
+
+    def __init__(self, fp, slots=16384, slot_bytes=4096):
+        self.fp = fp
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        os.makedirs(os.path.dirname(fp) or '.', exist_ok=True)
+        self._fd = os.open(fp, os.O_RDWR | os.O_CREAT, 0o644)
+        with self._file_lock():
+            header = os.pread(self._fd, SharedInfoTier.FILE_HEADER.size, 0)
+            if len(header) == SharedInfoTier.FILE_HEADER.size:
+                magic, version, file_slots, file_slot_bytes = SharedInfoTier.FILE_HEADER.unpack(header)
+            else:
+                magic = None
+            if magic == SharedInfoTier.MAGIC and version == SharedInfoTier.VERSION:
+                if (file_slots, file_slot_bytes) != (slots, slot_bytes):
+                    logger.warning(
+                        '%s has %d slots of %d bytes; using those', fp,
+                        file_slots, file_slot_bytes
+                    )
+                slots, slot_bytes = file_slots, file_slot_bytes
+            else:
+                os.ftruncate(self._fd, SharedInfoTier.HEADER_BYTES + slots * slot_bytes)
+                os.pwrite(
+                    self._fd,
+                    SharedInfoTier.FILE_HEADER.pack(SharedInfoTier.MAGIC, SharedInfoTier.VERSION, slots, slot_bytes),
+                    0
+                )
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self._mmap = mmap.mmap(self._fd, SharedInfoTier.HEADER_BYTES + slots * slot_bytes)
+
+    def _file_lock(self):
+        return _FileLock(self._fd)
+
+    @staticmethod
+    def _hash(ident):
+        return int.from_bytes(
+            hashlib.blake2b(ident.encode('utf8'), digest_size=8).digest(), 'little'
+        )
+
+    def _offset(self, ident_hash):
+        return SharedInfoTier.HEADER_BYTES + (ident_hash % self.slots) * self.slot_bytes
+
+    def get(self, ident, mtime):
+        '''
+        Args:
+            ident (str)
+            mtime (float): The mtime of the identifier's info.json.
+        Returns (ImageInfo):
+            The info, or None if it isn't here or is out of date.
+        '''
+        ident_hash = SharedInfoTier._hash(ident)
+        offset = self._offset(ident_hash)
+        header_size = SharedInfoTier.SLOT_HEADER.size
+        header = self._mmap[offset:offset + header_size]
+        seq, slot_hash, slot_mtime, length = SharedInfoTier.SLOT_HEADER.unpack(header)
+        record = None
+        if (
+            seq % 2 == 0 and slot_hash == ident_hash and slot_mtime == mtime and
+            header_size + length <= self.slot_bytes
+        ):
+            data = self._mmap[offset + header_size:offset + header_size + length]
+            # The writer may have started on the slot while we copied it.
+            if self._mmap[offset:offset + 4] == header[:4]:
+                try:
+                    stored_ident, record = marshal.loads(data)
+                except (EOFError, ValueError, TypeError):
+                    record = None
+                else:
+                    if stored_ident != ident:
+                        record = None
+        with self._lock:
+            if record is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if record is None:
+            return None
+        return ImageInfo.from_record(record)
+
+    def put(self, ident, info, mtime):
+        '''Share info, read from an info.json with this mtime.'''
+        data = marshal.dumps((ident, info.to_record()))
+        header_size = SharedInfoTier.SLOT_HEADER.size
+        if header_size + len(data) > self.slot_bytes:
+            logger.debug('Info for %s is too big to share (%d bytes)', ident, len(data))
+            return
+        ident_hash = SharedInfoTier._hash(ident)
+        self._write(self._offset(ident_hash), ident_hash, mtime, data)
+
+    def discard(self, ident):
+        ident_hash = SharedInfoTier._hash(ident)
+        offset = self._offset(ident_hash)
+        slot_hash = SharedInfoTier.SLOT_HEADER.unpack(
+            self._mmap[offset:offset + SharedInfoTier.SLOT_HEADER.size]
+        )[1]
+        if slot_hash == ident_hash:
+            self._write(offset, 0, 0.0, b'')
+
+    def _write(self, offset, ident_hash, mtime, data):
+        header_size = SharedInfoTier.SLOT_HEADER.size
+        with self._lock, self._file_lock():
+            seq = struct.unpack('<I', self._mmap[offset:offset + 4])[0]
+            # Odd while we write, so readers ignore the slot.
+            self._mmap[offset:offset + 4] = struct.pack('<I', (seq + 1) & 0xffffffff)
+            self._mmap[offset + 4:offset + header_size] = SharedInfoTier.SLOT_HEADER.pack(
+                0, ident_hash, mtime, len(data)
+            )[4:]
+            self._mmap[offset + header_size:offset + header_size + len(data)] = data
+            self._mmap[offset:offset + 4] = struct.pack('<I', (seq + 2) & 0xffffffff)
+
+    def metrics(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'slots': self.slots}
+
+
+class _FileLock:
+    '''An fcntl (POSIX) lock of a whole file, which excludes other processes
+    even when they share the file descriptor across a fork.'''
+    __slots__ = ('fd',)
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def __enter__(self):
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc_info):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+
+_INFO_STORE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS info (
+    ident TEXT PRIMARY KEY,
+    info TEXT NOT NULL,
+    mtime REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS profiles (
+    digest TEXT PRIMARY KEY,
+    icc BLOB NOT NULL
+);
+'''
+
+
+class InfoStore:
+    """InfoCache entries in SQLite databases, one record per identifier with
+    its info (which refers to any colour profile by digest) and modification
+    time, instead of an info.json at the end of a deep directory tree per
+    identifier. Each colour profile is stored once, by its digest.
+
+    Identifiers (and profiles) are spread by a hash over `shards` databases
+    (.info-00.sqlite, .info-01.sqlite, ... in the root), so writers mostly
+    don't wait for each other. Records are keyed by the unquoted identifier,
+    as the files are.
+
+    Slots:
+        root (str): The directory of the databases.
+        shards (int): The number of databases.
+        _conns ({int: sqlite3.Connection}): Connections of this process, by
+            shard, opened as they're first needed.
+        _pid (int): The process the connections were made in.
+        _lock (Lock): The lock.
+    """
+    __slots__ = ('root', 'shards', '_conns', '_pid', '_lock')
+
+    def __init__(self, root, shards=16):
+        self.root = root
+        self.shards = shards
+        self._conns = {}
+        self._pid = None
+        self._lock = Lock()
+
+    def _shard(self, key):
+        return int.from_bytes(
+            hashlib.blake2b(key.encode('utf8'), digest_size=4).digest(), 'little'
+        ) % self.shards
+
+    def _shard_fp(self, shard):
+        return os.path.join(self.root, '.info-%02d.sqlite' % shard)
+
+    def _connection(self, key):
+        return self._shard_connection(self._shard(key))
+
+    def _shard_connection(self, shard):
+        # Connections can't be shared with forked workers.
+        if self._pid != os.getpid():
+            self._conns = {}
+            self._pid = os.getpid()
+        conn = self._conns.get(shard)
+        if conn is None:
+            conn = connect_sqlite(self._shard_fp(shard), _INFO_STORE_SCHEMA)
+            self._conns[shard] = conn
+        return conn
+
+    def get(self, ident):
+        '''
+        Returns ((str, float)):
+            The full info JSON and modification time, or None.
+        '''
+        ident = unquote(ident)
+        with self._lock:
+            return self._connection(ident).execute(
+                'SELECT info, mtime FROM info WHERE ident = ?', (ident,)
+            ).fetchone()
+
+    def profile(self, digest):
+        '''
+        Returns (bytes):
+            The colour profile with this digest, or None.
+        '''
+        with self._lock:
+            row = self._connection(digest).execute(
+                'SELECT icc FROM profiles WHERE digest = ?', (digest,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put_profile(self, digest, icc):
+        with self._lock:
+            self._connection(digest).execute(
+                'INSERT OR IGNORE INTO profiles (digest, icc) VALUES (?, ?)',
+                (digest, icc)
+            )
+
+    def mtime(self, ident):
+        ident = unquote(ident)
+        with self._lock:
+            row = self._connection(ident).execute(
+                'SELECT mtime FROM info WHERE ident = ?', (ident,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, ident, info_json, mtime):
+        ident = unquote(ident)
+        with self._lock:
+            self._connection(ident).execute(
+                'INSERT OR REPLACE INTO info (ident, info, mtime) VALUES (?, ?, ?)',
+                (ident, info_json, mtime)
+            )
+
+    def remove(self, ident):
+        ident = unquote(ident)
+        with self._lock:
+            self._connection(ident).execute(
+                'DELETE FROM info WHERE ident = ?', (ident,)
+            )
+
+    def __len__(self):
+        with self._lock:
+            # Shards that were never written to have no database to count.
+            return sum(
+                self._shard_connection(shard).execute(
+                    'SELECT COUNT(*) FROM info'
+                ).fetchone()[0]
+                for shard in range(self.shards)
+                if shard in self._conns or os.path.exists(self._shard_fp(shard))
+            )
+
+    def import_tree(self, info_root, batch_size=1000):
+        '''Import the info.json files, and colour profiles, of a file system
+        InfoCache at info_root, keeping their modification times. The files
+        aren't removed. They're written in batches of batch_size; if a batch
+        fails it's logged and rolled back, and the error raised, leaving the
+        batches before it imported, so the import can simply be run again.
+
+        Returns ((int, int)):
+            The number of entries imported, and of info.json files that
+            weren't where an InfoCache would have put them, and so were
+            skipped.
+        '''
+        imported = skipped = 0
+        batch = []
+        profiles = set()
+        for dp, _, filenames in os.walk(info_root):
+            if 'info.json' not in filenames:
+                continue
+            ident = InfoStore._ident_for_dir(os.path.relpath(dp, info_root))
+            if ident is None:
+                logger.warning('Skipped %s, which is not named by its identifier', dp)
+                skipped += 1
+                continue
+            info_fp = os.path.join(dp, 'info.json')
+            with open(info_fp) as f:
+                info_json = f.read()
+            d = json.loads(info_json)
+            digest = d.get('_color_profile_digest')
+            if digest is None and 'profile.icc' in filenames:
+                # From before profiles were stored by digest.
+                with open(os.path.join(dp, 'profile.icc'), 'rb') as f:
+                    icc = f.read()
+                digest = icc_profile_digest(icc)
+                self.put_profile(digest, icc)
+                d['_color_profile_digest'] = digest
+                info_json = json.dumps(d)
+            elif digest is not None and digest not in profiles:
+                try:
+                    with open(os.path.join(info_root, '.profiles', '%s.icc' % digest), 'rb') as f:
+                        self.put_profile(digest, f.read())
+                except FileNotFoundError:
+                    logger.warning('Skipped %s, whose colour profile is missing', dp)
+                    skipped += 1
+                    continue
+            profiles.add(digest)
+            batch.append((ident, info_json, os.path.getmtime(info_fp)))
+            if len(batch) >= batch_size:
+                imported += self._import_batch(batch)
+                batch = []
+        imported += self._import_batch(batch)
+        return imported, skipped
+
+    @staticmethod
+    def _ident_for_dir(rel_dp):
+        # The directory is the (optional) sub-root and hash directories of
+        # CacheNamer.cache_directory_name, then the identifier, which may
+        # have slashes of its own.
+        parts = rel_dp.split(os.sep)
+        for i in range(len(parts)):
+            ident = '/'.join(parts[i:])
+            # Double slashes, as in http://, are collapsed on disk.
+            for candidate in (ident, ident.replace(':/', '://', 1)):
+                if parts[:i] and CacheNamer.cache_directory_name(candidate) == os.path.join(*parts[:i]):
+                    return candidate
+        return None
+
+    def _import_batch(self, batch):
+        by_shard = {}
+        for record in batch:
+            by_shard.setdefault(self._shard(record[0]), []).append(record)
+        with self._lock:
+            for shard, records in sorted(by_shard.items()):
+                conn = self._shard_connection(shard)
+                try:
+                    # Each shard's share of the batch is written, or rolled
+                    # back, as one.
+                    with conn:
+                        conn.execute('BEGIN')
+                        conn.executemany(
+                            'INSERT OR REPLACE INTO info (ident, info, mtime) VALUES (?, ?, ?)',
+                            records
+                        )
+                except sqlite3.Error:
+                    logger.error(
+                        'Failed to import %d entries into %s, beginning with %s',
+                        len(records), self._shard_fp(shard), records[0][0],
+                        exc_info=True
+                    )
+                    raise
+        return len(batch)
+
+
 class InfoCache:
     """A dict-like cache for ImageInfo objects. The n most recently used are
-    also kept in memory; all entries are on the file system.
+    also kept in memory; all entries are on the file system, as an info.json
+    per identifier, or in an InfoStore.
 
     One twist: you put in an ImageInfo object, but get back a two-tuple, the
     first member is the ImageInfo, the second member is the UTC date and time
@@ -262,24 +827,61 @@ class InfoCache:
     put (`instance[indent] = info`), membership, and length. There are no
     iterators, views, default, update, comparators, etc.
 
+    Entries that aren't in this process's memory are looked for in the
+    SharedInfoTier, if there is one, before being read from the file system.
+
+    Colour profiles are stored once each, by digest (in .profiles in root,
+    or in the InfoStore), and held in memory in color_profiles, so entries
+    with the same profile share it.
+
+    An entry is only returned if the source image it refers to still exists.
+    Entries in memory record when that was last checked, and aren't checked
+    again for verify_source_interval seconds, so hits on them can be
+    answered without touching the file system.
+
     Slots:
         root (str): See below
         size (int): See below.
-        _dict (OrderedDict): The map.
+        shared (SharedInfoTier): See below.
+        verify_source_interval (float): See below.
+        store (InfoStore): The store, if storage is 'sqlite'.
+        _dict (OrderedDict): The map, of (info, lastmod, verified time).
         _lock (Lock): The lock.
     """
-    __slots__ = ( 'root', 'size', '_dict', '_lock')
+    __slots__ = ( 'root', 'size', 'shared', 'verify_source_interval',
+        'store', '_dict', '_lock')
 
-    def __init__(self, root, size=500):
+    STORAGE = ('files', 'sqlite')
+
+    def __init__(self, root, size=500, shared=None, verify_source_interval=0,
+            storage='files', store_shards=16):
         """
         Args:
             root (str):
                 Path directory on the file system to be used for the cache.
             size (int):
                 Max entries before the we start popping (LRU).
+            shared (SharedInfoTier):
+                Entries shared with the other worker processes, or None.
+            verify_source_interval (float):
+                Seconds for which an entry in memory is returned without
+                checking that its source image still exists. 0 checks on
+                every get.
+            storage (str):
+                'files' keeps an info.json per identifier under root;
+                'sqlite' keeps them in an InfoStore in root.
+            store_shards (int):
+                The number of databases of the InfoStore.
         """
+        if storage not in InfoCache.STORAGE:
+            raise ConfigError(
+                'storage must be one of %s, not %r' % (', '.join(InfoCache.STORAGE), storage)
+            )
         self.root = root
         self.size = size
+        self.shared = shared
+        self.verify_source_interval = verify_source_interval
+        self.store = InfoStore(root, shards=store_shards) if storage == 'sqlite' else None
         self._dict = OrderedDict()  # keyed by URL, so we don't need
                                     # to separate HTTP and HTTPS
         self._lock = Lock()
@@ -305,36 +907,166 @@ class InfoCache:
         '''
         info_and_lastmod = None
         with self._lock:
-            info_and_lastmod = self._dict.get(ident)
+            entry = self._dict.get(ident)
+        if entry is not None:
+            info, lastmod, verified = entry
+            if time.monotonic() - verified < self.verify_source_interval:
+                return info, lastmod
+            info_and_lastmod = (info, lastmod)
+        if info_and_lastmod is None and self.shared is not None:
+            info_and_lastmod = self._get_shared(ident)
         if info_and_lastmod is None:
-            info_fp = self._get_info_fp(ident)
-            if os.path.exists(info_fp):
-                # from fs
-                info = ImageInfo.from_json_fp(info_fp)
-
-                icc_fp = self._get_color_profile_fp(ident)
-                if os.path.exists(icc_fp):
-                    with open(icc_fp, "rb") as f:
-                        info.color_profile_bytes = f.read()
-                else:
-                    info.color_profile_bytes = None
-
-                lastmod = datetime.utcfromtimestamp(os.path.getmtime(info_fp))
-                info_and_lastmod = (info, lastmod)
+            info_and_mtime = self._read(ident)
+            if info_and_mtime is not None:
+                info, mtime = info_and_mtime
+                info_and_lastmod = (info, datetime.utcfromtimestamp(mtime))
                 # into mem:
-                self.__setitem__(ident, info, _to_fs=False)
+                self._remember(ident, info, mtime)
+                if self.shared is not None:
+                    self.shared.put(ident, info, mtime)
 
         #If a source image is referred to in a cached info.json, check that it exists on disk.
         if info_and_lastmod:
             info = info_and_lastmod[0]
             if info.src_img_fp and not os.path.exists(info.src_img_fp):
                 logger.warning('%s cached info references src image which doesn\'t exist: %s' % (ident, info.src_img_fp))
+                with self._lock:
+                    self._dict.pop(ident, None)
                 return None
+            if entry is not None and self.verify_source_interval:
+                self._verified(ident, info)
 
         return info_and_lastmod
 
+    def _verified(self, ident, info):
+        with self._lock:
+            entry = self._dict.get(ident)
+            if entry is not None and entry[0] is info:
+                self._dict[ident] = (info, entry[1], time.monotonic())
+
+    def _get_shared(self, ident):
+        mtime = self._mtime(ident)
+        if mtime is None:
+            return None
+        info = self.shared.get(ident, mtime)
+        if info is None or not self._attach_profile(info):
+            return None
+        self._remember(ident, info, mtime)
+        return info, datetime.utcfromtimestamp(mtime)
+
+    def _mtime(self, ident):
+        if self.store is not None:
+            return self.store.mtime(ident)
+        try:
+            return os.stat(self._get_info_fp(ident)).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def _read(self, ident):
+        '''
+        Returns ((ImageInfo, float)):
+            The info and its modification time, or None.
+        '''
+        if self.store is not None:
+            record = self.store.get(ident)
+            if record is None:
+                return None
+            info_json, mtime = record
+            info = ImageInfo.from_json(info_json)
+        else:
+            info_fp = self._get_info_fp(ident)
+            if not os.path.exists(info_fp):
+                return None
+            info = ImageInfo.from_json_fp(info_fp)
+            mtime = os.path.getmtime(info_fp)
+
+            if info.color_profile_digest is None:
+                icc_fp = self._get_color_profile_fp(ident)
+                if os.path.exists(icc_fp):
+                    with open(icc_fp, "rb") as f:
+                        info.color_profile_bytes = f.read()
+
+        if not self._attach_profile(info):
+            return None
+        return info, mtime
+
+    def _write(self, ident, info):
+        '''
+        Returns (float):
+            The modification time of the entry.
+        '''
+        if info.color_profile_digest is not None:
+            self._write_profile(info.color_profile_digest, info.color_profile_bytes)
+
+        if self.store is not None:
+            mtime = time.time()
+            self.store.put(ident, info.to_full_info_json(), mtime)
+            return mtime
+
+        info_fp = self._get_info_fp(ident)
+        logger.debug('ident passed to __setitem__: %s', ident)
+        dp = os.path.dirname(info_fp)
+        os.makedirs(dp, exist_ok=True)
+        logger.debug('Created %s', dp)
+
+        with open(info_fp, 'w') as f:
+            f.write(info.to_full_info_json())
+        logger.debug('Created %s', info_fp)
+
+        return os.path.getmtime(info_fp)
+
+    def _get_profile_fp(self, digest):
+        return os.path.join(self.root, '.profiles', '%s.icc' % digest)
+
+    def _attach_profile(self, info):
+        '''Give info the colour profile its digest refers to.
+
+        Returns (bool):
+            False if the profile is missing (e.g. it was removed by a cache
+            cleaner), so the info can't be used.
+        '''
+        digest = info.color_profile_digest
+        if digest is None or info.color_profile_bytes is not None:
+            return True
+        profile = color_profiles.get(digest)
+        if profile is None:
+            if self.store is not None:
+                profile = self.store.profile(digest)
+            else:
+                try:
+                    with open(self._get_profile_fp(digest), 'rb') as f:
+                        profile = f.read()
+                except FileNotFoundError:
+                    pass
+        if profile is None:
+            logger.warning('Colour profile %s is missing from the info cache', digest)
+            return False
+        info.set_color_profile(profile, digest)
+        return True
+
+    def _write_profile(self, digest, profile):
+        if self.store is not None:
+            self.store.put_profile(digest, profile)
+            return
+        profile_fp = self._get_profile_fp(digest)
+        if os.path.exists(profile_fp):
+            return
+        os.makedirs(os.path.dirname(profile_fp), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(profile_fp), delete=False) as f:
+            f.write(profile)
+        safe_rename(f.name, profile_fp)
+        logger.debug('Created %s', profile_fp)
+
+    def _remember(self, ident, info, mtime):
+        if self.size > 0:
+            lastmod = datetime.utcfromtimestamp(mtime)
+            with self._lock:
+                self._dict[ident] = (info, lastmod, time.monotonic())
+                while len(self._dict) > self.size:
+                    self._dict.popitem(last=False)
+
     def has_key(self, ident):
-        return os.path.exists(self._get_info_fp(ident))
+        return self._mtime(ident) is not None
 
     def __contains__(self, ident):
         return self.has_key(ident)
@@ -347,44 +1079,35 @@ class InfoCache:
             return info_lastmod
 
     def __setitem__(self, ident, info, _to_fs=True):
-        info_fp = self._get_info_fp(ident)
         if _to_fs:
-            # to fs
-            logger.debug('ident passed to __setitem__: %s', ident)
-            dp = os.path.dirname(info_fp)
-            os.makedirs(dp, exist_ok=True)
-            logger.debug('Created %s', dp)
-
-            with open(info_fp, 'w') as f:
-                f.write(info.to_full_info_json())
-            logger.debug('Created %s', info_fp)
-
-
-            if info.color_profile_bytes:
-                icc_fp = self._get_color_profile_fp(ident)
-                with open(icc_fp, 'wb') as f:
-                    f.write(info.color_profile_bytes)
-                logger.debug('Created %s', icc_fp)
+            mtime = self._write(ident, info)
+            if self.shared is not None:
+                self.shared.put(ident, info, mtime)
+        else:
+            # The entry must already have been written before this is
+            # called - it's where the mtime gets drawn from.
+            # aka, nothing outside of this class should be using
+            # _to_fs=False
+            mtime = self._mtime(ident)
 
         # into mem
-        # The info file cache on disk must already exist before
-        # this is called - it's where the mtime gets drawn from.
-        # aka, nothing outside of this class should be using
-        # _to_fs=False
-        if self.size > 0:
-            lastmod = datetime.utcfromtimestamp(os.path.getmtime(info_fp))
-            with self._lock:
-                self._dict[ident] = (info,lastmod)
-                while len(self._dict) > self.size:
-                    self._dict.popitem(last=False)
+        self._remember(ident, info, mtime)
 
     def __delitem__(self, ident):
+        if self.shared is not None:
+            self.shared.discard(ident)
         with self._lock:
-            del self._dict[ident]
+            self._dict.pop(ident, None)
+
+        if self.store is not None:
+            self.store.remove(ident)
+            return
 
         info_fp = self._get_info_fp(ident)
         os.unlink(info_fp)
 
+        # From before profiles were stored by digest; those are shared with
+        # other entries, so they stay.
         icc_fp = self._get_color_profile_fp(ident)
         if os.path.exists(icc_fp):
             os.unlink(icc_fp)
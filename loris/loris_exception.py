@@ -19,6 +19,13 @@ class ResolverException(LorisException):
     pass
 
 
+class SourceNotFoundException(ResolverException):
+    """Raised when a resolver is sure an identifier has no source image (the
+    file doesn't exist, or the origin answered 404 or 410), rather than
+    failing to find out."""
+    pass
+
+
 class TransformException(LorisException):
     pass
 
@@ -2,6 +2,7 @@
 `resolver` -- Resolve Identifiers to Image Paths
 ================================================
 """
+from collections import OrderedDict
 from contextlib import closing
 import glob
 import json
@@ -11,14 +12,20 @@ from os.path import join, exists, dirname, split
 from os import remove
 from shutil import copy
 import tempfile
+from threading import Lock
+import time
 from urllib.parse import unquote
 import warnings
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from loris import constants
 from loris.identifiers import CacheNamer, IdentRegexChecker
-from loris.loris_exception import ResolverException, ConfigError
+from loris.loris_exception import (
+    ResolverException, SourceNotFoundException, ConfigError
+)
 from loris.utils import safe_rename
 from loris.img_info import ImageInfo
 
@@ -26,11 +33,121 @@ from loris.img_info import ImageInfo
 logger = getLogger(__name__)
 
 
+def _nearest_directory_mtime(fp):
+    '''
+    Returns ((str, int)):
+        The closest directory above fp that exists, and its mtime (ns), or
+        None. A file or directory created anywhere below that directory on
+        the way to fp changes its mtime.
+    '''
+    d = dirname(fp)
+    while True:
+        try:
+            return (d, os.stat(d).st_mtime_ns)
+        except (FileNotFoundError, NotADirectoryError):
+            parent = dirname(d)
+            if parent == d:
+                return None
+            d = parent
+
+
+class NegativeCache:
+    """Identifiers that recently failed to resolve, so that repeated
+    requests for them (e.g. from crawlers, or broken manifests) get a 404
+    without touching the file system or the origin server again.
+
+    Only identifiers the resolver is sure have no source are added, not
+    failures that may be transient (e.g. the origin server being down).
+    Entries expire after ttl seconds. An entry can also carry a token
+    describing the absence of its source, e.g. the mtime of the directory
+    the file would appear in; a lookup that gets a different token for it
+    now drops the entry, so a file that appears is found at once. Without
+    a token (e.g. for an origin server), a source that appears is found
+    once the entry expires, or when the resolver discards the entry itself.
+    The size newest entries are kept.
+
+    Slots:
+        ttl (float): Seconds an entry is used for.
+        size (int): Max entries before the oldest are dropped.
+        hits (int)
+        misses (int)
+        _dict (OrderedDict): ident -> (expiry time, message, token)
+        _lock (Lock): The lock.
+    """
+    __slots__ = ('ttl', 'size', 'hits', 'misses', '_dict', '_lock')
+
+    def __init__(self, ttl, size=10000):
+        self.ttl = ttl
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._dict = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._dict)
+
+    def get(self, ident, token_of=None):
+        '''
+        Args:
+            ident (str)
+            token_of (callable):
+                Called with ident if it has an entry; the entry is dropped
+                if this doesn't return the token it was added with.
+        Returns (str):
+            The message of the failure, or None if ident hasn't failed to
+            resolve in the last ttl seconds.
+        '''
+        with self._lock:
+            entry = self._dict.get(ident)
+        # Checked outside the lock, as it may stat files.
+        stale = (entry is not None and token_of is not None
+            and token_of(ident) != entry[2])
+        with self._lock:
+            if entry is not None and (stale or entry[0] <= time.monotonic()):
+                if self._dict.get(ident) is entry:
+                    del self._dict[ident]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def add(self, ident, message, token=None):
+        with self._lock:
+            self._dict.pop(ident, None)
+            self._dict[ident] = (time.monotonic() + self.ttl, message, token)
+            while len(self._dict) > self.size:
+                self._dict.popitem(last=False)
+
+    def discard(self, ident):
+        with self._lock:
+            self._dict.pop(ident, None)
+
+    def metrics(self):
+        return {
+            'entries': len(self._dict),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
 class _AbstractResolver:
 
+    # Resolvers that don't call this class's __init__ have none.
+    unresolvable = None
+
     def __init__(self, config):
         self.config = config
         if config:
+            negative_cache_ttl = self.config.get('negative_cache_ttl', 0)
+            if negative_cache_ttl:
+                self.unresolvable = NegativeCache(
+                    negative_cache_ttl,
+                    size=self.config.get('negative_cache_size', 10000)
+                )
+
             # check for previous settings
             if "use_extra_info" in self.config and "use_auth_rules" in self.config:
                 raise ConfigError("You cannot set both use_extra_info and use_auth_rules. Please remove use_extra_info from your config.")
@@ -74,6 +191,64 @@ class _AbstractResolver:
         cn = self.__class__.__name__
         raise NotImplementedError('resolve() not implemented for %s' % (cn,))
 
+    def source_exists(self, ident):
+        """
+        Like is_resolvable(), but tells a source that doesn't exist apart
+        from one that couldn't be looked for.
+
+        Returns:
+            bool: True or False, or None if it isn't known (e.g. the origin
+            server didn't answer).
+        """
+        return self.is_resolvable(ident)
+
+    def absence_token(self, ident):
+        """
+        Something that changes when the source of an identifier that
+        doesn't resolve may have appeared, and is cheap to get; see
+        NegativeCache. None if there's no such thing.
+        """
+        return None
+
+    def check_resolvable(self, ident):
+        '''is_resolvable(), answered without it for identifiers found to
+        have no source in the last negative_cache_ttl seconds.
+        '''
+        if self.unresolvable is None:
+            return self.is_resolvable(ident)
+        if self.unresolvable.get(ident, self.absence_token) is not None:
+            return False
+        found = self.source_exists(ident)
+        if found is False:
+            self.unresolvable.add(
+                ident,
+                'Source image not found for identifier: %s.' % (ident,),
+                self.absence_token(ident)
+            )
+        return bool(found)
+
+    def check_and_resolve(self, app, ident, base_uri):
+        '''resolve(), which raises the same SourceNotFoundException again
+        without calling it for identifiers found to have no source in the
+        last negative_cache_ttl seconds. Other ResolverExceptions aren't
+        remembered.
+        '''
+        if self.unresolvable is None:
+            return self.resolve(app, ident, base_uri)
+        message = self.unresolvable.get(ident, self.absence_token)
+        if message is not None:
+            raise SourceNotFoundException(message)
+        try:
+            return self.resolve(app, ident, base_uri)
+        except SourceNotFoundException as e:
+            self.unresolvable.add(ident, str(e), self.absence_token(ident))
+            raise
+
+    def source_appeared(self, ident):
+        '''Forget that ident failed to resolve.'''
+        if self.unresolvable is not None:
+            self.unresolvable.discard(ident)
+
     def get_auth_rules(self, ident, source_fp):
         """
         Given the identifier and any resolved source file (ie. on the filesystem), grab the associated
@@ -123,7 +298,7 @@ class SimpleFSResolver(_AbstractResolver):
 
     def raise_404_for_ident(self, ident):
         message = 'Source image not found for identifier: %s.' % (ident,)
-        raise ResolverException(message)
+        raise SourceNotFoundException(message)
 
     def source_file_path(self, ident):
         ident = unquote(ident)
@@ -135,6 +310,13 @@ class SimpleFSResolver(_AbstractResolver):
     def is_resolvable(self, ident):
         return not self.source_file_path(ident) is None
 
+    def absence_token(self, ident):
+        ident = unquote(ident)
+        return tuple(
+            _nearest_directory_mtime(join(directory, ident))
+            for directory in self.source_roots
+        )
+
     def resolve(self, app, ident, base_uri):
         if not self.is_resolvable(ident):
             self.raise_404_for_ident(ident)
@@ -179,6 +361,15 @@ class SimpleHTTPResolver(_AbstractResolver):
      self-signed certificate.
      * `cert`, path to an SSL client certificate to use for authentication. If `cert` and `key` are both present, they take precedence over `user` and `pw` for authentication.
      * `key`, path to an SSL client key to use for authentication.
+     * `pool_size`, the most connections kept open to the origin server by
+        each worker process (default 10).
+     * `keep_alive`, whether to reuse connections to the origin server
+        (default True).
+     * `retries`, how many times a request that fails to connect, or gets a
+        502, 503 or 504, is retried (default 0).
+     * `retry_backoff`, the backoff factor between retries (default 0.5, so
+        the waits are 0s, 1s, 2s, ...).
+     * `connect_timeout` and `read_timeout`, in seconds (defaults 10 and 60).
     '''
     def __init__(self, config):
         super().__init__(config)
@@ -203,6 +394,23 @@ class SimpleHTTPResolver(_AbstractResolver):
 
         self.ssl_check = self.config.get('ssl_check', True)
 
+        self.pool_size = self.config.get('pool_size', 10)
+
+        self.keep_alive = self.config.get('keep_alive', True)
+
+        self.retries = self.config.get('retries', 0)
+
+        self.retry_backoff = self.config.get('retry_backoff', 0.5)
+
+        self.timeout = (
+            self.config.get('connect_timeout', 10),
+            self.config.get('read_timeout', 60)
+        )
+
+        self._sessions = {}
+        self._sessions_pid = None
+        self._sessions_lock = Lock()
+
         self._ident_regex_checker = IdentRegexChecker(
             ident_regex=self.config.get('ident_regex')
         )
@@ -228,7 +436,46 @@ class SimpleHTTPResolver(_AbstractResolver):
         options['verify'] = self.ssl_check
         return options
 
+    def _session_key(self, ident):
+        '''Requests for identifiers with the same key share a pool of
+        connections.'''
+        return None
+
+    def _session(self, ident):
+        # Sessions (and their connections) can't be shared with forked
+        # workers.
+        with self._sessions_lock:
+            if self._sessions_pid != os.getpid():
+                self._sessions = {}
+                self._sessions_pid = os.getpid()
+            key = self._session_key(ident)
+            session = self._sessions.get(key)
+            if session is None:
+                session = self._sessions[key] = self._make_session()
+            return session
+
+    def _make_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_maxsize=self.pool_size,
+            max_retries=Retry(
+                total=self.retries,
+                read=False,
+                backoff_factor=self.retry_backoff,
+                status_forcelist=(502, 503, 504),
+                raise_on_status=False
+            )
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
     def is_resolvable(self, ident):
+        return bool(self.source_exists(ident))
+
+    def source_exists(self, ident):
         ident = unquote(ident)
 
         if not self._ident_regex_checker.is_allowed(ident):
@@ -241,17 +488,20 @@ class SimpleHTTPResolver(_AbstractResolver):
             try:
                 (url, options) = self._web_request_url(ident)
             except ResolverException:
-                return False
+                return None
 
+            session = self._session(ident)
             try:
                 if self.head_resolvable:
-                    response = requests.head(url, **options)
-                    return response.ok
+                    response = session.head(url, timeout=self.timeout, **options)
                 else:
-                    with closing(requests.get(url, stream=True, **options)) as response:
-                        return response.ok
-            except requests.ConnectionError:
-                return False
+                    with closing(session.get(url, stream=True, timeout=self.timeout, **options)) as response:
+                        pass
+            except (requests.ConnectionError, requests.Timeout):
+                return None
+            if response.ok:
+                return True
+            return False if response.status_code in (404, 410) else None
 
     def get_format(self, ident, potential_format):
         if self.default_format is not None:
@@ -282,7 +532,7 @@ class SimpleHTTPResolver(_AbstractResolver):
         )
 
     def raise_404_for_ident(self, ident):
-        raise ResolverException("Image not found for identifier: %r." % ident)
+        raise SourceNotFoundException("Image not found for identifier: %r." % ident)
 
     def cached_file_for_ident(self, ident):
         cache_dir = self.cache_dir_path(ident)
@@ -315,14 +565,21 @@ class SimpleHTTPResolver(_AbstractResolver):
         cache_dir = self.cache_dir_path(ident)
         os.makedirs(cache_dir, exist_ok=True)
 
-        with closing(requests.get(source_url, stream=True, **options)) as response:
+        session = self._session(ident)
+        with closing(session.get(source_url, stream=True, timeout=self.timeout, **options)) as response:
             if not response.ok:
                 logger.warn(
                     "Source image not found at %s for identifier: %s. "
                     "Status code returned: %s.",
                     source_url, ident, response.status_code
                 )
-                raise ResolverException(
+                # Only a 404 or 410 says there's no such image; anything
+                # else may be the origin failing.
+                if response.status_code in (404, 410):
+                    exception_class = SourceNotFoundException
+                else:
+                    exception_class = ResolverException
+                raise exception_class(
                     "Source image not found for identifier: %s. "
                     "Status code returned: %s." % (ident, response.status_code)
                 )
@@ -356,7 +613,7 @@ class SimpleHTTPResolver(_AbstractResolver):
             fn = bits[1].rsplit('.', 1)[0] + "." + self.auth_rules_ext
             rules_url = bits[0] + '/' + fn
             try:
-                resp = requests.get(rules_url)
+                resp = session.get(rules_url, timeout=self.timeout, **options)
                 if resp.status_code == 200:
                     local_rules_fp = join(cache_dir, "loris_cache." + self.auth_rules_ext)
                     if not exists(local_rules_fp):
@@ -371,6 +628,7 @@ class SimpleHTTPResolver(_AbstractResolver):
         cached_file_path = self.cached_file_for_ident(ident)
         if not cached_file_path:
             cached_file_path = self.copy_to_cache(ident)
+            self.source_appeared(ident)
         format_ = self.get_format(cached_file_path, None)
         auth_rules = self.get_auth_rules(ident, cached_file_path)
         return ImageInfo(app=app, src_img_fp=cached_file_path, src_format=format_, auth_rules=auth_rules)
@@ -428,6 +686,9 @@ class TemplateHTTPResolver(SimpleHTTPResolver):
     *   ``head_resolvable`` with value True, whether to make HEAD requests
         to validate object existence (don't set if using Fedora Commons
         prior to 3.8.)  [Currently must be the same for all templates.]
+    *   ``pool_size``, ``keep_alive``, ``retries``, ``retry_backoff``,
+        ``connect_timeout`` and ``read_timeout``, for the connections to
+        the origin servers; each template has its own pool of connections.
 
     """
     def __init__(self, config):
@@ -451,6 +712,10 @@ class TemplateHTTPResolver(SimpleHTTPResolver):
                 self.templates[name] = cfg
         logger.debug('TemplateHTTPResolver templates: %s', self.templates)
 
+    def _session_key(self, ident):
+        # A pool of connections for each template.
+        return ident.split(':', 1)[0]
+
     def _web_request_url(self, ident):
         # only split identifiers that look like template ids;
         # ignore other requests (e.g. favicon)
@@ -522,6 +787,9 @@ class SourceImageCachingResolver(_AbstractResolver):
         ident = unquote(ident)
         return join(self.cache_root, ident)
 
+    def absence_token(self, ident):
+        return _nearest_directory_mtime(self.source_file_path(ident))
+
     def in_cache(self, ident):
         return exists(self.cache_file_path(ident))
 
@@ -541,7 +809,7 @@ class SourceImageCachingResolver(_AbstractResolver):
             "Source image not found at %s for identifier: %s.",
             source_fp, ident
         )
-        raise ResolverException(
+        raise SourceNotFoundException(
             "Source image not found for identifier: %s." % ident
         )
 
@@ -550,6 +818,7 @@ class SourceImageCachingResolver(_AbstractResolver):
             self.raise_404_for_ident(ident)
         if not self.in_cache(ident):
             self.copy_to_cache(ident)
+            self.source_appeared(ident)
 
         cache_fp = self.cache_file_path(ident)
         format_ = self.format_from_ident(ident)
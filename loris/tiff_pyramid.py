@@ -0,0 +1,293 @@
+"""
+Reading regions from tiled, pyramidal TIFFs.
+
+A pyramidal TIFF stores the image at several resolutions, either as
+successive pages (IFDs) or as SubIFDs of the full resolution image.  When
+the levels are tiled we can pick the smallest level that still covers the
+requested size, and decode only the tiles that intersect the region.
+
+Pillow's libtiff decoder only decodes whole images, so each tile is
+wrapped in a minimal single-tile TIFF in memory and decoded on its own;
+libtiff still does the decompression, so every compression it supports
+(Deflate, LZW, JPEG, ...) works.
+
+Parsing the IFDs of a big pyramid isn't free, so the pyramids of the most
+recently used files are kept, and TiffPyramid.open() only parses a file
+again when its mtime changes.
+"""
+from collections import OrderedDict
+from io import BytesIO
+from logging import getLogger
+from math import ceil, floor
+import os
+import struct
+from threading import Lock
+
+from PIL import Image, TiffTags
+from PIL.TiffImagePlugin import ImageFileDirectory_v2
+
+logger = getLogger(__name__)
+
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+SUB_IFDS = 330
+ICC_PROFILE = 34675
+
+# Tags describing how a tile is encoded, copied into each single-tile TIFF.
+_TILE_ENCODING_TAGS = (
+    258,  # BitsPerSample
+    259,  # Compression
+    262,  # PhotometricInterpretation
+    277,  # SamplesPerPixel
+    284,  # PlanarConfiguration
+    317,  # Predictor
+    320,  # ColorMap
+    338,  # ExtraSamples
+    339,  # SampleFormat
+    347,  # JPEGTables
+    529,  # YCbCrCoefficients
+    530,  # YCbCrSubSampling
+    532,  # ReferenceBlackWhite
+)
+
+# Levels whose aspect ratio differs from the full image by more than this
+# aren't part of the pyramid (e.g. the label and macro images in slide
+# scanner TIFFs).
+_ASPECT_TOLERANCE = 0.02
+
+# The number of files whose parsed pyramids TiffPyramid.open() keeps.
+PYRAMID_CACHE_SIZE = 128
+
+# fp -> (mtime, TiffPyramid or None)
+_pyramids = OrderedDict()
+_pyramids_lock = Lock()
+
+
+class TiffLevel(object):
+    """One resolution of a tiled pyramidal TIFF.
+
+    Slots:
+        width (int)
+        height (int)
+        tile_width (int)
+        tile_height (int)
+        ifd (ImageFileDirectory_v2): The tags of this level.
+    """
+    __slots__ = ('width', 'height', 'tile_width', 'tile_height', 'ifd')
+
+    def __init__(self, ifd):
+        self.ifd = ifd
+        self.width = ifd[IMAGE_WIDTH]
+        self.height = ifd[IMAGE_LENGTH]
+        self.tile_width = ifd[TILE_WIDTH]
+        self.tile_height = ifd[TILE_LENGTH]
+
+    @property
+    def tiles_across(self):
+        return int(ceil(self.width / self.tile_width))
+
+    def tile_boxes(self, box):
+        """The (column, row) and pixel box of each tile intersecting `box`."""
+        x0, y0, x1, y1 = box
+        for row in range(y0 // self.tile_height, int(ceil(y1 / self.tile_height))):
+            for col in range(x0 // self.tile_width, int(ceil(x1 / self.tile_width))):
+                tx = col * self.tile_width
+                ty = row * self.tile_height
+                yield (col, row), (tx, ty, tx + self.tile_width, ty + self.tile_height)
+
+
+class TiffPyramid(object):
+    """The tiled levels of a TIFF, largest first.
+
+    Slots:
+        fp (str): Path to the TIFF.
+        levels ([TiffLevel])
+        icc_profile (bytes): The embedded colour profile, if any.
+    """
+    __slots__ = ('fp', 'levels', 'icc_profile')
+
+    def __init__(self, fp, levels, icc_profile=None):
+        self.fp = fp
+        self.levels = levels
+        self.icc_profile = icc_profile
+
+    @classmethod
+    def open(cls, fp):
+        """from_file(), remembered until the file's mtime changes.
+
+        Returns:
+            TiffPyramid, or None if the file isn't a tiled TIFF.
+        """
+        mtime = os.stat(fp).st_mtime_ns
+        with _pyramids_lock:
+            entry = _pyramids.get(fp)
+            if entry is not None and entry[0] == mtime:
+                _pyramids.move_to_end(fp)
+                return entry[1]
+        pyramid = cls.from_file(fp)
+        with _pyramids_lock:
+            _pyramids.pop(fp, None)
+            _pyramids[fp] = (mtime, pyramid)
+            while len(_pyramids) > PYRAMID_CACHE_SIZE:
+                _pyramids.popitem(last=False)
+        return pyramid
+
+    @classmethod
+    def from_file(cls, fp):
+        """
+        Returns:
+            TiffPyramid, or None if the file isn't a tiled TIFF.
+        """
+        with Image.open(fp) as im:
+            if im.format != 'TIFF' or TILE_WIDTH not in im.tag_v2:
+                return None
+            ifds = [_copy_ifd(im.tag_v2)]
+            sub_ifd_offsets = im.tag_v2.get(SUB_IFDS)
+            if sub_ifd_offsets:
+                if isinstance(sub_ifd_offsets, int):
+                    sub_ifd_offsets = (sub_ifd_offsets,)
+                for offset in sub_ifd_offsets:
+                    ifd = ImageFileDirectory_v2(prefix=im.tag_v2.prefix)
+                    im.fp.seek(offset)
+                    ifd.load(im.fp)
+                    ifds.append(ifd)
+            else:
+                for frame in range(1, getattr(im, 'n_frames', 1)):
+                    im.seek(frame)
+                    ifds.append(_copy_ifd(im.tag_v2))
+
+        base = ifds[0]
+        icc_profile = base.get(ICC_PROFILE)
+        base_aspect = base[IMAGE_WIDTH] / base[IMAGE_LENGTH]
+        levels = []
+        for ifd in ifds:
+            if TILE_WIDTH not in ifd or TILE_OFFSETS not in ifd:
+                continue
+            aspect = ifd[IMAGE_WIDTH] / ifd[IMAGE_LENGTH]
+            if abs(aspect - base_aspect) / base_aspect > _ASPECT_TOLERANCE:
+                continue
+            levels.append(TiffLevel(ifd))
+        levels.sort(key=lambda level: level.width, reverse=True)
+        logger.debug(
+            'TIFF pyramid levels for %s: %r', fp,
+            [(level.width, level.height) for level in levels]
+        )
+        return cls(fp, levels, icc_profile)
+
+    @property
+    def width(self):
+        return self.levels[0].width
+
+    @property
+    def height(self):
+        return self.levels[0].height
+
+    @property
+    def scale_factors(self):
+        return [int(round(self.width / level.width)) for level in self.levels]
+
+    def level_for(self, region_w, region_h, req_w, req_h):
+        """The smallest level at which the region is at least the requested
+        size (or the full resolution level, if none is).
+        """
+        for level in reversed(self.levels):
+            scale_x = self.width / level.width
+            scale_y = self.height / level.height
+            if region_w / scale_x >= req_w and region_h / scale_y >= req_h:
+                return level
+        return self.levels[0]
+
+    def read_region(self, level, box):
+        """Decode a region of one level.
+
+        Args:
+            level (TiffLevel)
+            box ((int, int, int, int)): The region, in full resolution
+                coordinates (x0, y0, x1, y1).
+        Returns:
+            PIL.Image: The region at the level's resolution.
+        """
+        scale_x = self.width / level.width
+        scale_y = self.height / level.height
+        level_box = (
+            int(floor(box[0] / scale_x)),
+            int(floor(box[1] / scale_y)),
+            min(int(ceil(box[2] / scale_x)), level.width),
+            min(int(ceil(box[3] / scale_y)), level.height),
+        )
+        tiles = list(level.tile_boxes(level_box))
+        logger.debug('Decoding %d tiles of the %dx%d level of %s', len(tiles),
+            level.width, level.height, self.fp)
+
+        offsets = level.ifd[TILE_OFFSETS]
+        byte_counts = level.ifd[TILE_BYTE_COUNTS]
+        canvas = None
+        with open(self.fp, 'rb') as f:
+            for (col, row), tile_box in tiles:
+                index = row * level.tiles_across + col
+                f.seek(offsets[index])
+                tile = _decode_tile(level, f.read(byte_counts[index]))
+                if canvas is None:
+                    canvas = Image.new(tile.mode, (
+                        level_box[2] - level_box[0],
+                        level_box[3] - level_box[1]
+                    ))
+                    if tile.mode in ('P', 'PA'):
+                        # The tiles share the level's ColorMap.
+                        canvas.putpalette(tile.getpalette())
+                canvas.paste(tile, (
+                    tile_box[0] - level_box[0],
+                    tile_box[1] - level_box[1]
+                ))
+
+        if self.icc_profile:
+            canvas.info['icc_profile'] = self.icc_profile
+        return canvas
+
+
+def _copy_ifd(ifd):
+    # Seeking to another frame reloads the same ImageFileDirectory_v2, so
+    # we keep a copy of each.
+    copy = ImageFileDirectory_v2(prefix=ifd.prefix)
+    for tag, value in ifd.items():
+        copy[tag] = value
+        copy.tagtype[tag] = ifd.tagtype[tag]
+    return copy
+
+
+def _decode_tile(level, data):
+    # The tile's samples are in the byte order of the file it came from, so
+    # the single-tile TIFF has to be too.
+    prefix = level.ifd.prefix
+    ifd = ImageFileDirectory_v2(prefix=prefix)
+    for tag in _TILE_ENCODING_TAGS:
+        if tag in level.ifd:
+            ifd[tag] = level.ifd[tag]
+            ifd.tagtype[tag] = level.ifd.tagtype[tag]
+    ifd[IMAGE_WIDTH] = level.tile_width
+    ifd[IMAGE_LENGTH] = level.tile_height
+    ifd[TILE_WIDTH] = level.tile_width
+    ifd[TILE_LENGTH] = level.tile_height
+    for tag in (IMAGE_WIDTH, IMAGE_LENGTH, TILE_WIDTH, TILE_LENGTH,
+            TILE_OFFSETS, TILE_BYTE_COUNTS):
+        ifd.tagtype[tag] = TiffTags.LONG
+    ifd[TILE_BYTE_COUNTS] = (len(data),)
+
+    # The IFD's length doesn't depend on the tile offset, so write it once
+    # to find out where the tile data will start.
+    ifd[TILE_OFFSETS] = (0,)
+    data_offset = 8 + len(ifd.tobytes(8))
+    ifd[TILE_OFFSETS] = (data_offset,)
+
+    if prefix == b'MM':
+        header = b'MM\x00*' + struct.pack('>L', 8)
+    else:
+        header = b'II*\x00' + struct.pack('<L', 8)
+    buf = header + ifd.tobytes(8) + data
+    tile = Image.open(BytesIO(buf))
+    tile.load()
+    return tile
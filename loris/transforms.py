@@ -1,3 +1,4 @@
+from collections import OrderedDict
 from io import BytesIO
 from logging import getLogger
 from math import ceil, log
@@ -5,26 +6,58 @@ import os
 import platform
 import subprocess
 import tempfile
+import threading
 
 from PIL import Image
+from PIL.ImageFile import Parser
 from PIL.ImageOps import mirror
 
 # This import is only used for converting embedded color profiles to sRGB,
 # which is a user-configurable setting.  If they don't have this enabled,
 # the failure of this import isn't catastrophic.
 try:
-    from PIL.ImageCms import profileToProfile, PyCMSError
+    from PIL.ImageCms import (
+        buildTransform, FLAGS, ImageCmsProfile, PyCMSError
+    )
     has_imagecms = True
 except ImportError:
     has_imagecms = False
 
+from loris.decoder_pool import DecoderPool
 from loris.loris_exception import ConfigError, TransformException
-from loris.parameters import FULL_MODE
-from loris.utils import decode_bytes
+from loris.tiff_pyramid import TiffPyramid
+from loris.utils import decode_bytes, icc_profile_digest
 
 
 logger = getLogger(__name__)
 
+# Image.transpose() methods for each (mirror, clockwise rotation); IIIF
+# mirrors first, then rotates.
+TRANSPOSE_METHODS = {
+    (False, 0): None,
+    (False, 90): Image.ROTATE_270,
+    (False, 180): Image.ROTATE_180,
+    (False, 270): Image.ROTATE_90,
+    (True, 0): Image.FLIP_LEFT_RIGHT,
+    (True, 90): Image.TRANSVERSE,
+    (True, 180): Image.FLIP_TOP_BOTTOM,
+    (True, 270): Image.TRANSPOSE,
+}
+
+# Pillow's names for the target formats.
+PIL_FORMATS = {
+    'jpg': 'JPEG',
+    'png': 'PNG',
+    'gif': 'GIF',
+    'webp': 'WEBP',
+    'tif': 'TIFF',
+}
+
+# Modes that can be converted to L before resizing gray and bitonal images,
+# within a few levels of converting after. Not P: Pillow resizes that with
+# the nearest pixel, so the results would differ a lot.
+EARLY_GRAY_MODES = ('RGB', 'RGBX', 'CMYK', 'YCbCr')
+
 
 def _validate_color_profile_conversion_config(config):
     """
@@ -46,6 +79,139 @@ def _validate_color_profile_conversion_config(config):
         )
 
 
+# Pillow save() options for each target format, as a list of
+# (max_pixels, options) size classes; the first class whose max_pixels is
+# at least the number of pixels in the output image is used, and a
+# max_pixels of None matches any size.  Override them per format in
+# [transforms][[encoders]].
+DEFAULT_ENCODER_PROFILES = {
+    # see http://pillow.readthedocs.org/en/latest/handbook/image-file-formats.html#jpeg
+    'jpg': [(None, {'quality': 90})],
+    # see http://pillow.readthedocs.org/en/latest/handbook/image-file-formats.html#png
+    'png': [(None, {'optimize': True, 'bits': 256})],
+    # see http://pillow.readthedocs.org/en/latest/handbook/image-file-formats.html#gif
+    'gif': [(None, {})],
+    # see http://pillow.readthedocs.org/en/latest/handbook/image-file-formats.html#webp
+    'webp': [(None, {'quality': 90})],
+    # see http://pillow.readthedocs.io/en/latest/handbook/image-file-formats.html#tiff
+    'tif': [(None, {'compression': 'None'})],
+}
+
+
+def _load_encoder_profiles(config):
+    """
+    Merge the [[encoders]] config over the default encoder profiles.
+    """
+    profiles = dict(DEFAULT_ENCODER_PROFILES)
+    for fmt, size_classes in (config.get('encoders') or {}).items():
+        try:
+            profiles[fmt] = [
+                (max_pixels, dict(options))
+                for max_pixels, options in size_classes
+            ]
+        except (TypeError, ValueError):
+            raise ConfigError(
+                'Encoder profiles for %r should be a list of '
+                '(max_pixels, {options}) pairs, not %r' % (fmt, size_classes)
+            )
+    return profiles
+
+
+class ColorTransformCache:
+    """The n most recently used LittleCMS transforms from embedded colour
+    profiles to sRGB, so each profile is only parsed, and each transform only
+    built, once.
+
+    Transforms are keyed by (profile digest, input mode, output mode).
+
+    Slots:
+        srgb_profile_fp (str): The sRGB profile we map to.
+        size (int): Max transforms before we start popping (LRU).
+        hits (int)
+        misses (int)
+        _srgb_profile (ImageCmsProfile): Parsed from srgb_profile_fp.
+        _dict (OrderedDict): The map.
+        _lock (Lock): The lock.
+    """
+    __slots__ = ('srgb_profile_fp', 'size', 'hits', 'misses', '_srgb_profile',
+        '_dict', '_lock')
+
+    def __init__(self, srgb_profile_fp, size=64):
+        self.srgb_profile_fp = srgb_profile_fp
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._srgb_profile = None
+        self._dict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._dict)
+
+    def get(self, profile_bytes, in_mode, out_mode, digest=None):
+        '''
+        Args:
+            profile_bytes (bytes): The embedded ICC profile.
+            in_mode (str)
+            out_mode (str)
+            digest (str): icc_profile_digest(profile_bytes), if it's
+                already known.
+        Returns:
+            ImageCmsTransform
+        '''
+        key = (digest or icc_profile_digest(profile_bytes), in_mode, out_mode)
+        with self._lock:
+            transform = self._dict.pop(key, None)
+            if transform is not None:
+                self._dict[key] = transform
+                self.hits += 1
+                return transform
+            self.misses += 1
+
+        if self._srgb_profile is None:
+            self._srgb_profile = ImageCmsProfile(self.srgb_profile_fp)
+        # Without LittleCMS's one-pixel cache, a transform can be used by
+        # several threads at once.
+        transform = buildTransform(
+            ImageCmsProfile(BytesIO(profile_bytes)), self._srgb_profile,
+            in_mode, out_mode, flags=FLAGS['NOTCACHE']
+        )
+        with self._lock:
+            self._dict[key] = transform
+            while len(self._dict) > self.size:
+                self._dict.popitem(last=False)
+        return transform
+
+
+def _dct_scale(full_size, draft_size):
+    '''
+    Returns (int): the JPEG DCT scale (1, 2, 4 or 8) that decodes an image
+        of full_size at draft_size. libjpeg rounds scaled dimensions up.
+    '''
+    for scale in (8, 4, 2):
+        if all(int(ceil(f / scale)) == d for f, d in zip(full_size, draft_size)):
+            return scale
+    return 1
+
+
+def _crop_to_pixels(im, box):
+    '''
+    Crop to the whole pixels covering a box that may have fractional
+    coordinates.
+
+    Returns:
+        (PIL.Image, tuple): The cropped image, and where the box lies in it,
+            or None if that's the whole image.
+    '''
+    outer = (int(box[0]), int(box[1]), int(ceil(box[2])), int(ceil(box[3])))
+    logger.debug('cropping to: %r', outer)
+    im = im.crop(outer)
+    box = (box[0] - outer[0], box[1] - outer[1], box[2] - outer[0], box[3] - outer[1])
+    if box == (0, 0) + im.size:
+        box = None
+    return im, box
+
+
 class _AbstractTransformer(object):
 
     def __init__(self, config):
@@ -53,17 +219,91 @@ class _AbstractTransformer(object):
         self.config = config
         self.target_formats = config['target_formats']
         self.dither_bitonal_images = config['dither_bitonal_images']
+        self.reducing_gap = config.get('reducing_gap')
+        self.encoder_profiles = _load_encoder_profiles(config)
+        self.color_transforms = None
+        if self.map_profile_to_srgb:
+            self.color_transforms = ColorTransformCache(
+                self.srgb_profile_fp,
+                size=config.get('color_transform_cache_size', 64)
+            )
 
     def transform(self, target_fp, image_request, image_info):
         '''
         Args:
-            target_fp (str)
+            target_fp (str or file object): Where to write the image.
             image_request (ImageRequest)
             image_info (ImageInfo)
         '''
         cn = self.__class__.__name__
         raise NotImplementedError('transform() not implemented for %s' % (cn,))
 
+    def transform_sizes(self, targets, image_info):
+        '''
+        Derive several full-region images from a single decode of the
+        source, which is decoded for the largest of them.
+
+        Args:
+            targets ([(str, ImageRequest)]):
+                Target paths, and the full-region, unrotated requests to
+                derive into them.
+            image_info (ImageInfo)
+        '''
+        largest = max(
+            (image_request for _, image_request in targets),
+            key=lambda image_request: image_request.size_param(image_info).w
+        )
+        im, box = self._decode_region(largest, image_info)
+        im.load()
+        for target_fp, image_request in targets:
+            self._derive_from_decoded(im, target_fp, image_request, image_info, box=box)
+
+    def transform_from_derivative(self, source_fp, target_fp, image_request, image_info):
+        '''
+        Make a full-region, unrotated image from a larger derivative of the
+        same source, rather than from the source itself.
+
+        Args:
+            source_fp (str): The derivative.
+            target_fp (str)
+            image_request (ImageRequest)
+            image_info (ImageInfo)
+        '''
+        im = Image.open(source_fp)
+        if self.map_profile_to_srgb:
+            # The derivative has already been mapped to sRGB.
+            im.info.pop('icc_profile', None)
+        self._derive_with_pil(
+            im=im,
+            target_fp=target_fp,
+            image_request=image_request,
+            image_info=image_info,
+            crop=False
+        )
+
+    def _decode_region(self, image_request, image_info):
+        '''
+        Decode the requested region of the source, at any resolution that
+        still covers the requested size.
+
+        Returns:
+            (PIL.Image, tuple): The decoded image, and the box the region
+                occupies in it, or None if it's the whole image. The box may
+                have fractional coordinates, which are left to the resize.
+        '''
+        cn = self.__class__.__name__
+        raise NotImplementedError('_decode_region() not implemented for %s' % (cn,))
+
+    def _derive_from_decoded(self, im, target_fp, image_request, image_info, box=None):
+        self._derive_with_pil(
+            im=im,
+            target_fp=target_fp,
+            image_request=image_request,
+            image_info=image_info,
+            crop=False,
+            box=box
+        )
+
     @property
     def map_profile_to_srgb(self):
         return self.config.get('map_profile_to_srgb', False)
@@ -72,16 +312,33 @@ class _AbstractTransformer(object):
     def srgb_profile_fp(self):
         return self.config.get('srgb_profile_fp')
 
-    def _map_im_profile_to_srgb(self, im, input_profile):
-        return profileToProfile(im, input_profile, self.srgb_profile_fp)
+    def _map_im_profile_to_srgb(self, im, profile_bytes, digest=None):
+        transform = self.color_transforms.get(
+            profile_bytes, im.mode, im.mode, digest=digest
+        )
+        return transform.apply(im)
+
+    def encoder_options(self, fmt, pixels):
+        '''
+        Args:
+            fmt (str): The target format.
+            pixels (int): The number of pixels in the image to be saved.
+        Returns:
+            ({}) keyword arguments for Image.save()
+        '''
+        for max_pixels, options in self.encoder_profiles.get(fmt, []):
+            if max_pixels is None or pixels <= max_pixels:
+                return options
+        return {}
 
-    def _derive_with_pil(self, im, target_fp, image_request, image_info, rotate=True, crop=True):
+    def _derive_with_pil(self, im, target_fp, image_request, image_info, rotate=True, crop=True,
+                         box=None):
         '''
         Once you have a PIL.Image, this can be used to do the IIIF operations.
 
         Args:
             im (PIL.Image)
-            target_fp (str)
+            target_fp (str or file object)
             image_request (ImageRequest)
             image_info (ImageInfo)
             rotate (bool):
@@ -90,11 +347,17 @@ class _AbstractTransformer(object):
             crop (bool):
                 True by default; can be set to False when the region was already
                 extracted further upstream.
+            box (tuple):
+                With crop=False, where the region lies in `im` if it was
+                located but not extracted upstream. Fractional coordinates are
+                resampled rather than rounded.
         Returns:
             void (puts an image at target_fp)
 
         '''
         region_param = image_request.region_param(image_info=image_info)
+        size_param = image_request.size_param(image_info=image_info)
+        rotation_param = image_request.rotation_param()
 
         if crop and region_param.canonical_uri_value != 'full':
             # For PIL: "The box is a 4-tuple defining the left, upper, right,
@@ -105,47 +368,68 @@ class _AbstractTransformer(object):
                 region_param.pixel_x + region_param.pixel_w,
                 region_param.pixel_y + region_param.pixel_h
             )
-            logger.debug('cropping to: %r', box)
-            im = im.crop(box)
 
-        # resize
-        size_param = image_request.size_param(image_info=image_info)
+        # Gray and bitonal images can be resized as one channel rather than
+        # three, unless we still need the colours to map the colour profile.
+        if (
+            image_request.quality in ('gray', 'bitonal') and
+            im.mode in EARLY_GRAY_MODES and
+            not (self.map_profile_to_srgb and 'icc_profile' in im.info)
+        ):
+            if box is not None:
+                im, box = _crop_to_pixels(im, box)
+            im = im.convert('L')
 
         if size_param.canonical_uri_value != 'full':
             wh = [int(size_param.w), int(size_param.h)]
-            logger.debug('Resizing to: %r', wh)
-            im = im.resize(wh, resample=Image.ANTIALIAS)
-
-        rotation_param = image_request.rotation_param()
-
-        if rotation_param.mirror:
+            options = {}
+            if self.reducing_gap is not None:
+                # Only Pillow 7.0 and later accept this.
+                options['reducing_gap'] = self.reducing_gap
+            if box is not None:
+                # Crop to whole pixels first, so the filter doesn't blend
+                # in pixels from around the region, and resize from any
+                # fraction of a pixel that's left.
+                im, box = _crop_to_pixels(im, box)
+            if box is not None:
+                logger.debug('Resizing %r to: %r', box, wh)
+                im = im.resize(wh, resample=Image.ANTIALIAS, box=box, **options)
+            else:
+                logger.debug('Resizing to: %r', wh)
+                im = im.resize(wh, resample=Image.ANTIALIAS, **options)
+        elif box is not None:
+            im, _ = _crop_to_pixels(im, box)
+
+        # Mirroring and right-angle rotations are done together as a single
+        # lossless transpose.
+        rotation = float(rotation_param.rotation) if rotate else 0.0
+        right_angle = rotation % 90 == 0.0
+        if right_angle:
+            method = TRANSPOSE_METHODS[(rotation_param.mirror, int(rotation) % 360)]
+            if method is not None:
+                im = im.transpose(method)
+        elif rotation_param.mirror:
             im = mirror(im)
 
         try:
             if self.map_profile_to_srgb and 'icc_profile' in im.info:
-                embedded_profile = BytesIO(im.info['icc_profile'])
-                im = self._map_im_profile_to_srgb(im, embedded_profile)
+                im = self._map_im_profile_to_srgb(im, im.info['icc_profile'])
         except PyCMSError as err:
             logger.warn(
                 'Error converting %r (%r) to sRGB: %r',
                 image_request.ident, image_info.src_img_fp, err
             )
 
-        if rotation_param.rotation != '0' and rotate:
-            r = 0 - float(rotation_param.rotation)
-
+        if not right_angle:
             # We need to convert pngs here and not below if we want a
             # transparent background (A == Alpha layer)
-            if (
-                float(rotation_param.rotation) % 90 != 0.0 and
-                image_request.format == 'png'
-            ):
+            if image_request.format == 'png':
                 if image_request.quality in ('gray', 'bitonal'):
                     im = im.convert('LA')
                 else:
                     im = im.convert('RGBA')
 
-            im = im.rotate(r, expand=True)
+            im = im.rotate(-rotation, expand=True)
 
         # If the source format is a PNG image with transparency (mode RGBA)
         # and we're writing as a non-transparent format (e.g. RGB), we need
@@ -168,45 +452,122 @@ class _AbstractTransformer(object):
                 dither = Image.FLOYDSTEINBERG if self.dither_bitonal_images else Image.NONE
                 im = im.convert('1', dither=dither)
 
-        if image_request.format == 'jpg':
-            # see http://pillow.readthedocs.org/en/latest/handbook/image-file-formats.html#jpeg
-            im.save(target_fp, quality=90)
+        options = self.encoder_options(image_request.format, im.width * im.height)
+        logger.debug('Saving %s with %r', image_request.format, options)
+        im.save(target_fp, format=PIL_FORMATS.get(image_request.format), **options)
 
-        elif image_request.format == 'png':
-            # see http://pillow.readthedocs.org/en/latest/handbook/image-file-formats.html#png
-            im.save(target_fp, optimize=True, bits=256)
 
-        elif image_request.format == 'gif':
-            # see http://pillow.readthedocs.org/en/latest/handbook/image-file-formats.html#gif
-            im.save(target_fp)
+class _PillowTransformer(_AbstractTransformer):
 
-        elif image_request.format == 'webp':
-            # see http://pillow.readthedocs.org/en/latest/handbook/image-file-formats.html#webp
-            im.save(target_fp, quality=90)
+    def _decode_region(self, image_request, image_info):
+        # The region isn't cropped out here; _derive_with_pil crops it along
+        # with the resize.
+        im = Image.open(image_info.src_img_fp)
+        region_param = image_request.region_param(image_info=image_info)
+        box = None
+        if region_param.canonical_uri_value != 'full':
+            # For PIL: "The box is a 4-tuple defining the left, upper, right,
+            # and lower pixel coordinate."
+            box = (
+                region_param.pixel_x,
+                region_param.pixel_y,
+                region_param.pixel_x + region_param.pixel_w,
+                region_param.pixel_y + region_param.pixel_h
+            )
+        return im, box
 
-        elif image_request.format == 'tif':
-            # see http://pillow.readthedocs.io/en/latest/handbook/image-file-formats.html#tiff
-            im.save(target_fp, compression='None')
+    def transform(self, target_fp, image_request, image_info):
+        im, box = self._decode_region(image_request, image_info)
+        self._derive_from_decoded(im, target_fp, image_request, image_info, box=box)
 
 
-class _PillowTransformer(_AbstractTransformer):
+class JPG_Transformer(_PillowTransformer):
+    '''
+    Uses libjpeg's DCT scaling (Image.draft) to decode at 1/2, 1/4 or 1/8 of
+    the full size when the requested size allows it, so e.g. a thumbnail
+    doesn't need the whole image decoded.
+    '''
+    def __init__(self, config):
+        super().__init__(config)
+        self.jpeg_draft_mode = config.get('jpeg_draft_mode', True)
 
-    def transform(self, target_fp, image_request, image_info):
-        im = Image.open(image_info.src_img_fp)
-        self._derive_with_pil(
-            im=im,
-            target_fp=target_fp,
-            image_request=image_request,
-            image_info=image_info
+    def _draft_scale(self, image_request, image_info):
+        '''
+        Returns (int): the largest DCT scale (1, 2, 4 or 8) at which the
+            region still covers the requested size.
+        '''
+        region_param = image_request.region_param(image_info)
+        size_param = image_request.size_param(image_info)
+        max_scale = min(
+            region_param.pixel_w // int(size_param.w),
+            region_param.pixel_h // int(size_param.h)
         )
+        return max([s for s in (1, 2, 4, 8) if s <= max_scale] or [1])
 
+    def _decode_region(self, image_request, image_info):
+        scale = self._draft_scale(image_request, image_info) if self.jpeg_draft_mode else 1
+        if scale == 1:
+            return super()._decode_region(image_request, image_info)
 
-class JPG_Transformer(_PillowTransformer):
-    pass
+        im = Image.open(image_info.src_img_fp)
+        # Image.draft() picks the largest scale for which the image is
+        # at least the given size, so this gets us exactly `scale`. What it
+        # returns differs between Pillow versions, so the scale it chose is
+        # read back from the image's new size.
+        full_w, full_h = im.size
+        im.draft(None, (full_w // scale, full_h // scale))
+        scale = _dct_scale((full_w, full_h), im.size)
+        if scale == 1:
+            return super()._decode_region(image_request, image_info)
+
+        logger.debug('Decoding %s at 1/%d scale', image_info.src_img_fp, scale)
+        region_param = image_request.region_param(image_info)
+        box = None
+        if region_param.canonical_uri_value != 'full':
+            box = (
+                region_param.pixel_x / scale,
+                region_param.pixel_y / scale,
+                min((region_param.pixel_x + region_param.pixel_w) / scale, im.size[0]),
+                min((region_param.pixel_y + region_param.pixel_h) / scale, im.size[1])
+            )
+        return im, box
 
 
 class TIF_Transformer(_PillowTransformer):
-    pass
+    '''
+    For tiled, pyramidal TIFFs, reads the region from the smallest level
+    that still covers the requested size, decoding only the tiles that
+    intersect it. Other TIFFs are decoded whole by Pillow.
+    '''
+    def __init__(self, config):
+        super().__init__(config)
+        self.tiff_pyramids = config.get('tiff_pyramids', True)
+
+    def _decode_region(self, image_request, image_info):
+        pyramid = None
+        if self.tiff_pyramids:
+            pyramid = TiffPyramid.open(image_info.src_img_fp)
+
+        if pyramid is None:
+            return super()._decode_region(image_request, image_info)
+
+        region_param = image_request.region_param(image_info)
+        size_param = image_request.size_param(image_info)
+        level = pyramid.level_for(
+            region_param.pixel_w, region_param.pixel_h,
+            int(size_param.w), int(size_param.h)
+        )
+        box = (
+            region_param.pixel_x,
+            region_param.pixel_y,
+            region_param.pixel_x + region_param.pixel_w,
+            region_param.pixel_y + region_param.pixel_h
+        )
+        logger.debug(
+            'Reading %r from the %dx%d level of %s',
+            box, level.width, level.height, image_info.src_img_fp
+        )
+        return pyramid.read_region(level, box), None
 
 
 class PNG_Transformer(_PillowTransformer):
@@ -217,12 +578,24 @@ class _AbstractJP2Transformer(_AbstractTransformer):
     '''
     Shared methods and configuration for the Kakadu and OpenJPEG transformers.
     '''
+    decoder_name = 'jp2'
+
     def __init__(self, config):
         self.tmp_dp = config['tmp_dp']
         #if there's an error making the dirs, just let it propagate up
         os.makedirs(self.tmp_dp, exist_ok=True)
         super().__init__(config)
         self.transform_timeout = config.get('timeout', 120)
+        self.stream_decoder_output = config.get('stream_decoder_output', False)
+        self.decoder_pool = None
+        if config.get('decoder_pool_workers', 0):
+            self.decoder_pool = DecoderPool(
+                transformer_class=self.__class__,
+                config=config,
+                workers=config['decoder_pool_workers'],
+                cpu_budget=config.get('decoder_pool_cpu_budget'),
+                slots_dp=config.get('decoder_pool_slots_dp')
+            )
 
     def _scale_dim(self, dim, scale):
         return int(ceil(dim/float(scale)))
@@ -235,26 +608,106 @@ class _AbstractJP2Transformer(_AbstractTransformer):
                 if self._scale_dim(full_w,s) >= req_w and \
                     self._scale_dim(full_h,s) >= req_h])
 
+    def _reduced_extent(self, offset, length, scale):
+        # The decoders map the region onto the reduced resolution grid
+        # edge by edge, so a region that isn't aligned to the scale loses a
+        # pixel at its start.
+        return self._scale_dim(offset + length, scale) - self._scale_dim(offset, scale)
+
+    def _get_closest_region_scale(self, req_w, req_h, region_param, scales):
+        x, y = region_param.pixel_x, region_param.pixel_y
+        w, h = region_param.pixel_w, region_param.pixel_h
+        if req_w > w or req_h > h:
+            return 1
+        return max([s for s in scales
+            if self._reduced_extent(x, w, s) >= req_w and
+                self._reduced_extent(y, h, s) >= req_h] or [1])
+
     def _scales_to_reduce_arg(self, image_request, image_info):
         # Scales from JP2 levels, so even though these are from the tiles
         # info.json, it's easier than using the sizes from info.json
         scales = [s for t in image_info.tiles for s in t['scaleFactors']]
-        is_full_region = image_request.region_param(image_info).mode == FULL_MODE
         arg = None
-        if scales and is_full_region:
-            full_w = image_info.width
-            full_h = image_info.height
-            req_w = image_request.size_param(image_info).w
-            req_h = image_request.size_param(image_info).h
-            closest_scale = self._get_closest_scale(req_w, req_h, full_w, full_h, scales)
+        if scales:
+            # Both decoders take the region in full-resolution coordinates
+            # (kdu_expand as fractions, opj_decompress as reference grid
+            # pixels) and apply the reduction to it, so we compare the size
+            # of the region -- not the whole image -- with the requested
+            # size.  Pillow only has to do the remaining resize.
+            region_param = image_request.region_param(image_info)
+            size_param = image_request.size_param(image_info)
+            closest_scale = self._get_closest_region_scale(
+                size_param.w, size_param.h, region_param, scales
+            )
             reduce_arg = int(log(closest_scale, 2))
             arg = str(reduce_arg)
         return arg
 
-    def _process(self, transform_cmd, target_fp, image_request, image_info, tmp_img_fp):
+    def _decode_to_file(self, transform_cmd, tmp_img_fp):
         #generate tmp img with opj_decompress or kdu_expand
+        subprocess.run(transform_cmd.split(), check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self.env)
+        return Image.open(tmp_img_fp)
+
+    def _decode_to_fifo(self, transform_cmd, tmp_img_fp):
+        '''
+        Like _decode_to_file, but tmp_img_fp is created as a named pipe and
+        the decoder's output is parsed by Pillow as it is written, so the
+        decoded image never touches the disk.
+        '''
+        os.mkfifo(tmp_img_fp)
+        # Open both ends before starting the decoder. The read end is opened
+        # non-blocking so it can't wait forever for a writer that never
+        # comes (e.g. if the decoder fails before opening its output), and
+        # holding our own write end until the decoder has exited means we
+        # only see EOF after that, however early or late it opened the pipe.
+        read_fd = os.open(tmp_img_fp, os.O_RDONLY | os.O_NONBLOCK)
+        os.set_blocking(read_fd, True)
+        write_fd = os.open(tmp_img_fp, os.O_WRONLY | os.O_NONBLOCK)
+        try:
+            proc = subprocess.Popen(transform_cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self.env)
+        except Exception:
+            os.close(read_fd)
+            os.close(write_fd)
+            raise
+        outputs = {}
+
+        def _wait_for_decoder():
+            try:
+                outputs['stdout'], outputs['stderr'] = proc.communicate(timeout=self.transform_timeout)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                outputs['stdout'], outputs['stderr'] = proc.communicate()
+            finally:
+                os.close(write_fd)
+
+        waiter = threading.Thread(target=_wait_for_decoder)
+        waiter.start()
+        parser = Parser()
+        try:
+            with os.fdopen(read_fd, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    parser.feed(chunk)
+        finally:
+            waiter.join()
+
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(
+                proc.returncode, proc.args,
+                output=outputs.get('stdout'), stderr=outputs.get('stderr')
+            )
+        return parser.close()
+
+    def _run_decoder(self, transform_cmd, tmp_img_fp):
+        '''
+        Run opj_decompress or kdu_expand, and return the decoded image,
+        fully loaded (tmp_img_fp won't outlive the caller's temp dir).
+        '''
         try:
-            subprocess.run(transform_cmd.split(), check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self.env)
+            if self.stream_decoder_output:
+                im = self._decode_to_fifo(transform_cmd, tmp_img_fp)
+            else:
+                im = self._decode_to_file(transform_cmd, tmp_img_fp)
+                im.load()
         except subprocess.CalledProcessError as e:
             msg = str(e)
             if e.stderr:
@@ -262,12 +715,57 @@ class _AbstractJP2Transformer(_AbstractTransformer):
             if e.stdout:
                 msg = f'{msg}; stdout: {decode_bytes(e.stdout)}'
             raise RuntimeError(msg)
-        #now open that image with Pillow
-        im = Image.open(tmp_img_fp)
+        return im
+
+    def _decode(self, image_request, image_info, num_threads=None):
+        '''
+        Decode the requested region at the reduced resolution.
+
+        Args:
+            image_request (ImageRequest)
+            image_info (ImageInfo)
+            num_threads (int):
+                Threads the decoder may use, if it's multi-threaded; None
+                for the transformer's own setting.
+        Returns:
+            PIL.Image
+        '''
+        cn = self.__class__.__name__
+        raise NotImplementedError('_decode() not implemented for %s' % (cn,))
+
+    def _decode_region(self, image_request, image_info):
+        if self.decoder_pool is not None:
+            im = self.decoder_pool.decode(
+                image_request, image_info, timeout=self.transform_timeout
+            )
+        else:
+            im = self._decode(image_request, image_info)
+        return im, None
+
+    def transform(self, target_fp, image_request, image_info):
+        try:
+            im, box = self._decode_region(image_request, image_info)
+            self._derive_from_decoded(im, target_fp, image_request, image_info, box=box)
+        except Exception as e:
+            raise TransformException(f'{self.decoder_name} transform error: {e}')
+
+    def transform_sizes(self, targets, image_info):
+        try:
+            super().transform_sizes(targets, image_info)
+        except Exception as e:
+            raise TransformException(f'{self.decoder_name} transform error: {e}')
+
+    def _derive_from_decoded(self, im, target_fp, image_request, image_info, box=None):
+        '''
+        Map the colour profile of a decoded region and hand it on to
+        _derive_with_pil; the region has already been extracted.
+        '''
         try:
             if self.map_profile_to_srgb and image_info.color_profile_bytes:
-                emb_profile = BytesIO(image_info.color_profile_bytes)
-                im = self._map_im_profile_to_srgb(im, emb_profile)
+                im = self._map_im_profile_to_srgb(
+                    im, image_info.color_profile_bytes,
+                    digest=image_info.color_profile_digest
+                )
         except PyCMSError as err:
             logger.warn('Error converting %r to sRGB: %r', im, err)
 
@@ -277,11 +775,13 @@ class _AbstractJP2Transformer(_AbstractTransformer):
             target_fp=target_fp,
             image_request=image_request,
             image_info=image_info,
-            crop=False
+            crop=False,
+            box=box
         )
 
 
 class OPJ_JP2Transformer(_AbstractJP2Transformer):
+    decoder_name = 'openjpeg'
 
     def __init__(self, config):
         self.opj_decompress = config['opj_decompress']
@@ -305,7 +805,7 @@ class OPJ_JP2Transformer(_AbstractJP2Transformer):
         logger.debug('opj region parameter: %s', arg)
         return arg
 
-    def transform(self, target_fp, image_request, image_info):
+    def _decode(self, image_request, image_info, num_threads=None):
         # opj_decompress command
         region_arg = self._region_to_opj_arg(image_request.region_param(image_info))
         reg = '-d %s' % (region_arg,) if region_arg else ''
@@ -316,13 +816,11 @@ class OPJ_JP2Transformer(_AbstractJP2Transformer):
             tmp_img_fp = os.path.join(tmp, 'image.bmp')
             o = '-o %s' % (tmp_img_fp,)
             opj_cmd = ' '.join((self.opj_decompress,i,reg,red,o))
-            try:
-                self._process(opj_cmd, target_fp, image_request, image_info, tmp_img_fp)
-            except Exception as e:
-                raise TransformException(f'openjpeg transform error: {e}')
+            return self._run_decoder(opj_cmd, tmp_img_fp)
 
 
 class KakaduJP2Transformer(_AbstractJP2Transformer):
+    decoder_name = 'kakadu'
 
     def __init__(self, config):
         self.kdu_expand = config['kdu_expand']
@@ -363,20 +861,99 @@ class KakaduJP2Transformer(_AbstractJP2Transformer):
         logger.debug('kdu region parameter: %s', arg)
         return arg
 
-    def transform(self, target_fp, image_request, image_info):
+    def _decode(self, image_request, image_info, num_threads=None):
         # kdu command
         reduce_arg = self._scales_to_reduce_arg(image_request, image_info)
         red = '-reduce %s' % (reduce_arg,) if reduce_arg else ''
         region_arg = self._region_to_kdu_arg(image_request.region_param(image_info))
         reg = '-region %s' % (region_arg,) if region_arg else ''
         q = '-quiet'
-        t = '-num_threads %s' % self.num_threads
+        t = '-num_threads %s' % (num_threads or self.num_threads)
         i = '-i %s' % image_info.src_img_fp
         with tempfile.TemporaryDirectory(dir=self.tmp_dp) as tmp:
             tmp_img_fp = os.path.join(tmp, 'image.bmp')
             o = '-o %s' % tmp_img_fp
             kdu_cmd = ' '.join((self.kdu_expand,q,i,t,reg,red,o))
-            try:
-                self._process(kdu_cmd, target_fp, image_request, image_info, tmp_img_fp)
-            except Exception as e:
-                raise TransformException(f'kakadu transform error: {e}')
+            return self._run_decoder(kdu_cmd, tmp_img_fp)
+
+
+class PillowJP2Transformer(_AbstractJP2Transformer):
+    '''
+    Decodes JP2s in-process with Pillow's OpenJPEG plugin, so there's no
+    subprocess per request. The image is decoded at the reduced resolution
+    chosen by _scales_to_reduce_arg (which makes the wavelet decode much
+    cheaper), then the region is cropped out; Pillow has no way to decode
+    less than the whole codestream, so a full-resolution region costs as
+    much as the full image. If opj_decompress is configured, those regions
+    are decoded by an OPJ_JP2Transformer instead, which only decodes the
+    tiles the region covers.
+    '''
+    decoder_name = 'pillow jp2'
+
+    def __init__(self, config):
+        self.env = None
+        super().__init__(config)
+        # Number of quality layers to decode; 0 means all of them.
+        self.layers = int(config.get('layers', 0))
+        self.region_transformer = None
+        if config.get('opj_decompress'):
+            self.region_transformer = OPJ_JP2Transformer(config)
+
+    def _region_to_reduced_box(self, region_param, reduce_level, reduced_size):
+        '''
+        Args:
+            region_param (params.RegionParam)
+            reduce_level (int)
+            reduced_size ((int, int))
+
+        Returns ((int, int, int, int)): the region in the coordinates of the
+            reduced image, e.g. (x0, y0, x1, y1)
+        '''
+        scale = 1 << reduce_level
+        x1 = region_param.pixel_x + region_param.pixel_w
+        y1 = region_param.pixel_y + region_param.pixel_h
+        return (
+            region_param.pixel_x // scale,
+            region_param.pixel_y // scale,
+            min(self._scale_dim(x1, scale), reduced_size[0]),
+            min(self._scale_dim(y1, scale), reduced_size[1]),
+        )
+
+    def _pillow_reduce_level(self, size, reduce_level):
+        '''
+        Some versions of Pillow round the reduced size of a JP2 to the
+        nearest pixel, where OpenJPEG rounds up, and fail to decode the
+        image when the two differ. Returns the highest level up to
+        reduce_level at which they agree.
+        '''
+        for level in range(reduce_level, 0, -1):
+            power = 1 << level
+            if all(int((d + (power >> 1)) / power) == self._scale_dim(d, power) for d in size):
+                return level
+        return 0
+
+    def _decode(self, image_request, image_info, num_threads=None):
+        reduce_arg = self._scales_to_reduce_arg(image_request, image_info)
+        region_param = image_request.region_param(image_info)
+
+        if (self.region_transformer is not None and not int(reduce_arg or 0)
+                and (region_param.pixel_w, region_param.pixel_h)
+                    != (image_info.width, image_info.height)):
+            logger.debug('pillow jp2 region at full resolution, using opj_decompress')
+            return self.region_transformer._decode(
+                image_request, image_info, num_threads=num_threads
+            )
+
+        im = Image.open(image_info.src_img_fp)
+        reduce_level = self._pillow_reduce_level(
+            im.size, int(reduce_arg) if reduce_arg else 0
+        )
+        im.reduce = reduce_level
+        im.layers = self.layers
+        im.load()
+        box = self._region_to_reduced_box(region_param, reduce_level, im.size)
+        logger.debug('pillow jp2 reduce: %d, box: %r', reduce_level, box)
+
+        if box != (0, 0) + im.size:
+            im = im.crop(box)
+        return im
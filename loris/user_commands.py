@@ -3,6 +3,9 @@ import os
 import shutil
 from configobj import ConfigObj
 
+from loris.img import AliasIndex, CacheIndex, PackStore
+from loris.img_info import InfoStore
+
 
 CONFIG_FILE_NAME = 'loris.conf'
 CONFIG_DIR_TARGET_DEFAULT = '/etc/loris'
@@ -92,3 +95,74 @@ def create_default_files_and_directories(config=None):
     _write_wsgi(config)
     _copy_index_and_favicon(config)
 
+
+
+def rebuild_image_cache_index(config=None):
+    """Index the images already in the image cache, so it can be kept under
+    [img.ImageCache] quota_bytes.
+    """
+    if not config:
+        config = ConfigObj(_config_file_path(), unrepr=True, interpolation=False)
+    cache_config = config['img.ImageCache']
+    aliases = None
+    if cache_config.get('aliases', 'symlinks') == 'sqlite':
+        aliases = AliasIndex(cache_config['cache_dp'])
+    packs = None
+    if cache_config.get('pack_max_item_bytes', 0):
+        packs = PackStore(cache_config['cache_dp'])
+    index = CacheIndex(
+        cache_config['cache_dp'],
+        quota_bytes=cache_config.get('quota_bytes', 0),
+        policy=cache_config.get('eviction_policy', 'lru'),
+        aliases=aliases,
+        packs=packs
+    )
+    images, links = index.rebuild()
+    print('Indexed %d images and %d symlinks in %s' % (images, links, index.cache_root))
+    removed = index.enforce()
+    while removed:
+        removed = index.enforce()
+
+
+def migrate_image_cache_symlinks(config=None):
+    """Replace the symlinks in the image cache with an alias index, for
+    [img.ImageCache] aliases = 'sqlite'.
+    """
+    if not config:
+        config = ConfigObj(_config_file_path(), unrepr=True, interpolation=False)
+    cache_config = config['img.ImageCache']
+    aliases = AliasIndex(cache_config['cache_dp'])
+    imported, dangling = aliases.import_symlinks()
+    print('Imported %d symlinks, and removed %d dangling symlinks, in %s' % (
+        imported, dangling, aliases.cache_root
+    ))
+    if cache_config.get('quota_bytes', 0):
+        # The quota index still lists the symlinks.
+        rebuild_image_cache_index(config)
+
+
+def compact_image_cache_packs(config=None, min_live_ratio=0.5):
+    """Reclaim the space of images that have been removed from the pack
+    files of the image cache ([img.ImageCache] pack_max_item_bytes).
+    """
+    if not config:
+        config = ConfigObj(_config_file_path(), unrepr=True, interpolation=False)
+    packs = PackStore(config['img.ImageCache']['cache_dp'])
+    segments, reclaimed = packs.compact(min_live_ratio)
+    print('Compacted %d pack segments, reclaiming %d bytes, in %s' % (
+        segments, reclaimed, packs.cache_root
+    ))
+
+
+def migrate_info_cache(config=None):
+    """Import the info.json files of the info cache into an InfoStore, for
+    [img_info.InfoCache] storage = 'sqlite'.
+    """
+    if not config:
+        config = ConfigObj(_config_file_path(), unrepr=True, interpolation=False)
+    cache_config = config['img_info.InfoCache']
+    store = InfoStore(cache_config['cache_dp'], shards=cache_config.get('store_shards', 16))
+    imported, skipped = store.import_tree(cache_config['cache_dp'])
+    print('Imported %d info.json files, and skipped %d, into %s' % (
+        imported, skipped, store.root
+    ))
@@ -1,7 +1,9 @@
 import errno
+import hashlib
 import logging
 import os
 import shutil
+import sqlite3
 import uuid
 
 
@@ -79,3 +81,22 @@ def decode_bytes(data):
         return data.decode('utf8')
     except UnicodeDecodeError:
         return data.decode('latin1')
+
+
+def icc_profile_digest(profile_bytes):
+    """A hex digest that identifies an ICC profile by its contents."""
+    return hashlib.sha256(profile_bytes).hexdigest()
+
+
+def connect_sqlite(db_fp, schema):
+    """A connection to the SQLite database at db_fp, which is made (with
+    schema) if it doesn't exist. It's in WAL mode, so readers don't block
+    the writer, and in autocommit mode.
+    """
+    os.makedirs(os.path.dirname(db_fp), exist_ok=True)
+    conn = sqlite3.connect(
+        db_fp, timeout=30, isolation_level=None, check_same_thread=False
+    )
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(schema)
+    return conn
@@ -4,8 +4,10 @@ webapp.py
 =========
 Implements IIIF 2.0 <http://iiif.io/api/image/2.0/> level 2
 '''
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from decimal import getcontext
+from io import BytesIO
 import logging
 from logging.handlers import RotatingFileHandler
 import os
@@ -13,6 +15,7 @@ from os import path, unlink
 import re
 from subprocess import CalledProcessError
 from tempfile import NamedTemporaryFile
+from threading import Lock
 from urllib.parse import unquote
 
 import sys
@@ -20,14 +23,15 @@ sys.path.append('.')
 
 from configobj import ConfigObj
 from PIL import Image
-from werkzeug.http import parse_date, http_date
+from werkzeug.http import parse_date, http_date, quote_etag
 
 from werkzeug.wrappers import (
     Request, Response, BaseResponse, CommonResponseDescriptorsMixin
 )
+from werkzeug.wsgi import wrap_file
 
 from loris import constants, img, transforms
-from loris.img_info import InfoCache
+from loris.img_info import InfoCache, SharedInfoTier
 from loris.loris_exception import (
     ConfigError,
     ImageInfoException,
@@ -65,6 +69,8 @@ def get_debug_config(debug_jp2_transformer):
     if debug_jp2_transformer == 'opj':
         config['transforms']['jp2']['impl'] = 'OPJ_JP2Transformer'
         config['transforms']['jp2']['opj_decompress'] = '/usr/bin/opj_decompress'
+    elif debug_jp2_transformer == 'pillow':
+        config['transforms']['jp2']['impl'] = 'PillowJP2Transformer'
     elif debug_jp2_transformer == 'kdu':
         from loris.transforms import KakaduJP2Transformer
         config['transforms']['jp2']['impl'] = 'KakaduJP2Transformer'
@@ -371,17 +377,51 @@ class Loris:
         self.resolver = self._load_resolver()
         self.authorizer = self._load_authorizer()
         self.max_size_above_full = _loris_config.get('max_size_above_full', 200)
+        self.prerender_sizes_max = _loris_config.get('prerender_sizes_max', 0)
+        self.prerender_sizes_on_info = _loris_config.get('prerender_sizes_on_info', False)
+        # Sizes rendered for info requests, off the request thread.
+        self._prerender_executor = None
+        self._prerender_pid = None
+        self._prerender_pending = set()
+        self._prerender_lock = Lock()
+        self.derive_from_cache = _loris_config.get('derive_from_cache', False)
+        self.in_memory_max_bytes = _loris_config.get('in_memory_max_bytes', 4194304)
+        self.coalesce_renders = _loris_config.get('coalesce_renders', True)
 
         if self.enable_caching:
-            self.info_cache = InfoCache(self.app_configs['img_info.InfoCache']['cache_dp'])
-            cache_dp = self.app_configs['img.ImageCache']['cache_dp']
-            self.img_cache = img.ImageCache(cache_dp)
+            _info_cache_config = self.app_configs['img_info.InfoCache']
+            shared_info = None
+            if _info_cache_config.get('shared_fp'):
+                shared_info = SharedInfoTier(
+                    _info_cache_config['shared_fp'],
+                    slots=_info_cache_config.get('shared_slots', 16384),
+                    slot_bytes=_info_cache_config.get('shared_slot_bytes', 4096)
+                )
+            self.info_cache = InfoCache(
+                _info_cache_config['cache_dp'],
+                shared=shared_info,
+                verify_source_interval=_info_cache_config.get('verify_source_interval', 0),
+                storage=_info_cache_config.get('storage', 'files'),
+                store_shards=_info_cache_config.get('store_shards', 16)
+            )
+            _img_cache_config = self.app_configs['img.ImageCache']
+            self.img_cache = img.ImageCache(
+                _img_cache_config['cache_dp'],
+                memory_max_bytes=_img_cache_config.get('memory_max_bytes', 0),
+                memory_max_item_bytes=_img_cache_config.get('memory_max_item_bytes', 262144),
+                quota_bytes=_img_cache_config.get('quota_bytes', 0),
+                eviction_policy=_img_cache_config.get('eviction_policy', 'lru'),
+                aliases=_img_cache_config.get('aliases', 'symlinks'),
+                pack_max_item_bytes=_img_cache_config.get('pack_max_item_bytes', 0),
+                pack_segment_bytes=_img_cache_config.get('pack_segment_bytes', 67108864)
+            )
 
     def _load_transformers(self):
         tforms = self.app_configs['transforms']
-        source_formats = [k for k in tforms if isinstance(tforms[k], dict)]
+        # [[encoders]] is the only subsection that isn't a source format
+        source_formats = [k for k in tforms if isinstance(tforms[k], dict) and k != 'encoders']
         self.logger.debug('Source formats: %r', source_formats)
-        global_transform_options = dict((k, v) for k, v in tforms.items() if not isinstance(v, dict))
+        global_transform_options = dict((k, v) for k, v in tforms.items() if k not in source_formats)
         self.logger.debug('Global transform options: %r', global_transform_options)
 
         pil_max_image_pixels = tforms.get('pil_max_image_pixels', Image.MAX_IMAGE_PIXELS)
@@ -451,7 +491,7 @@ class Loris:
         base_uri = loris_request.base_uri
 
         if request_type == 'redirect_info':
-            if not self.resolver.is_resolvable(ident):
+            if not self.resolver.check_resolvable(ident):
                 msg = "could not resolve identifier: %s " % (ident)
                 return NotFoundResponse(msg)
 
@@ -524,37 +564,55 @@ class Loris:
         r.set_acao(request, self.cors_regex)
         ims_hdr = request.headers.get('If-Modified-Since')
         ims = parse_date(ims_hdr)
+        inm = request.if_none_match if 'If-None-Match' in request.headers else None
         last_mod = parse_date(http_date(last_mod)) # see note under get_img
 
         if self.authorizer and self.authorizer.is_protected(info):
             authed = self.authorizer.is_authorized(info, request)
             if authed['status'] == 'deny':
                 r.status_code = 401
-                # trash If-Mod-Since to ensure no 304
+                # trash If-Mod-Since and If-None-Match to ensure no 304
                 ims = None
+                inm = None
             elif authed['status'] == 'redirect':
                 r.status_code = 302
                 r.location = authed['location']
             # Otherwise we're okay
 
-        if ims and ims >= last_mod:
+        callback = request.args.get('callback', None)
+        if request.headers.get('accept') == 'application/ld+json' and not callback:
+            content_type = 'application/ld+json'
+        else:
+            content_type = 'application/json'
+        body, etag = info.iiif_json_and_etag(base_uri, content_type)
+        if callback:
+            # The body depends on the callback, so it isn't tagged.
+            etag = None
+            inm = None
+
+        # If-None-Match takes precedence over If-Modified-Since (RFC 7232).
+        if inm is not None:
+            not_modified = inm.contains_weak(etag)
+        else:
+            not_modified = bool(ims and ims >= last_mod)
+
+        if etag:
+            r.headers['ETag'] = quote_etag(etag)
+        if not_modified:
             self.logger.debug('Sent 304 for %s ', ident)
             r.status_code = 304
         else:
             if last_mod:
                 r.last_modified = last_mod
-            callback = request.args.get('callback', None)
             if callback:
                 r.mimetype = 'application/javascript'
-                r.data = '%s(%s);' % (callback, info.to_iiif_json(base_uri))
+                r.data = b'%s(%s);' % (callback.encode('utf8'), body)
             else:
-                if request.headers.get('accept') == 'application/ld+json':
-                    r.content_type = 'application/ld+json'
-                else:
-                    r.content_type = 'application/json'
+                r.content_type = content_type
+                if content_type == 'application/json':
                     l = '<http://iiif.io/api/image/2/context.json>;rel="http://www.w3.org/ns/json-ld#context";type="application/ld+json"'
                     r.headers['Link'] = '%s,%s' % (r.headers['Link'], l)
-                r.data = info.to_iiif_json(base_uri)
+                r.data = body
         return r
 
     def _get_info(self,ident,request,base_uri):
@@ -566,7 +624,7 @@ class Loris:
                 pass
 
         #otherwise construct it
-        info = self.resolver.resolve(self, ident, base_uri)
+        info = self.resolver.check_and_resolve(self, ident, base_uri)
 
         # Maybe inject services before caching
         if self.authorizer and self.authorizer.is_protected(info):
@@ -580,6 +638,8 @@ class Loris:
             self.info_cache[ident] = info
             # pick up the timestamp... :()
             info,last_mod = self.info_cache[ident]
+            if self.prerender_sizes_max and self.prerender_sizes_on_info:
+                self._prerender_sizes_in_background(ident, info)
         else:
             last_mod = None
 
@@ -618,10 +678,9 @@ class Loris:
 
         self.logger.debug('Image Request Path: %s', image_request.request_path)
 
+        in_memory = None
         if self.enable_caching:
-            in_cache = image_request in self.img_cache
-        else:
-            in_cache = False
+            in_memory = self.img_cache.get_from_memory(image_request)
 
         try:
             # We need the info to check authorization,
@@ -642,26 +701,54 @@ class Loris:
 
         set_content_disposition_header(image_request=image_request, response=r)
 
-        if in_cache:
-            fp, img_last_mod = self.img_cache[image_request]
+        # An open file descriptor and its stat if the image is cached on disk
+        cached = None
+        if self.enable_caching and in_memory is None:
+            cached = self.img_cache.open(image_request)
+            if cached is None:
+                # Small images may be in a pack file instead.
+                in_memory = self.img_cache.get_from_packs(image_request)
+
+        if in_memory or cached:
+            if in_memory:
+                data, img_last_mod, _ = in_memory
+            else:
+                fd, stat_result = cached
+                # The stamp from the FS needs to be rounded using the same
+                # precision as when went sent it, so for an accurate
+                # comparison turn it into an http date and then parse it
+                # again :-( :
+                img_last_mod = parse_date(http_date(
+                    datetime.utcfromtimestamp(stat_result.st_mtime)
+                ))
             ims_hdr = request.headers.get('If-Modified-Since')
-            # The stamp from the FS needs to be rounded using the same precision
-            # as when went sent it, so for an accurate comparison turn it into
-            # an http date and then parse it again :-( :
-            img_last_mod = parse_date(http_date(img_last_mod))
             self.logger.debug("Time from FS (default, rounded): %s", img_last_mod)
             self.logger.debug("Time from IMS Header (parsed): %s", parse_date(ims_hdr))
             # ims_hdr = parse_date(ims_hdr) # catch parsing errors?
             if ims_hdr and parse_date(ims_hdr) >= img_last_mod:
-                self.logger.debug('Sent 304 for %s ', fp)
+                self.logger.debug('Sent 304 for %s ', image_request.request_path)
+                if cached:
+                    os.close(fd)
                 r.status_code = 304
                 return r
             else:
                 r.content_type = constants.FORMATS_BY_EXTENSION[target_fmt]
                 r.status_code = 200
                 r.last_modified = img_last_mod
-                r.headers['Content-Length'] = path.getsize(fp)
-                r.response = open(fp, 'rb')
+                if not in_memory:
+                    f = os.fdopen(fd, 'rb')
+                    data = self.img_cache.add_to_memory(
+                        image_request, f, stat_result.st_size, img_last_mod,
+                        r.content_type
+                    )
+                if data is not None:
+                    if cached:
+                        f.close()
+                    r.set_data(data)
+                else:
+                    r.headers['Content-Length'] = stat_result.st_size
+                    r.response = wrap_file(request.environ, f)
+                    r.direct_passthrough = True
 
                 # hand the Image object its info
                 info = self._get_info(ident, request, base_uri)[0]
@@ -694,11 +781,19 @@ class Loris:
                         r.status_code = 301
                         return r
 
-                # Make an image
-                fp = self._make_image(
-                    image_request=image_request,
-                    image_info=info
-                )
+                # Make an image, along with the other advertised sizes if
+                # this is one of them
+                fp = None
+                if self._should_prerender_sizes(image_request, info):
+                    self._prerender_sizes(
+                        ident, info, image_request.quality, image_request.format
+                    )
+                    fp = (self.img_cache.get(image_request) or (None,))[0]
+                if fp is None:
+                    fp = self._make_image(
+                        image_request=image_request,
+                        image_info=info
+                    )
 
             except TransformException as te:
                 self.logger.error(f'{ident} transform exception: {te}')
@@ -715,31 +810,222 @@ possible that there was a problem with the source file
                 return ServerSideErrorResponse(msg)
         r.content_type = constants.FORMATS_BY_EXTENSION[target_fmt]
         r.status_code = 200
-        r.last_modified = datetime.utcfromtimestamp(path.getctime(fp))
-        r.headers['Content-Length'] = path.getsize(fp)
         self._set_canonical_link(
             request=request,
             response=r,
             image_request=image_request,
             image_info=info
         )
-        r.response = open(fp, 'rb')
+        if isinstance(fp, bytes):
+            # Made in memory; this also sets the Content-Length.
+            r.last_modified = datetime.utcnow()
+            r.set_data(fp)
+            return r
+
+        if self.enable_caching and self.img_cache.packs is not None and not path.exists(fp):
+            packed = self.img_cache.get_from_packs(image_request)
+            if packed is not None:
+                data, r.last_modified, _ = packed
+                r.set_data(data)
+                return r
 
-        if not self.enable_caching:
+        f = open(fp, 'rb')
+        stat_result = os.fstat(f.fileno())
+        r.last_modified = datetime.utcfromtimestamp(stat_result.st_ctime)
+        if self.enable_caching:
+            data = self.img_cache.add_to_memory(
+                image_request, f, stat_result.st_size, r.last_modified,
+                r.content_type
+            )
+            if data is not None:
+                f.close()
+                r.set_data(data)
+                return r
+
+        r.headers['Content-Length'] = stat_result.st_size
+        r.response = wrap_file(request.environ, f)
+
+        if self.enable_caching:
+            # Lets the server send the file with e.g. sendfile(2); but then
+            # the response's on close callbacks aren't called.
+            r.direct_passthrough = True
+        else:
             r.call_on_close(lambda: unlink(fp))
 
         return r
 
+    def _prerender_sizes_list(self, image_info):
+        return [
+            size for size in (image_info.sizes or [])
+            if max(size['width'], size['height']) <= self.prerender_sizes_max
+        ]
+
+    def _should_prerender_sizes(self, image_request, image_info):
+        '''True if the request is for one of the advertised sizes that we
+        render together.
+        '''
+        if not (self.enable_caching and self.prerender_sizes_max):
+            return False
+        if image_request.region_value != 'full' or image_request.rotation_value != '0':
+            return False
+        return any(
+            image_request.size_value == '%d,' % size['width']
+            for size in self._prerender_sizes_list(image_info)
+        )
+
+    def _prerender_sizes(self, ident, image_info, quality='default', fmt='jpg'):
+        '''Render every advertised size up to prerender_sizes_max that isn't
+        cached yet from a single decode of the source, and put them in the
+        image cache.
+
+        Failures are logged rather than raised; the requested image will
+        still be made on its own.
+
+        Returns:
+            ([ImageRequest]) the requests that were rendered
+        '''
+        image_requests = [
+            img.ImageRequest(ident, 'full', '%d,' % size['width'], '0', quality, fmt)
+            for size in self._prerender_sizes_list(image_info)
+        ]
+        image_requests = [r for r in image_requests if r not in self.img_cache]
+        if not image_requests:
+            return []
+
+        if self.coalesce_renders:
+            lock_key = path.join(ident, 'sizes', '%s.%s' % (quality, fmt))
+            with self.img_cache.render_locks.hold(lock_key):
+                # Another request may have rendered them while we waited.
+                image_requests = [r for r in image_requests if r not in self.img_cache]
+                return self._render_sizes(ident, image_info, image_requests, fmt)
+        return self._render_sizes(ident, image_info, image_requests, fmt)
+
+    def _prerender_sizes_in_background(self, ident, image_info):
+        '''Run _prerender_sizes in a background thread, so the info request
+        that asked for it isn't held up. Renders run one at a time, and an
+        identifier that is already waiting isn't queued again.
+
+        Returns:
+            (Future) or None if ident was already waiting.
+        '''
+        with self._prerender_lock:
+            # Threads don't survive a fork, so each process starts its own.
+            if self._prerender_executor is None or self._prerender_pid != os.getpid():
+                self._prerender_executor = ThreadPoolExecutor(max_workers=1)
+                self._prerender_pid = os.getpid()
+                self._prerender_pending = set()
+            if ident in self._prerender_pending:
+                return None
+            self._prerender_pending.add(ident)
+            executor = self._prerender_executor
+        future = executor.submit(self._prerender_sizes, ident, image_info)
+        future.add_done_callback(lambda f: self._prerender_done(ident, f))
+        return future
+
+    def _prerender_done(self, ident, future):
+        with self._prerender_lock:
+            self._prerender_pending.discard(ident)
+        if future.exception() is not None:
+            self.logger.warning(
+                'error rendering sizes of %s: %s', ident, future.exception()
+            )
+
+    def _render_sizes(self, ident, image_info, image_requests, fmt):
+        if not image_requests:
+            return []
+
+        targets = []
+        for image_request in image_requests:
+            temp_file = NamedTemporaryFile(
+                dir=self.tmp_dp,
+                suffix='.%s' % fmt,
+                delete=False
+            )
+            temp_file.close()
+            targets.append((temp_file.name, image_request))
+
+        try:
+            transformer = self.transformers[image_info.src_format]
+            transformer.transform_sizes(targets, image_info)
+            for temp_fp, image_request in targets:
+                self.img_cache.upsert(
+                    image_request=image_request,
+                    temp_fp=temp_fp,
+                    image_info=image_info
+                )
+        except Exception as e:
+            self.logger.warning('error rendering sizes of %s: %s', ident, e)
+            for temp_fp, _ in targets:
+                if path.exists(temp_fp):
+                    unlink(temp_fp)
+            return []
+
+        self.logger.debug(
+            'Rendered %d sizes of %s from one decode', len(targets), ident
+        )
+        return image_requests
+
+    def _make_image_in_memory(self, image_request, image_info):
+        '''Encode the image into memory rather than a temporary file.
+
+        Images bigger than in_memory_max_bytes are still written out to a
+        temporary file, so we don't hold on to big buffers while they're
+        sent to slow clients.
+
+        Returns:
+            (bytes) the image, or (str) the path of a temporary file
+        '''
+        buf = BytesIO()
+        transformer = self.transformers[image_info.src_format]
+        transformer.transform(
+            target_fp=buf,
+            image_request=image_request,
+            image_info=image_info
+        )
+        derivative_size = buf.tell()
+        if derivative_size < 1:
+            self.logger.error('empty derivative created for %s' % image_info.src_img_fp)
+            raise TransformException()
+        if derivative_size <= self.in_memory_max_bytes:
+            return buf.getvalue()
+
+        with NamedTemporaryFile(
+            dir=self.tmp_dp,
+            suffix='.%s' % image_request.format,
+            delete=False
+        ) as temp_file:
+            temp_file.write(buf.getbuffer())
+        return temp_file.name
+
     def _make_image(self, image_request, image_info):
         """Call the appropriate transformer to create the image.
 
+        With coalesce_renders, identical requests made at the same time (in
+        any thread or worker process) wait for the first one to make the
+        image, rather than all making it.
+
         Args:
             image_request (ImageRequest)
             image_info (ImageInfo)
         Returns:
-            (str) the file path of the new image
+            (str) the file path of the new image, or (bytes) the image
+            itself if caching is disabled and it's no bigger than
+            in_memory_max_bytes.
 
         """
+        if not self.enable_caching and self.in_memory_max_bytes:
+            return self._make_image_in_memory(image_request, image_info)
+
+        if self.enable_caching and self.coalesce_renders:
+            with self.img_cache.render_lock(image_request, image_info) as cached_fp:
+                if cached_fp:
+                    self.logger.debug('%s was made while we waited', image_request.request_path)
+                    return cached_fp
+                return self._make_image_file(image_request, image_info)
+
+        return self._make_image_file(image_request, image_info)
+
+    def _make_image_file(self, image_request, image_info):
         temp_file = NamedTemporaryFile(
             dir=self.tmp_dp,
             suffix='.%s' % image_request.format,
@@ -747,13 +1033,31 @@ possible that there was a problem with the source file
         )
         temp_fp = temp_file.name
 
+        source_fp = None
+        if self.enable_caching and self.derive_from_cache:
+            source_fp = self.img_cache.derivation_source(image_request, image_info)
+
         try:
             transformer = self.transformers[image_info.src_format]
-            transformer.transform(
-                target_fp=temp_fp,
-                image_request=image_request,
-                image_info=image_info
-            )
+            if source_fp:
+                self.logger.debug('Deriving %s from cached %s', image_request.request_path, source_fp)
+                try:
+                    transformer.transform_from_derivative(
+                        source_fp=source_fp,
+                        target_fp=temp_fp,
+                        image_request=image_request,
+                        image_info=image_info
+                    )
+                except Exception as e:
+                    # e.g. the derivative was removed from the cache
+                    self.logger.warning('error deriving from %s: %s', source_fp, e)
+                    source_fp = None
+            if not source_fp:
+                transformer.transform(
+                    target_fp=temp_fp,
+                    image_request=image_request,
+                    image_info=image_info
+                )
             derivative_size = os.stat(temp_fp).st_size
             if derivative_size < 1:
                 self.logger.error('empty derivative file created for %s' % image_info.src_img_fp)
@@ -766,7 +1070,8 @@ possible that there was a problem with the source file
             canonical_cache_fp = self.img_cache.upsert(
                 image_request=image_request,
                 temp_fp=temp_fp,
-                image_info=image_info
+                image_info=image_info,
+                generation=1 if source_fp else 0
             )
             return canonical_cache_fp
         else:
@@ -0,0 +1,100 @@
+# Count the file system calls made for an image cache hit, comparing the
+# old lookup (__contains__, __getitem__, getsize, then open) with
+# ImageCache.open's single open + fstat, and for a whole cached request made
+# with the werkzeug test client.
+#
+# strace isn't always available, so the calls are counted by wrapping the
+# os functions they're made through. A Python open() is counted as one call;
+# it also makes an fstat and an lseek of its own.
+#
+# Usage (from the repository root): PYTHONPATH=. python misc/cache_hit_syscalls.py
+import builtins
+from collections import Counter
+import logging
+import os
+from os import path
+import tempfile
+import timeit
+
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from loris import img
+from loris.webapp import get_debug_config, Loris
+
+IDENT = '01%2F03%2F0001.jpg'
+# A non-canonical request, so lookups go through the cache symlink.
+REQUEST_PATH = '/%s/full/!300,300/0/default.jpg' % IDENT
+NUMBER = 1000
+
+calls = Counter()
+counting = False
+
+
+def counted(name, function):
+    def wrapper(*args, **kwargs):
+        if counting:
+            calls[name] += 1
+        return function(*args, **kwargs)
+    return wrapper
+
+
+for name in ('stat', 'lstat', 'fstat', 'open', 'readlink'):
+    setattr(os, name, counted('os.' + name, getattr(os, name)))
+builtins.open = counted('open()', builtins.open)
+
+
+def count(function):
+    global counting
+    calls.clear()
+    counting = True
+    try:
+        function()
+    finally:
+        counting = False
+    return dict(calls), sum(calls.values())
+
+
+def old_lookup(cache, image_request):
+    if image_request in cache:
+        fp, _ = cache[image_request]
+        path.getsize(fp)
+        open(fp, 'rb').close()
+
+
+def new_lookup(cache, image_request):
+    fd, _ = cache.open(image_request)
+    os.close(fd)
+
+
+def cached_request(client):
+    with client.get(REQUEST_PATH) as resp:
+        resp.data
+
+
+with tempfile.TemporaryDirectory() as tmp:
+    config = get_debug_config('pillow')
+    config['logging']['log_level'] = 'WARNING'
+    config['loris.Loris']['tmp_dp'] = path.join(tmp, 'tmp')
+    config['img.ImageCache']['cache_dp'] = path.join(tmp, 'img')
+    config['img_info.InfoCache']['cache_dp'] = path.join(tmp, 'info')
+    logging.disable(logging.WARNING)
+    app = Loris(config)
+    client = Client(app, BaseResponse)
+    cached_request(client)
+
+    cache = app.img_cache
+    image_request = img.ImageRequest(IDENT, 'full', '!300,300', '0', 'default', 'jpg')
+    cases = (
+        ('lookup, before', lambda: old_lookup(cache, image_request)),
+        ('lookup, after', lambda: new_lookup(cache, image_request)),
+        ('whole request, after', lambda: cached_request(client)),
+    )
+    print('%s (%d path components)' % (
+        cache.get_request_cache_path(image_request),
+        len(cache.get_request_cache_path(image_request).split(os.sep)) - 1
+    ))
+    for name, function in cases:
+        by_function, total = count(function)
+        seconds = timeit.timeit(function, number=NUMBER) / NUMBER
+        print('%-22s %3d calls, %0.1fus  %r' % (name, total, seconds * 1e6, by_function))
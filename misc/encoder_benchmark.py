@@ -0,0 +1,45 @@
+# Report encode time and output bytes for a set of encoder profiles (the
+# Pillow save() options in [transforms][[encoders]]) at a few output sizes.
+#
+# Usage (from the repository root): PYTHONPATH=. python misc/encoder_benchmark.py [image]
+from io import BytesIO
+import sys
+import timeit
+
+from PIL import Image
+
+from loris.transforms import PIL_FORMATS
+
+IMAGE_FP = sys.argv[1] if len(sys.argv) > 1 else 'tests/img/01/03/0001.jpg'
+WIDTHS = (256, 1024, 3000)
+NUMBER = 3
+
+PROFILES = (
+    ('jpg', {'quality': 90}),
+    ('jpg', {'quality': 90, 'optimize': True}),
+    ('jpg', {'quality': 90, 'progressive': True}),
+    ('jpg', {'quality': 85, 'subsampling': '4:2:0'}),
+    ('jpg', {'quality': 90, 'subsampling': '4:4:4'}),
+    ('png', {'optimize': True, 'bits': 256}),
+    ('png', {'compress_level': 1}),
+    ('png', {'compress_level': 3}),
+    ('png', {'compress_level': 6}),
+    ('webp', {'quality': 90}),
+    ('webp', {'quality': 90, 'method': 0}),
+    ('webp', {'quality': 90, 'method': 2}),
+    ('webp', {'quality': 90, 'method': 6}),
+)
+
+source = Image.open(IMAGE_FP).convert('RGB')
+for width in WIDTHS:
+    height = round(source.height * width / source.width)
+    im = source.resize((width, height), Image.LANCZOS)
+    print('%dx%d (%d pixels)' % (width, height, width * height))
+    for fmt, options in PROFILES:
+        def encode():
+            buf = BytesIO()
+            im.save(buf, format=PIL_FORMATS[fmt], **options)
+            return buf
+        size = len(encode().getvalue())
+        t = timeit.timeit(encode, number=NUMBER) / NUMBER
+        print('  %-5s %-55r %8.4fs %10d bytes' % (fmt, options, t, size))
@@ -0,0 +1,56 @@
+# Time each geometry fast path in _AbstractTransformer._derive_with_pil
+# against the separate operations it replaces, on a decoded test image.
+#
+# Usage (from the repository root): PYTHONPATH=. python misc/geometry_benchmark.py
+import timeit
+
+from PIL import Image
+from PIL.ImageOps import mirror
+
+IMAGE_FP = 'tests/img/01/03/0001.jpg'
+BOX = (100, 200, 2100, 1700)
+SIZE = (800, 600)
+NUMBER = 10
+
+im = Image.open(IMAGE_FP)
+im.load()
+
+CASES = (
+    (
+        'crop + resize',
+        lambda: im.crop(BOX).resize(SIZE, resample=Image.LANCZOS),
+        lambda: im.resize(SIZE, resample=Image.LANCZOS, box=BOX),
+    ),
+    (
+        'crop + resize (reducing_gap=3)',
+        lambda: im.crop(BOX).resize(SIZE, resample=Image.LANCZOS),
+        lambda: im.resize(SIZE, resample=Image.LANCZOS, box=BOX, reducing_gap=3),
+    ),
+    (
+        'rotate 90',
+        lambda: im.rotate(-90, expand=True),
+        lambda: im.transpose(Image.ROTATE_270),
+    ),
+    (
+        'mirror + rotate 90',
+        lambda: mirror(im).rotate(-90, expand=True),
+        lambda: im.transpose(Image.TRANSVERSE),
+    ),
+    (
+        'resize + gray',
+        lambda: im.resize(SIZE, resample=Image.LANCZOS).convert('L'),
+        lambda: im.convert('L').resize(SIZE, resample=Image.LANCZOS),
+    ),
+    (
+        'resize + bitonal',
+        lambda: im.resize(SIZE, resample=Image.LANCZOS).convert('1'),
+        lambda: im.convert('L').resize(SIZE, resample=Image.LANCZOS).convert('1'),
+    ),
+)
+
+print('%s, %dx%d' % (IMAGE_FP, im.width, im.height))
+for name, before, after in CASES:
+    t_before = timeit.timeit(before, number=NUMBER) / NUMBER
+    t_after = timeit.timeit(after, number=NUMBER) / NUMBER
+    print('%-32s before %0.4fs, after %0.4fs (%0.1fx)' % (
+        name, t_before, t_after, t_before / t_after))
@@ -0,0 +1,76 @@
+# Time InfoCache lookups made by many worker processes at once, with each
+# worker's in-memory cache turned off (size=0), so every lookup either reads
+# and parses info.json or is answered from the SharedInfoTier. Then time
+# lookups from a single process with each storage engine.
+#
+# Usage (from the repository root): PYTHONPATH=. python misc/info_cache_benchmark.py
+from multiprocessing import Pool
+from os import path
+import tempfile
+import time
+
+from loris.img_info import ImageInfo, InfoCache, Profile, SharedInfoTier
+
+WORKERS = 32
+IDENTS = 2000
+LOOKUPS = 2000
+
+
+def make_info(src_img_fp):
+    info = ImageInfo(src_img_fp=src_img_fp, src_format='jp2')
+    info.width, info.height = 5906, 7200
+    info.tiles = [{'width': 256, 'scaleFactors': [1, 2, 4, 8, 16, 32]}]
+    info.sizes = [
+        {'width': 185, 'height': 225}, {'width': 370, 'height': 450},
+        {'width': 739, 'height': 900}, {'width': 1477, 'height': 1800},
+    ]
+    info.profile = Profile(
+        'http://iiif.io/api/image/2/level2.json',
+        {
+            'formats': ['jpg', 'png', 'gif', 'webp'],
+            'qualities': ['default', 'bitonal', 'gray', 'color'],
+            'supports': ['canonicalLinkHeader', 'profileLinkHeader',
+                'mirroring', 'rotationArbitrary', 'sizeAboveFull'],
+        }
+    )
+    info.color_profile_bytes = None
+    return info
+
+
+def worker(args):
+    root, shared_fp, worker_id, storage = args
+    shared = SharedInfoTier(shared_fp) if shared_fp else None
+    cache = InfoCache(root, size=0, shared=shared, storage=storage)
+    start = time.perf_counter()
+    for i in range(LOOKUPS):
+        cache.get('ident-%d' % ((i * 7 + worker_id * 13) % IDENTS))
+    return (time.perf_counter() - start) / LOOKUPS
+
+
+def run(root, shared_fp):
+    with Pool(WORKERS) as pool:
+        per_lookup = pool.map(worker, [(root, shared_fp, i, 'files') for i in range(WORKERS)])
+    per_lookup.sort()
+    return per_lookup[len(per_lookup) // 2], per_lookup[-1]
+
+
+with tempfile.TemporaryDirectory() as tmp:
+    shared_fp = path.join(tmp, 'shared')
+    cache = InfoCache(path.join(tmp, 'info'), size=0, shared=SharedInfoTier(shared_fp))
+    for i in range(IDENTS):
+        cache['ident-%d' % i] = make_info(__file__)
+
+    print('%d workers, %d lookups each over %d identifiers' % (WORKERS, LOOKUPS, IDENTS))
+    for name, fp in (('info.json', None), ('shared tier', shared_fp)):
+        median, worst = run(path.join(tmp, 'info'), fp)
+        print('%-12s median worker %6.1fus/lookup, slowest %6.1fus/lookup' % (
+            name, median * 1e6, worst * 1e6
+        ))
+
+    root = path.join(tmp, 'store')
+    cache = InfoCache(root, size=0, storage='sqlite')
+    for i in range(IDENTS):
+        cache['ident-%d' % i] = make_info(__file__)
+    print('\nOne process, %d lookups over %d identifiers' % (LOOKUPS, IDENTS))
+    for storage, fp in (('files', path.join(tmp, 'info')), ('sqlite', root)):
+        print('%-12s %6.1fus/lookup' % (storage, worker((fp, None, 0, storage)) * 1e6))
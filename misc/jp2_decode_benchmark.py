@@ -0,0 +1,41 @@
+# Compare decoding JP2s to a temporary BMP file vs. streaming the decoder's
+# output through a named pipe (`stream_decoder_output` in [[jp2]]).
+#
+# Usage (from the repository root): PYTHONPATH=. python misc/jp2_decode_benchmark.py [kdu|opj] [path/to/image.jp2]
+import os
+import sys
+import timeit
+
+from loris.img import ImageRequest
+from loris.webapp import Loris, get_debug_config
+
+JP2_TRANSFORMER = sys.argv[1] if len(sys.argv) > 1 else 'opj'
+IDENT = sys.argv[2] if len(sys.argv) > 2 else '01/02/gray.jp2'
+REQUESTS = (
+    ('full', '1000,'),
+    ('0,0,2048,2048', '512,'),
+)
+NUMBER = 10
+
+
+def make_app(stream):
+    config = get_debug_config(JP2_TRANSFORMER)
+    config['logging']['log_level'] = 'WARNING'
+    config['loris.Loris']['enable_caching'] = False
+    config['transforms']['jp2']['stream_decoder_output'] = stream
+    return Loris(config)
+
+
+for stream in (False, True):
+    app = make_app(stream)
+    info = app.resolver.resolve(app, IDENT, '')
+    for region, size in REQUESTS:
+        image_request = ImageRequest(IDENT, region, size, '0', 'default', 'jpg')
+
+        def run():
+            fp = app._make_image(image_request=image_request, image_info=info)
+            os.unlink(fp)
+
+        t = timeit.timeit(run, number=NUMBER)
+        print('stream_decoder_output=%-5s %-14s %-6s %0.4fs/request' % (
+            stream, region, size, t / NUMBER))
@@ -0,0 +1,52 @@
+# Time the tiles a deep-zoom viewer asks for with the OPJ_JP2Transformer,
+# which runs opj_decompress for every tile, and with the in-process
+# PillowJP2Transformer. Pillow decodes every codestream tile for every
+# request, so at scale 1 it alone is usually far slower than opj_decompress,
+# which only decodes the tiles the region covers; 'pillow+opj' decodes those
+# full-resolution regions with opj_decompress.
+#
+# Usage (from the repository root): PYTHONPATH=. python misc/jp2_tiles_per_second.py [path/to/image.jp2]
+import os
+import sys
+import time
+
+from loris.img import ImageRequest
+from loris.webapp import Loris, get_debug_config
+
+IDENT = sys.argv[1] if len(sys.argv) > 1 else '01/02/gray.jp2'
+TILE_SIZE = 512
+
+
+def make_app(jp2_transformer):
+    config = get_debug_config(jp2_transformer.split('+')[0])
+    if jp2_transformer == 'pillow+opj':
+        config['transforms']['jp2']['opj_decompress'] = '/usr/bin/opj_decompress'
+    config['logging']['log_level'] = 'WARNING'
+    config['loris.Loris']['enable_caching'] = False
+    return Loris(config)
+
+
+def tile_requests(info, scale):
+    # The tiles a deep-zoom viewer would ask for at one scale factor.
+    step = TILE_SIZE * scale
+    for y in range(0, info.height, step):
+        for x in range(0, info.width, step):
+            w = min(step, info.width - x)
+            h = min(step, info.height - y)
+            region = '%d,%d,%d,%d' % (x, y, w, h)
+            size = '%d,' % ((w + scale - 1) // scale)
+            yield ImageRequest(IDENT, region, size, '0', 'default', 'jpg')
+
+
+for jp2_transformer in ('opj', 'pillow', 'pillow+opj'):
+    app = make_app(jp2_transformer)
+    info = app.resolver.resolve(app, IDENT, '')
+    for scale in (1, 4):
+        requests = list(tile_requests(info, scale))
+        start = time.time()
+        for image_request in requests:
+            fp = app._make_image(image_request=image_request, image_info=info)
+            os.unlink(fp)
+        elapsed = time.time() - start
+        print('%-10s scale %d: %d tiles, %0.1f tiles/s' % (
+            jp2_transformer, scale, len(requests), len(requests) / elapsed))
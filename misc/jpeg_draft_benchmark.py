@@ -0,0 +1,39 @@
+# Time JPEG thumbnail and pct: requests with and without DCT draft-mode
+# scaling (`jpeg_draft_mode` in [[jpg]]), through the test client as in
+# tests/transforms_t.py.
+#
+# Usage (from the repository root): PYTHONPATH=. python misc/jpeg_draft_benchmark.py
+import timeit
+
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from loris.webapp import Loris, get_debug_config
+
+IDENT = '01%2F03%2F0001.jpg'
+REQUEST_PATHS = (
+    '/%s/full/150,/0/default.jpg' % IDENT,
+    '/%s/full/!400,400/0/default.jpg' % IDENT,
+    '/%s/full/pct:25/0/default.jpg' % IDENT,
+    '/%s/full/pct:50/0/default.jpg' % IDENT,
+    '/%s/0,0,2048,2048/256,/0/default.jpg' % IDENT,
+)
+NUMBER = 10
+
+
+def make_client(jpeg_draft_mode):
+    config = get_debug_config('kdu')
+    config['logging']['log_level'] = 'WARNING'
+    config['loris.Loris']['enable_caching'] = False
+    config['transforms']['jpg']['jpeg_draft_mode'] = jpeg_draft_mode
+    return Client(Loris(config), BaseResponse)
+
+
+clients = {mode: make_client(mode) for mode in (False, True)}
+for request_path in REQUEST_PATHS:
+    times = {}
+    for mode, client in clients.items():
+        t = timeit.timeit(lambda: client.get(request_path).data, number=NUMBER)
+        times[mode] = t / NUMBER
+    print('%-45s full decode %0.4fs, draft %0.4fs (%0.1fx)' % (
+        request_path, times[False], times[True], times[False] / times[True]))
@@ -0,0 +1,202 @@
+from concurrent.futures import TimeoutError
+import os
+from os import path
+
+import pytest
+
+from loris import img_info, transforms
+from loris.decoder_pool import DecoderPool, acquire_slot, open_slots, release_slot
+from loris.img import ImageRequest
+from loris.webapp import get_debug_config
+from tests import loris_t
+
+
+TEST_JP2_FP = path.join(path.dirname(path.realpath(__file__)), 'img', '01', '02', 'gray.jp2')
+
+TRANSFORMER_CONFIG = {
+    'tmp_dp': '/tmp/loris/tmp',
+    'target_formats': ['jpg'],
+    'dither_bitonal_images': False,
+}
+
+
+@pytest.fixture
+def jp2_info():
+    info = img_info.ImageInfo(src_img_fp=TEST_JP2_FP, src_format='jp2')
+    info.width = 2477
+    info.height = 3200
+    info.tiles = [{'width': 256, 'scaleFactors': [1, 2, 4, 8, 16, 32, 64]}]
+    return info
+
+
+@pytest.fixture
+def pool():
+    pool = DecoderPool(
+        transformer_class=transforms.PillowJP2Transformer,
+        config=TRANSFORMER_CONFIG,
+        workers=2,
+        cpu_budget=4
+    )
+    yield pool
+    pool.close()
+
+
+class TestDecoderPool:
+
+    @pytest.mark.parametrize('workers, cpu_budget, threads_per_job', [
+        (2, 4, 2),
+        (4, 4, 1),
+        (8, 4, 1),
+        (3, 8, 2),
+    ])
+    def test_cpu_budget_is_shared_between_workers(self, workers, cpu_budget, threads_per_job):
+        pool = DecoderPool(
+            transformer_class=transforms.PillowJP2Transformer,
+            config=TRANSFORMER_CONFIG,
+            workers=workers,
+            cpu_budget=cpu_budget
+        )
+        try:
+            assert pool.threads_per_job == threads_per_job
+        finally:
+            pool.close()
+
+    @pytest.mark.parametrize('workers, cpu_budget, slots', [
+        (2, 4, 2),
+        (4, 4, 4),
+        (8, 4, 4),
+        (3, 8, 4),
+    ])
+    def test_host_wide_slots_come_from_the_cpu_budget(self, workers, cpu_budget, slots, tmpdir):
+        pool = DecoderPool(
+            transformer_class=transforms.PillowJP2Transformer,
+            config=TRANSFORMER_CONFIG,
+            workers=workers,
+            cpu_budget=cpu_budget,
+            slots_dp=str(tmpdir)
+        )
+        try:
+            assert pool.slots == slots
+            assert pool.metrics()['slots'] == slots
+        finally:
+            pool.close()
+
+    def test_slots_are_exclusive(self, tmpdir):
+        # Separate opens of the slot files, as in separate processes.
+        first = acquire_slot(open_slots(str(tmpdir), 2))
+        second = acquire_slot(open_slots(str(tmpdir), 2))
+        assert first.name != second.name
+        mine = open_slots(str(tmpdir), 2)
+        assert acquire_slot(mine, timeout=0.1) is None
+        release_slot(second)
+        assert acquire_slot(mine, timeout=0.1).name == second.name
+
+    def test_jobs_wait_for_a_slot_held_by_another_process(self, jp2_info, tmpdir):
+        pool = DecoderPool(
+            transformer_class=transforms.PillowJP2Transformer,
+            config=TRANSFORMER_CONFIG,
+            workers=1,
+            cpu_budget=1,
+            slots_dp=str(tmpdir)
+        )
+        image_request = ImageRequest('id1', 'full', '100,', '0', 'default', 'jpg')
+        try:
+            # Start the worker, so it isn't the slow start that times out.
+            expected = pool.decode(image_request, jp2_info, timeout=60)
+            other_process_slots = open_slots(str(tmpdir), 1)
+            slot = acquire_slot(other_process_slots)
+            with pytest.raises(TimeoutError):
+                pool.decode(image_request, jp2_info, timeout=1)
+            release_slot(slot)
+            assert pool.decode(image_request, jp2_info, timeout=60).size == expected.size
+        finally:
+            pool.close()
+
+    def test_decodes_same_pixels_as_transformer(self, pool, jp2_info):
+        image_request = ImageRequest('id1', '1024,1024,1024,1024', '256,', '0', 'default', 'jpg')
+        transformer = transforms.PillowJP2Transformer(TRANSFORMER_CONFIG)
+
+        expected = transformer._decode(image_request, jp2_info)
+        actual = pool.decode(image_request, jp2_info, timeout=60)
+
+        assert actual.mode == expected.mode
+        assert actual.size == expected.size
+        assert actual.tobytes() == expected.tobytes()
+
+    def test_metrics_count_jobs(self, pool, jp2_info):
+        image_request = ImageRequest('id1', 'full', '100,', '0', 'default', 'jpg')
+        pool.decode(image_request, jp2_info, timeout=60)
+        pool.decode(image_request, jp2_info, timeout=60)
+        pool.close()
+
+        metrics = pool.metrics()
+        assert metrics['submitted'] == 2
+        assert metrics['completed'] == 2
+        assert metrics['failed'] == 0
+        assert metrics['queue_depth'] == 0
+        assert metrics['in_flight'] == 0
+
+    def test_workers_start_with_the_first_job(self, pool, jp2_info):
+        assert pool._executor is None
+        jp2_info.src_img_fp = '/does/not/exist.jp2'
+        image_request = ImageRequest('id1', 'full', '100,', '0', 'default', 'jpg')
+        with pytest.raises(FileNotFoundError):
+            pool.decode(image_request, jp2_info, timeout=60)
+        assert pool._executor is not None
+
+    def test_forked_child_gets_its_own_workers(self, pool, jp2_info):
+        jp2_info.src_img_fp = '/does/not/exist.jp2'
+        image_request = ImageRequest('id1', 'full', '100,', '0', 'default', 'jpg')
+        # Start the parent's workers first, as a pool built before a WSGI
+        # server forks may have done.
+        with pytest.raises(FileNotFoundError):
+            pool.decode(image_request, jp2_info, timeout=60)
+        parent_executor = pool._executor
+
+        child = os.fork()
+        if child == 0:
+            status = 1
+            try:
+                pool.decode(image_request, jp2_info, timeout=60)
+            except FileNotFoundError:
+                if pool._executor is not parent_executor:
+                    status = 0
+                pool.close()
+            finally:
+                os._exit(status)
+        _, status = os.waitpid(child, 0)
+        assert os.WEXITSTATUS(status) == 0
+
+        # The parent's workers are still there and still answer.
+        assert pool._executor is parent_executor
+        with pytest.raises(FileNotFoundError):
+            pool.decode(image_request, jp2_info, timeout=60)
+
+    def test_decode_error_is_raised_and_counted(self, pool, jp2_info):
+        jp2_info.src_img_fp = '/does/not/exist.jp2'
+        image_request = ImageRequest('id1', 'full', '100,', '0', 'default', 'jpg')
+        with pytest.raises(FileNotFoundError):
+            pool.decode(image_request, jp2_info, timeout=60)
+        pool.close()
+
+        assert pool.metrics()['failed'] == 1
+
+
+class Test_DecoderPoolTransformer(loris_t.LorisTest):
+
+    def setUp(self):
+        super(Test_DecoderPoolTransformer, self).setUp()
+        config = get_debug_config('pillow')
+        config['transforms']['jp2']['decoder_pool_workers'] = 1
+        self.build_client_from_config(config)
+
+    def tearDown(self):
+        self.app.transformers['jp2'].decoder_pool.close()
+        super(Test_DecoderPoolTransformer, self).tearDown()
+
+    def test_transform_uses_decoder_pool(self):
+        request_path = '/%s/full/300,/0/default.jpg' % self.test_jp2_gray_id
+        image = self.request_image_from_client(request_path)
+
+        assert image.width == 300
+        assert self.app.transformers['jp2'].decoder_pool.submitted == 1
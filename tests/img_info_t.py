@@ -1,9 +1,13 @@
+import glob
 import json
 import os
 from os import path
 import shutil
+import sqlite3
 import tempfile
+import time
 from datetime import datetime
+from unittest import mock
 from urllib.parse import unquote
 
 import pytest
@@ -12,6 +16,7 @@ from werkzeug.datastructures import Headers
 from loris import img_info, loris_exception
 from loris.img_info import ImageInfo, Profile
 from loris.loris_exception import ImageInfoException
+from loris.utils import icc_profile_digest
 from tests import loris_t
 
 
@@ -90,6 +95,20 @@ class InfoUnit(loris_t.LorisTest):
         with open(self.test_jp2_embedded_profile_copy_fp, 'rb') as fixture_bytes:
             self.assertEqual(info.color_profile_bytes, fixture_bytes.read())
 
+    def test_color_profile_digest_is_set_with_profile(self):
+        info = img_info.ImageInfo(
+            app=self.app,
+            src_img_fp=self.test_jp2_with_embedded_profile_fp,
+            src_format=self.test_jp2_with_embedded_profile_fmt
+        )
+        self.assertEqual(
+            info.color_profile_digest,
+            icc_profile_digest(info.color_profile_bytes)
+        )
+
+        info.color_profile_bytes = None
+        self.assertIsNone(info.color_profile_digest)
+
     def test_no_embedded_profile_info_color_profile_bytes_is_None(self):
         fp = self.test_jp2_color_fp
         fmt = self.test_jp2_color_fmt
@@ -236,6 +255,15 @@ class InfoUnit(loris_t.LorisTest):
         self.assertEqual(info.profile.compliance_uri, profile[0])
         self.assertEqual(info.profile.description, profile[1])
 
+    def test_pyramidal_tiff_info_has_tiles_and_sizes(self):
+        info = img_info.ImageInfo(
+            app=self.app, src_img_fp=self.test_tiff_pyramid_fp, src_format='tif'
+        )
+
+        self.assertEqual((info.width, info.height), self.test_tiff_pyramid_dims)
+        self.assertEqual(info.tiles, self.test_tiff_pyramid_tiles)
+        self.assertEqual(info.sizes, self.test_tiff_pyramid_sizes)
+
     def test_info_from_json(self):
         json_fp = self.test_jp2_color_info_fp
 
@@ -325,6 +353,16 @@ class TestImageInfo:
         assert info.profile.compliance_uri == compliance_uri
         assert info.profile.description == description
 
+    def test_iiif_json_memo_forgets_the_oldest_entry(self):
+        info = ImageInfo.from_json(json.dumps({'width': 100, 'height': 100}))
+        base_uris = ['http://example.org/%d' % n for n in range(ImageInfo.MAX_IIIF_JSON + 1)]
+        for base_uri in base_uris:
+            info.iiif_json_and_etag(base_uri, 'application/json')
+        assert len(info._iiif_json) == ImageInfo.MAX_IIIF_JSON
+        assert (base_uris[0], 'application/json') not in info._iiif_json
+        assert (base_uris[1], 'application/json') in info._iiif_json
+        assert (base_uris[-1], 'application/json') in info._iiif_json
+
 
 class TestProfile:
 
@@ -561,3 +599,212 @@ class TestInfoCache(loris_t.LorisTest):
             with pytest.raises(KeyError):
                 cache[self.test_jpeg_id]
 
+    def test_source_is_verified_at_most_every_interval(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            src_fp = path.join(tmp, 'source.jpg')
+            open(src_fp, 'wb').close()
+            cache = img_info.InfoCache(root=tmp, verify_source_interval=60)
+            info = img_info.ImageInfo(src_img_fp=src_fp, src_format='jpg')
+            info.width, info.height, info.tiles, info.sizes = 100, 100, [], []
+            info.profile = Profile('http://iiif.io/api/image/2/level2.json', {})
+            info.color_profile_bytes = None
+            cache['ident'] = info
+            cache['ident']
+
+            os.unlink(src_fp)
+            with mock.patch('loris.img_info.os.path.exists') as exists:
+                assert cache.get('ident') is not None
+            exists.assert_not_called()
+
+            monotonic = time.monotonic() + 60
+            with mock.patch('loris.img_info.time.monotonic', return_value=monotonic):
+                assert cache.get('ident') is None
+
+
+    def test_sqlite_storage(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = img_info.InfoCache(root=tmp, size=0, storage='sqlite', store_shards=4)
+            info = img_info.ImageInfo(src_img_fp=__file__, src_format='jpg')
+            info.width, info.height, info.tiles, info.sizes = 100, 100, [], []
+            info.profile = Profile('http://iiif.io/api/image/2/level2.json', {})
+            info.color_profile_bytes = b'icc'
+            cache['01%2F02%2Fa.jpg'] = info
+
+            # Quoted and unquoted identifiers are the same entry, as with files.
+            got, lastmod = cache['01/02/a.jpg']
+            assert got.to_full_info_json() == info.to_full_info_json()
+            assert got.color_profile_bytes == b'icc'
+            assert '01/02/a.jpg' in cache
+            # Only the databases of the shards that were written to.
+            assert 0 < len(glob.glob(path.join(tmp, '.info-*.sqlite'))) <= 2
+            assert not path.exists(path.dirname(cache._get_info_fp('01/02/a.jpg')))
+
+            del cache['01/02/a.jpg']
+            assert cache.get('01/02/a.jpg') is None
+
+    def test_store_opens_only_the_shards_it_uses(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = img_info.InfoStore(tmp, shards=16)
+            assert store._conns == {}
+            assert len(store) == 0
+            assert glob.glob(path.join(tmp, '.info-*.sqlite')) == []
+
+            store.put('a.jp2', '{}', 1.0)
+            assert list(store._conns) == [store._shard('a.jp2')]
+            assert glob.glob(path.join(tmp, '.info-*.sqlite')) == [
+                store._shard_fp(store._shard('a.jp2'))
+            ]
+            # A fresh store counts what's there without opening the rest.
+            other = img_info.InfoStore(tmp, shards=16)
+            assert len(other) == 1
+            assert list(other._conns) == [store._shard('a.jp2')]
+
+    def test_failed_import_batch_is_rolled_back(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = img_info.InfoStore(tmp, shards=1)
+            batch = [('a.jp2', '{}', 1.0), ('b.jp2', None, 1.0)]
+            with self.assertLogs('loris.img_info', 'ERROR'):
+                with pytest.raises(sqlite3.IntegrityError):
+                    store._import_batch(batch)
+            assert store.get('a.jp2') is None
+            assert len(store) == 0
+
+            # The connection isn't left in the failed transaction.
+            assert store._import_batch(batch[:1]) == 1
+            assert store.get('a.jp2') == ('{}', 1.0)
+
+    def test_color_profiles_are_stored_once(self):
+        for storage in ('files', 'sqlite'):
+            with tempfile.TemporaryDirectory() as tmp:
+                cache = img_info.InfoCache(root=tmp, size=0, storage=storage)
+                profile = b'icc' * 100
+                for ident in ('a.jp2', 'b.jp2'):
+                    info = img_info.ImageInfo(src_img_fp=__file__, src_format='jp2')
+                    info.width, info.height, info.tiles, info.sizes = 100, 100, [], []
+                    info.profile = Profile('http://iiif.io/api/image/2/level2.json', {})
+                    info.color_profile_bytes = bytes(profile)
+                    cache[ident] = info
+
+                a, b = cache['a.jp2'][0], cache['b.jp2'][0]
+                assert a.color_profile_bytes == profile
+                assert a.color_profile_bytes is b.color_profile_bytes
+                assert a.color_profile_digest == icc_profile_digest(profile)
+                if storage == 'files':
+                    assert os.listdir(path.join(tmp, '.profiles')) == [
+                        '%s.icc' % a.color_profile_digest
+                    ]
+                    assert not path.exists(cache._get_color_profile_fp('a.jp2'))
+
+    def test_entry_with_missing_profile_is_a_miss(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = img_info.InfoCache(root=tmp, size=0)
+            info = img_info.ImageInfo(src_img_fp=__file__, src_format='jp2')
+            info.width, info.height, info.tiles, info.sizes = 100, 100, [], []
+            info.profile = Profile('http://iiif.io/api/image/2/level2.json', {})
+            # Not one that's already held in img_info.color_profiles.
+            info.color_profile_bytes = os.urandom(64)
+            cache['a.jp2'] = info
+            img_info.color_profiles._dict.pop(info.color_profile_digest)
+            shutil.rmtree(path.join(tmp, '.profiles'))
+            assert cache.get('a.jp2') is None
+
+    def test_profile_icc_from_before_digests_is_read(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = img_info.InfoCache(root=tmp, size=0)
+            info_fp = cache._get_info_fp('a.jp2')
+            os.makedirs(path.dirname(info_fp))
+            with open(info_fp, 'w') as f:
+                json.dump({
+                    'width': 100, 'height': 100, 'tiles': [], 'sizes': [],
+                    'profile': ['http://iiif.io/api/image/2/level2.json'],
+                    '_src_img_fp': __file__, '_src_format': 'jp2',
+                }, f)
+            with open(cache._get_color_profile_fp('a.jp2'), 'wb') as f:
+                f.write(b'old icc')
+            info = cache['a.jp2'][0]
+            assert info.color_profile_bytes == b'old icc'
+            assert info.color_profile_digest == icc_profile_digest(b'old icc')
+
+    def test_unknown_storage_is_config_error(self):
+        with pytest.raises(loris_exception.ConfigError):
+            img_info.InfoCache(root=self.SRC_IMAGE_CACHE, storage='bucket')
+
+
+class TestSharedInfoTier(loris_t.LorisTest):
+
+    def _info(self):
+        info = img_info.ImageInfo(src_img_fp=__file__, src_format='jp2')
+        info.width, info.height = 5906, 7200
+        info.tiles = [{'width': 256, 'scaleFactors': [1, 2, 4, 8, 16, 32]}]
+        info.sizes = [{'width': 185, 'height': 225}]
+        info.profile = Profile(
+            'http://iiif.io/api/image/2/level2.json', {'formats': ['jpg']}
+        )
+        info.color_profile_bytes = b'icc'
+        return info
+
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            shared = img_info.SharedInfoTier(path.join(tmp, 'info'), slots=64)
+            info = self._info()
+            shared.put('ident', info, 1.5)
+            got = shared.get('ident', 1.5)
+            assert got.to_full_info_json() == info.to_full_info_json()
+            # The profile is referred to by its digest.
+            assert got.color_profile_digest == info.color_profile_digest
+            assert got.color_profile_bytes is None
+            assert shared.metrics() == {'hits': 1, 'misses': 0, 'slots': 64}
+
+    def test_changed_mtime_is_a_miss(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            shared = img_info.SharedInfoTier(path.join(tmp, 'info'), slots=64)
+            shared.put('ident', self._info(), 1.5)
+            assert shared.get('ident', 2.5) is None
+            assert shared.get('other', 1.5) is None
+
+    def test_is_shared_through_the_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fp = path.join(tmp, 'info')
+            img_info.SharedInfoTier(fp, slots=64).put('ident', self._info(), 1.5)
+            # Sized by the existing file, not the arguments.
+            other = img_info.SharedInfoTier(fp, slots=8, slot_bytes=1024)
+            assert (other.slots, other.slot_bytes) == (64, 4096)
+            assert other.get('ident', 1.5) is not None
+
+    def test_discard(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            shared = img_info.SharedInfoTier(path.join(tmp, 'info'), slots=64)
+            shared.put('ident', self._info(), 1.5)
+            shared.discard('ident')
+            assert shared.get('ident', 1.5) is None
+
+    def test_entries_too_big_for_a_slot_are_not_shared(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            shared = img_info.SharedInfoTier(path.join(tmp, 'info'), slots=64, slot_bytes=128)
+            shared.put('ident', self._info(), 1.5)
+            assert shared.get('ident', 1.5) is None
+
+    def test_info_cache_reads_through_the_shared_tier(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fp = path.join(tmp, 'info')
+            writer = img_info.InfoCache(
+                root=tmp, shared=img_info.SharedInfoTier(fp, slots=64)
+            )
+            writer[self.test_jp2_color_id] = self._info()
+
+            reader = img_info.InfoCache(
+                root=tmp, size=0, shared=img_info.SharedInfoTier(fp)
+            )
+            info, lastmod = reader[self.test_jp2_color_id]
+            assert info.width == 5906
+            assert info.color_profile_bytes == b'icc'
+            assert reader.shared.metrics()['hits'] == 1
+
+            # A rewritten info.json isn't served from the shared tier.
+            info_fp = reader._get_info_fp(self.test_jp2_color_id)
+            os.utime(info_fp, (0, 0))
+            reader[self.test_jp2_color_id]
+            assert reader.shared.metrics()['misses'] == 1
+
+            del writer[self.test_jp2_color_id]
+            assert reader.get(self.test_jp2_color_id) is None
@@ -1,16 +1,36 @@
 import mock
+import os
 from os.path import exists
 from os.path import islink
 from os.path import join
 import tempfile
+import threading
 from urllib.parse import unquote
 
 import pytest
 
 from loris import img, img_info
+from loris.loris_exception import ConfigError
 from tests import loris_t
 
 
+def make_info(width=100, height=100):
+    '''An ImageInfo with only the size of the image.'''
+    info = img_info.ImageInfo()
+    info.width = width
+    info.height = height
+    return info
+
+
+def write_file(root, rel_fp, size=10, data=None):
+    '''Write data, or size bytes, to rel_fp under root.'''
+    fp = os.path.join(str(root), rel_fp)
+    os.makedirs(os.path.dirname(fp), exist_ok=True)
+    with open(fp, 'wb') as f:
+        f.write(b'x' * size if data is None else data)
+    return fp
+
+
 class TestImageRequest:
 
     @pytest.mark.parametrize('args, request_path', [
@@ -119,10 +139,501 @@ class Test_ImageCache(loris_t.LorisTest):
                 with pytest.raises(OSError) as err:
                     cache[request]
 
+    def test_open_missing_entry_is_none(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = img.ImageCache(cache_root=tmp)
+            request = img.ImageRequest('id1', 'full', 'full', '0', 'default', 'jpg')
+
+            self.assertIsNone(cache.open(request))
+
+    def test_open_follows_symlinks_to_the_canonical_image(self):
+        ident = self.test_tiff_pyramid_id
+        self.client.get('/%s/full/!300,300/0/default.jpg' % ident)
+        request = img.ImageRequest(ident, 'full', '!300,300', '0', 'default', 'jpg')
+        canonical_fp, _ = self.app.img_cache[request]
+
+        with mock.patch('loris.img.path.realpath') as realpath:
+            fd, stat_result = self.app.img_cache.open(request)
+        realpath.assert_not_called()
+        with os.fdopen(fd, 'rb') as f:
+            self.assertEqual(len(f.read()), stat_result.st_size)
+        self.assertEqual(stat_result.st_ino, os.stat(canonical_fp).st_ino)
+
     def test_deleting_cache_entries(self):
-        # Because this operation is a no-op, we just check we can call the
-        # __del__ method without an error.
+        # Deleting an image that isn't in the cache isn't an error.
         with tempfile.TemporaryDirectory() as tmp:
             cache = img.ImageCache(cache_root=tmp)
             request = img.ImageRequest('id1', 'full', 'full', '0', 'default', 'jpg')
             del cache[request]
+
+
+class TestRenderLocks:
+
+    def test_second_holder_waits_for_the_first(self, tmpdir):
+        locks = img.RenderLocks(str(tmpdir.join('locks')))
+        key = 'id1/full/50,/0/default.jpg'
+        events = []
+
+        def wait_for_lock():
+            with locks.hold(key):
+                events.append('waiter')
+
+        with locks.hold(key):
+            waiter = threading.Thread(target=wait_for_lock)
+            waiter.start()
+            waiter.join(timeout=0.2)
+            events.append('holder')
+        waiter.join()
+        assert events == ['holder', 'waiter']
+
+    def test_the_number_of_lock_files_is_bounded(self, tmpdir):
+        locks = img.RenderLocks(str(tmpdir), stripes=4)
+        lock_paths = {locks.lock_path('id%d' % i) for i in range(100)}
+        assert len(lock_paths) <= 4
+
+    def test_render_lock_yields_nothing_for_a_missing_image(self, tmpdir):
+        cache = img.ImageCache(cache_root=str(tmpdir))
+        request = img.ImageRequest('id1', 'full', '50,', '0', 'default', 'jpg')
+        with cache.render_lock(request, make_info()) as cached_fp:
+            assert cached_fp is None
+        assert cache.render_locks.metrics() == {'renders': 1, 'renders_saved': 0}
+
+    def test_render_lock_yields_an_image_made_while_waiting(self, tmpdir):
+        cache = img.ImageCache(cache_root=str(tmpdir))
+        info = make_info()
+        canonical_fp = cache.create_dir_and_return_file_path(
+            img.ImageRequest('id1', 'full', '50,', '0', 'default', 'jpg'), info
+        )
+        with open(canonical_fp, 'wb') as f:
+            f.write(b'made by someone else')
+
+        request = img.ImageRequest('id1', 'full', '!50,50', '0', 'default', 'jpg')
+        with cache.render_lock(request, info) as cached_fp:
+            assert cached_fp == canonical_fp
+        assert cache.render_locks.metrics() == {'renders': 0, 'renders_saved': 1}
+        # and the non-canonical request is linked to it
+        assert request in cache
+
+
+class TestMemoryTier:
+
+    def test_entries_are_returned_and_counted(self):
+        memory = img.MemoryTier(max_bytes=100)
+        memory.put('a', b'aaaa', 'today', 'image/jpeg')
+        assert memory.get('a') == (b'aaaa', 'today', 'image/jpeg')
+        assert memory.get('b') is None
+        assert memory.metrics()['hits'] == 1
+        assert memory.metrics()['misses'] == 1
+
+    def test_least_recently_used_are_evicted_over_budget(self):
+        memory = img.MemoryTier(max_bytes=10)
+        memory.put('a', b'a' * 4, 'today', 'image/jpeg')
+        memory.put('b', b'b' * 4, 'today', 'image/jpeg')
+        memory.get('a')
+        memory.put('c', b'c' * 4, 'today', 'image/jpeg')
+        assert memory.get('b') is None
+        assert memory.get('a') is not None
+        assert memory.metrics()['evictions'] == 1
+        assert memory.metrics()['bytes'] == 8
+
+    def test_replacing_an_entry_keeps_the_byte_count(self):
+        memory = img.MemoryTier(max_bytes=10)
+        memory.put('a', b'a' * 4, 'today', 'image/jpeg')
+        memory.put('a', b'a' * 6, 'today', 'image/jpeg')
+        assert len(memory) == 1
+        assert memory.current_bytes == 6
+
+    def test_big_images_are_not_admitted(self):
+        memory = img.MemoryTier(max_bytes=100, max_item_bytes=10)
+        memory.put('a', b'a' * 11, 'today', 'image/jpeg')
+        assert len(memory) == 0
+
+    def test_cache_without_a_budget_has_no_memory_tier(self, tmpdir):
+        cache = img.ImageCache(cache_root=str(tmpdir))
+        request = img.ImageRequest('id1', 'full', 'full', '0', 'default', 'jpg')
+        assert cache.memory is None
+        assert cache.get_from_memory(request) is None
+
+    def test_discarding_entries(self):
+        memory = img.MemoryTier(max_bytes=100)
+        memory.put('a', b'aaaa', 'today', 'image/jpeg', target='/cache/a.jpg')
+        memory.put('b', b'bbbb', 'today', 'image/jpeg', target='/cache/a.jpg')
+        memory.put('c', b'cccc', 'today', 'image/jpeg')
+        memory.discard('c')
+        assert memory.get('c') is None
+        memory.discard_target('/cache/a.jpg')
+        assert len(memory) == 0
+        assert memory.current_bytes == 0
+
+    def _cache_image(self, cache, request, tmpdir, data=b'jpg'):
+        cache.upsert(request, write_file(tmpdir, 'tmp.jpg', data=data), make_info())
+        fd, stat_result = cache.open(request)
+        with os.fdopen(fd, 'rb') as f:
+            cache.add_to_memory(request, f, stat_result.st_size, 'today', 'image/jpeg')
+
+    def test_deleted_image_is_not_served_from_memory(self, tmpdir):
+        cache = img.ImageCache(cache_root=str(tmpdir.mkdir('cache')), memory_max_bytes=1000)
+        request = img.ImageRequest('id1', 'full', 'full', '0', 'default', 'jpg')
+        self._cache_image(cache, request, tmpdir)
+        assert cache.get_from_memory(request) is not None
+
+        del cache[request]
+        assert cache.get_from_memory(request) is None
+        assert cache.open(request) is None
+
+    def test_evicted_image_is_not_served_from_memory(self, tmpdir):
+        cache = img.ImageCache(
+            cache_root=str(tmpdir.mkdir('cache')), memory_max_bytes=1000,
+            quota_bytes=1000
+        )
+        request = img.ImageRequest('id1', 'full', 'full', '0', 'default', 'jpg')
+        self._cache_image(cache, request, tmpdir)
+        cache.index.remove(cache.get_request_cache_path(request))
+        assert cache.get_from_memory(request) is None
+
+    def test_remade_image_replaces_the_one_in_memory(self, tmpdir):
+        cache = img.ImageCache(cache_root=str(tmpdir.mkdir('cache')), memory_max_bytes=1000)
+        request = img.ImageRequest('id1', 'full', 'full', '0', 'default', 'jpg')
+        self._cache_image(cache, request, tmpdir, data=b'old')
+        cache.upsert(request, write_file(tmpdir, 'new.jpg', data=b'new'), make_info())
+        assert cache.get_from_memory(request) is None
+
+
+class TestCacheIndex:
+
+    def _add(self, index, root, rel_fp, size, now):
+        fp = write_file(root, rel_fp, size)
+        with mock.patch('loris.img.time.time', return_value=now):
+            index.add(fp, size)
+        return fp
+
+    def test_total_bytes_are_tracked(self, tmpdir):
+        index = img.CacheIndex(str(tmpdir))
+        fp = self._add(index, tmpdir, 'a/1.jpg', 10, now=1)
+        self._add(index, tmpdir, 'b/1.jpg', 20, now=2)
+        index.add(fp, 15)
+        assert index.total_bytes == 35
+        assert len(index) == 2
+
+    def test_least_recently_used_are_evicted_over_quota(self, tmpdir):
+        index = img.CacheIndex(str(tmpdir), quota_bytes=30, flush_interval=0)
+        a = self._add(index, tmpdir, 'a/1.jpg', 10, now=1)
+        b = self._add(index, tmpdir, 'b/1.jpg', 10, now=2)
+        with mock.patch('loris.img.time.time', return_value=3):
+            index.touch(a)
+        c = self._add(index, tmpdir, 'c/1.jpg', 15, now=4)
+        assert exists(a) and exists(c)
+        assert not exists(b)
+        # and its directory
+        assert not exists(os.path.dirname(b))
+        assert index.total_bytes == 25
+
+    def test_size_policy_evicts_big_old_images_first(self, tmpdir):
+        index = img.CacheIndex(str(tmpdir), quota_bytes=100, policy='size')
+        small = self._add(index, tmpdir, 'a/1.jpg', 10, now=1)
+        big = self._add(index, tmpdir, 'b/1.jpg', 60, now=2)
+        self._add(index, tmpdir, 'c/1.jpg', 40, now=3)
+        assert exists(small)
+        assert not exists(big)
+
+    def test_removing_an_image_removes_its_links(self, tmpdir):
+        index = img.CacheIndex(str(tmpdir))
+        fp = self._add(index, tmpdir, 'a/full/10,/0/default.jpg', 10, now=1)
+        link = os.path.join(str(tmpdir), 'a/full/!10,10/0/default.jpg')
+        os.makedirs(os.path.dirname(link))
+        os.symlink(fp, link)
+        index.add_link(link, fp)
+        index.remove(fp)
+        assert not os.path.lexists(link)
+        assert not exists(fp)
+        assert index.total_bytes == 0
+
+    def test_rebuild_indexes_the_cache(self, tmpdir):
+        fp = write_file(tmpdir, 'a/full/10,/0/default.jpg', 10)
+        write_file(tmpdir, 'b/full/20,/0/default.jpg', 20)
+        write_file(tmpdir, '.locks/1.lock', 0)
+        # An info cache sharing the directory
+        write_file(tmpdir, 'a/info.json', 100)
+        write_file(tmpdir, 'a/profile.icc', 100)
+        link = os.path.join(str(tmpdir), 'a/full/!10,10/0/default.jpg')
+        os.makedirs(os.path.dirname(link))
+        os.symlink(fp, link)
+
+        index = img.CacheIndex(str(tmpdir))
+        index.add(write_file(tmpdir, 'gone.jpg', 5), 5)
+        os.unlink(os.path.join(str(tmpdir), 'gone.jpg'))
+
+        assert index.rebuild() == (2, 1)
+        assert index.total_bytes == 30
+        index.remove(fp)
+        assert not os.path.lexists(link)
+
+    def test_upsert_survives_its_directory_being_evicted(self, tmpdir):
+        cache = img.ImageCache(cache_root=str(tmpdir), quota_bytes=1000)
+        info = make_info()
+        request = img.ImageRequest('id1', 'full', '50,', '0', 'default', 'jpg')
+        temp_fp = write_file(tmpdir, 'tmp.jpg', 10)
+        safe_rename = img.safe_rename
+        renames = []
+
+        def evict_then_rename(src, dst):
+            # Another process empties and removes the directory after we
+            # made it.
+            if not renames:
+                os.rmdir(os.path.dirname(dst))
+            renames.append(dst)
+            safe_rename(src, dst)
+
+        with mock.patch('loris.img.safe_rename', side_effect=evict_then_rename):
+            canonical_fp = cache.upsert(request, temp_fp, info)
+        assert len(renames) == 2
+        assert exists(canonical_fp)
+        assert cache.index.total_bytes == 10
+
+    def test_unknown_policy_is_configerror(self, tmpdir):
+        with pytest.raises(ConfigError):
+            img.CacheIndex(str(tmpdir), policy='mru')
+
+    def test_image_cache_indexes_images_and_links(self, tmpdir):
+        cache = img.ImageCache(cache_root=str(tmpdir), quota_bytes=1000)
+        info = make_info()
+        request = img.ImageRequest('id1', 'full', '!50,50', '0', 'default', 'jpg')
+        temp_fp = write_file(tmpdir, 'tmp.jpg', 10)
+        canonical_fp = cache.upsert(request, temp_fp, info)
+        assert cache.index.total_bytes == 10
+
+        del cache[request]
+        assert not exists(canonical_fp)
+        assert request not in cache
+        assert not os.path.lexists(cache.get_request_cache_path(request))
+        assert len(cache.index) == 0
+
+
+class TestAliasIndex:
+
+    def test_aliases_are_looked_up_by_relative_path(self, tmpdir):
+        aliases = img.AliasIndex(str(tmpdir))
+        fp = write_file(tmpdir, 'a/full/50,/0/default.jpg')
+        aliases.add('a/full/!50,50/0/default.jpg', fp)
+        assert aliases.get('a/full/!50,50/0/default.jpg') == os.path.realpath(fp)
+        assert aliases.get('a/full/50,50/0/default.jpg') is None
+
+        aliases.remove_target(fp)
+        assert len(aliases) == 0
+
+    def test_symlinks_are_imported(self, tmpdir):
+        fp = write_file(tmpdir, 'a/full/50,/0/default.jpg')
+        link = os.path.join(str(tmpdir), 'a/full/!50,50/0/default.jpg')
+        os.makedirs(os.path.dirname(link))
+        os.symlink(fp, link)
+        dangling = os.path.join(str(tmpdir), 'b/full/!50,50/0/default.jpg')
+        os.makedirs(os.path.dirname(dangling))
+        os.symlink(os.path.join(str(tmpdir), 'b/gone.jpg'), dangling)
+
+        aliases = img.AliasIndex(str(tmpdir))
+        assert aliases.import_symlinks(batch_size=1) == (1, 1)
+        assert aliases.get('a/full/!50,50/0/default.jpg') == os.path.realpath(fp)
+        assert not os.path.lexists(link)
+        assert not os.path.exists(os.path.join(str(tmpdir), 'a/full/!50,50'))
+        assert not os.path.exists(os.path.join(str(tmpdir), 'b'))
+        assert exists(fp)
+
+    def test_image_cache_uses_aliases_instead_of_symlinks(self, tmpdir):
+        cache = img.ImageCache(cache_root=str(tmpdir), aliases='sqlite')
+        request = img.ImageRequest('id1', 'full', '!50,50', '0', 'default', 'jpg')
+        canonical_fp = cache.upsert(request, write_file(tmpdir, 'tmp.jpg'), make_info())
+
+        request_fp = os.path.join(
+            str(tmpdir), img._cache_directory_name('id1'), 'full/!50,50/0/default.jpg'
+        )
+        assert not os.path.lexists(request_fp)
+        assert request in cache
+        assert cache[request][0] == canonical_fp
+        fd, stat_result = cache.open(request)
+        os.close(fd)
+        assert stat_result.st_ino == os.stat(canonical_fp).st_ino
+
+        del cache[request]
+        assert not exists(canonical_fp)
+        assert request not in cache
+        assert cache.open(request) is None
+        assert len(cache.aliases) == 0
+
+    def test_evicted_images_lose_their_aliases(self, tmpdir):
+        cache = img.ImageCache(cache_root=str(tmpdir), quota_bytes=15, aliases='sqlite')
+        info = make_info()
+        first = img.ImageRequest('id1', 'full', '!50,50', '0', 'default', 'jpg')
+        cache.upsert(first, write_file(tmpdir, 'tmp.jpg'), info)
+        second = img.ImageRequest('id2', 'full', '!50,50', '0', 'default', 'jpg')
+        cache.upsert(second, write_file(tmpdir, 'tmp.jpg'), info)
+        assert first not in cache
+        assert second in cache
+        assert len(cache.aliases) == 1
+
+    def test_unknown_aliases_is_configerror(self, tmpdir):
+        with pytest.raises(ConfigError):
+            img.ImageCache(cache_root=str(tmpdir), aliases='hardlinks')
+
+
+class TestPackStore:
+
+    def test_packed_images_are_read_back(self, tmpdir):
+        packs = img.PackStore(str(tmpdir))
+        packs.put('a', 'a/full/50,/0/default.jpg', write_file(tmpdir, 'tmp.jpg', data=b'first'))
+        packs.put('a', 'a/full/60,/0/default.jpg', write_file(tmpdir, 'tmp.jpg', data=b'second'))
+        packs.link('a/full/!50,50/0/default.jpg', 'a/full/50,/0/default.jpg')
+
+        assert packs.read('a/full/60,/0/default.jpg')[0] == b'second'
+        data, _, canonical_rel_fp = packs.read('a/full/!50,50/0/default.jpg')
+        assert data == b'first'
+        assert canonical_rel_fp == 'a/full/50,/0/default.jpg'
+        assert packs.read('a/full/70,/0/default.jpg') is None
+        assert os.listdir(str(tmpdir.join('a'))) == ['.pack.0']
+        assert not exists(str(tmpdir.join('tmp.jpg')))
+
+    def test_removed_images_and_their_aliases_are_forgotten(self, tmpdir):
+        packs = img.PackStore(str(tmpdir))
+        packs.put('a', 'a/full/50,/0/default.jpg', write_file(tmpdir, 'tmp.jpg', data=b'first'))
+        packs.link('a/full/!50,50/0/default.jpg', 'a/full/50,/0/default.jpg')
+        packs.remove('a/full/50,/0/default.jpg')
+        assert packs.read('a/full/50,/0/default.jpg') is None
+        assert packs.lookup('a/full/!50,50/0/default.jpg') is None
+
+    def test_new_segment_is_started_when_full(self, tmpdir):
+        packs = img.PackStore(str(tmpdir), segment_bytes=8)
+        for size in (50, 60, 70):
+            packs.put('a', 'a/full/%d,/0/default.jpg' % size, write_file(tmpdir, 'tmp.jpg', data=b'x' * 5))
+        assert sorted(os.listdir(str(tmpdir.join('a')))) == ['.pack.0', '.pack.1']
+        assert packs.read('a/full/70,/0/default.jpg')[0] == b'x' * 5
+
+    def test_compaction_reclaims_removed_images(self, tmpdir):
+        packs = img.PackStore(str(tmpdir))
+        packs.put('a', 'a/full/50,/0/default.jpg', write_file(tmpdir, 'tmp.jpg', data=b'gone' * 10))
+        packs.put('a', 'a/full/60,/0/default.jpg', write_file(tmpdir, 'tmp.jpg', data=b'kept'))
+        packs.put('b', 'b/full/60,/0/default.jpg', write_file(tmpdir, 'tmp.jpg', data=b'all kept'))
+        packs.remove('a/full/50,/0/default.jpg')
+
+        assert packs.compact() == (1, 40)
+        assert os.listdir(str(tmpdir.join('a'))) == ['.pack.1']
+        assert packs.read('a/full/60,/0/default.jpg')[0] == b'kept'
+        assert packs.read('b/full/60,/0/default.jpg')[0] == b'all kept'
+
+    def test_image_cache_packs_small_images(self, tmpdir):
+        cache = img.ImageCache(cache_root=str(tmpdir), pack_max_item_bytes=10)
+        small = img.ImageRequest('id1', 'full', '!50,50', '0', 'default', 'jpg')
+        canonical_fp = cache.upsert(small, write_file(tmpdir, 'tmp.jpg', data=b'small'), make_info())
+        big = img.ImageRequest('id1', 'full', '60,', '0', 'default', 'jpg')
+        big_fp = cache.upsert(big, write_file(tmpdir, 'tmp.jpg', data=b'x' * 11), make_info())
+
+        assert not os.path.lexists(canonical_fp)
+        assert not os.path.lexists(cache.get_request_cache_path(small))
+        assert small in cache
+        assert cache[small][0] == canonical_fp
+        data, _, content_type = cache.get_from_packs(small)
+        assert (data, content_type) == (b'small', 'image/jpeg')
+        assert exists(big_fp)
+        assert cache.get_from_packs(big) is None
+
+        del cache[small]
+        assert small not in cache
+
+    def test_evicted_images_are_unpacked(self, tmpdir):
+        cache = img.ImageCache(cache_root=str(tmpdir), quota_bytes=8, pack_max_item_bytes=10)
+        first = img.ImageRequest('id1', 'full', '50,', '0', 'default', 'jpg')
+        cache.upsert(first, write_file(tmpdir, 'tmp.jpg', data=b'first'), make_info())
+        second = img.ImageRequest('id2', 'full', '50,', '0', 'default', 'jpg')
+        cache.upsert(second, write_file(tmpdir, 'tmp.jpg', data=b'second'), make_info())
+        assert first not in cache
+        assert second in cache
+        assert len(cache.packs) == 1
+
+
+class TestDerivativeIndex:
+
+    def _add(self, index, tmp, size, quality='default', generation=0, fmt='jpg'):
+        fp = join(tmp, '%s-%s.%s' % (size, quality, fmt))
+        open(fp, 'wb').close()
+        request = img.ImageRequest('id1', 'full', size, '0', quality, fmt)
+        index.add(request, make_info(1000, 750), fp, generation)
+        return fp
+
+    def _source_for(self, index, size, quality='default', region='full', rotation='0', fmt='jpg'):
+        request = img.ImageRequest('id1', region, size, rotation, quality, fmt)
+        return index.source_for(request, make_info(1000, 750))
+
+    def test_smallest_large_enough_derivative_is_the_source(self):
+        index = img.DerivativeIndex()
+        with tempfile.TemporaryDirectory() as tmp:
+            self._add(index, tmp, '800,')
+            fp_400 = self._add(index, tmp, '400,')
+            self._add(index, tmp, '100,')
+            assert self._source_for(index, '200,') == fp_400
+            assert self._source_for(index, '400,') == fp_400
+            assert self._source_for(index, '900,') is None
+
+    def test_derivatives_of_derivatives_are_not_sources(self):
+        index = img.DerivativeIndex()
+        with tempfile.TemporaryDirectory() as tmp:
+            fp_800 = self._add(index, tmp, '800,')
+            self._add(index, tmp, '400,', generation=1)
+            assert self._source_for(index, '200,') == fp_800
+
+    def test_quality_must_match(self):
+        index = img.DerivativeIndex()
+        with tempfile.TemporaryDirectory() as tmp:
+            self._add(index, tmp, '800,', quality='gray')
+            assert self._source_for(index, '200,') is None
+
+    def test_upscaled_derivative_is_not_a_source(self):
+        index = img.DerivativeIndex()
+        with tempfile.TemporaryDirectory() as tmp:
+            self._add(index, tmp, 'pct:150')
+            assert self._source_for(index, '900,') is None
+            assert 'id1' not in index._dict
+
+    @pytest.mark.parametrize('size', ['full', '1000,', ',750'])
+    def test_full_size_is_made_from_the_source(self, size):
+        index = img.DerivativeIndex()
+        with tempfile.TemporaryDirectory() as tmp:
+            self._add(index, tmp, 'full')
+            assert self._source_for(index, size) is None
+            assert self._source_for(index, '999,') is not None
+
+    @pytest.mark.parametrize('source_fmt, fmt, is_source', [
+        ('jpg', 'jpg', True),
+        ('png', 'jpg', True),
+        ('png', 'webp', True),
+        ('jpg', 'png', False),
+        ('gif', 'png', False),
+        ('webp', 'jpg', False),
+    ])
+    def test_source_format_must_match_or_be_lossless(self, source_fmt, fmt, is_source):
+        index = img.DerivativeIndex()
+        with tempfile.TemporaryDirectory() as tmp:
+            fp = self._add(index, tmp, '800,', fmt=source_fmt)
+            expected = fp if is_source else None
+            assert self._source_for(index, '200,', fmt=fmt) == expected
+
+    def test_removed_derivative_is_forgotten(self):
+        index = img.DerivativeIndex()
+        with tempfile.TemporaryDirectory() as tmp:
+            fp = self._add(index, tmp, '800,')
+        assert self._source_for(index, '200,') is None
+        assert fp not in index._dict['id1']
+
+    def test_least_recently_used_identifiers_are_dropped(self):
+        index = img.DerivativeIndex(size=1)
+        with tempfile.TemporaryDirectory() as tmp:
+            self._add(index, tmp, '800,')
+            other = img.ImageRequest('id2', 'full', '800,', '0', 'default', 'jpg')
+            index.add(other, make_info(1000, 750), join(tmp, 'other.jpg'))
+            assert list(index._dict) == ['id2']
+
+    @pytest.mark.parametrize('region, rotation', [
+        ('0,0,500,500', '0'),
+        ('full', '90'),
+        ('full', '!0'),
+    ])
+    def test_only_full_unrotated_requests_are_indexed(self, region, rotation):
+        request = img.ImageRequest('id1', region, '200,', rotation, 'default', 'jpg')
+        assert not img.DerivativeIndex.is_indexable(request, make_info(1000, 750))
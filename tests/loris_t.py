@@ -96,6 +96,19 @@ class LorisTest(unittest.TestCase):
         self.test_tiff_dims = (839,1080)
         self.test_tiff_sizes = []
 
+        self.test_tiff_pyramid_fp = path.join(self.test_img_dir, 'pyramid.tif')
+        self.test_tiff_pyramid_id = 'pyramid.tif'
+        self.test_tiff_pyramid_dims = (1000, 750)
+        self.test_tiff_pyramid_tiles = [
+            { "width": 128, "scaleFactors": [1,2,4,8] }
+        ]
+        self.test_tiff_pyramid_sizes = [
+            { "height": 94, "width": 125 },
+            { "height": 188, "width": 250 },
+            { "height": 375, "width": 500 },
+            { "height": 750, "width": 1000 }
+        ]
+
         self.test_png_fp = path.join(self.test_img_dir,'henneken.png')
         self.test_png_fp2 = path.join(self.test_img_dir2,'henneken.png')
         self.test_png_fmt = 'png'
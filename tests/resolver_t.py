@@ -8,14 +8,17 @@ from os.path import realpath
 from os.path import exists
 import tempfile
 import unittest
+from unittest import mock
 from urllib.parse import quote_plus, unquote
 
 import pytest
+import requests
 import responses
 
 from loris.loris_exception import ResolverException, ConfigError
 from loris.resolver import (
     _AbstractResolver,
+    NegativeCache,
     SimpleHTTPResolver,
     TemplateHTTPResolver,
     SourceImageCachingResolver,
@@ -114,6 +117,101 @@ class Test_SimpleFSResolver(loris_t.LorisTest):
             assert resolver.get_auth_rules(ident, source_fp) == {'rule': 1}
 
 
+class TestNegativeCache:
+
+    def test_entries_expire(self):
+        cache = NegativeCache(ttl=60)
+        with mock.patch('loris.resolver.time.monotonic', return_value=100):
+            cache.add('missing.jpg', 'Not found')
+            assert cache.get('missing.jpg') == 'Not found'
+        with mock.patch('loris.resolver.time.monotonic', return_value=160):
+            assert cache.get('missing.jpg') is None
+        assert len(cache) == 0
+        assert cache.metrics() == {'entries': 0, 'hits': 1, 'misses': 1}
+
+    def test_is_bounded(self):
+        cache = NegativeCache(ttl=60, size=2)
+        for ident in ('a.jpg', 'b.jpg', 'c.jpg'):
+            cache.add(ident, 'Not found')
+        assert cache.get('a.jpg') is None
+        assert cache.get('c.jpg') == 'Not found'
+
+    def test_unresolvable_idents_are_not_looked_up_again(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            resolver = SimpleFSResolver({
+                'src_img_root': tmp, 'negative_cache_ttl': 60
+            })
+            with mock.patch.object(
+                SimpleFSResolver, 'source_file_path', return_value=None
+            ) as source_file_path:
+                assert not resolver.check_resolvable('missing.jpg')
+                assert not resolver.check_resolvable('missing.jpg')
+                with pytest.raises(ResolverException):
+                    resolver.check_and_resolve(None, 'missing.jpg', '')
+            assert source_file_path.call_count == 1
+            assert resolver.unresolvable.metrics()['hits'] == 2
+
+    def test_resolve_failures_are_cached(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            resolver = SimpleFSResolver({
+                'src_img_root': tmp, 'negative_cache_ttl': 60
+            })
+            with pytest.raises(ResolverException) as first:
+                resolver.check_and_resolve(None, 'missing.jpg', '')
+            with pytest.raises(ResolverException) as second:
+                resolver.check_and_resolve(None, 'missing.jpg', '')
+            assert str(first.value) == str(second.value)
+            assert resolver.unresolvable.metrics()['hits'] == 1
+
+            resolver.source_appeared('missing.jpg')
+            assert len(resolver.unresolvable) == 0
+
+    def test_source_that_appears_is_found_at_once(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            resolver = SimpleFSResolver({
+                'src_img_root': tmp, 'negative_cache_ttl': 60
+            })
+            with pytest.raises(ResolverException):
+                resolver.check_and_resolve(None, '01/02/missing.jpg', '')
+            assert not resolver.check_resolvable('01/02/missing.jpg')
+
+            os.makedirs(join(tmp, '01', '02'))
+            with open(join(tmp, '01', '02', 'missing.jpg'), 'wb') as f:
+                f.write(b'jpg')
+            assert resolver.check_resolvable('01/02/missing.jpg')
+            info = resolver.check_and_resolve(None, '01/02/missing.jpg', '')
+            assert info.src_img_fp == join(tmp, '01', '02', 'missing.jpg')
+
+    def test_source_that_appears_in_source_image_cache_root_is_found(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            resolver = SourceImageCachingResolver({
+                'source_root': join(tmp, 'src'),
+                'cache_root': join(tmp, 'cache'),
+                'negative_cache_ttl': 60,
+            })
+            os.makedirs(join(tmp, 'src'))
+            with pytest.raises(ResolverException):
+                resolver.check_and_resolve(None, 'missing.jpg', '')
+            open(join(tmp, 'src', 'missing.jpg'), 'wb').close()
+            info = resolver.check_and_resolve(None, 'missing.jpg', '')
+            assert info.src_img_fp == join(tmp, 'cache', 'missing.jpg')
+
+    def test_other_failures_are_not_cached(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            resolver = SimpleFSResolver({
+                'src_img_root': tmp, 'negative_cache_ttl': 60
+            })
+            open(join(tmp, 'noextension'), 'wb').close()
+            with pytest.raises(ResolverException):
+                resolver.check_and_resolve(None, 'noextension', '')
+            assert len(resolver.unresolvable) == 0
+
+    def test_is_off_by_default(self):
+        resolver = SimpleFSResolver({'src_img_root': '/var/loris/img'})
+        assert resolver.unresolvable is None
+        assert not resolver.check_resolvable('missing.jpg')
+
+
 class Test_SourceImageCachingResolver(loris_t.LorisTest):
 
     def test_source_image_caching_resolver(self):
@@ -489,6 +587,47 @@ class TestSimpleHTTPResolver(object):
         resolver = SimpleHTTPResolver(config=config)
         assert resolver.is_resolvable(ident=ident) == expected_resolvable
 
+    @responses.activate
+    @pytest.mark.parametrize('status, cached', [
+        (404, True),
+        (410, True),
+        (500, False),
+        (503, False),
+    ])
+    def test_only_missing_sources_are_negatively_cached(self, status, cached):
+        responses.add(responses.HEAD, 'http://sample.sample/0005', status=status)
+        responses.add(responses.GET, 'http://sample.sample/0005', status=status)
+        with tempfile.TemporaryDirectory() as tmp:
+            resolver = SimpleHTTPResolver({
+                'cache_root': tmp,
+                'source_prefix': 'http://sample.sample/',
+                'head_resolvable': True,
+                'negative_cache_ttl': 60,
+            })
+            assert not resolver.check_resolvable('0005')
+            assert (len(resolver.unresolvable) == 1) == cached
+            resolver.unresolvable.discard('0005')
+
+            with pytest.raises(ResolverException):
+                resolver.check_and_resolve(None, '0005', '')
+            assert (len(resolver.unresolvable) == 1) == cached
+
+    @responses.activate
+    def test_connection_errors_are_not_negatively_cached(self):
+        responses.add(
+            responses.HEAD, 'http://sample.sample/0005',
+            body=requests.ConnectionError('refused')
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            resolver = SimpleHTTPResolver({
+                'cache_root': tmp,
+                'source_prefix': 'http://sample.sample/',
+                'head_resolvable': True,
+                'negative_cache_ttl': 60,
+            })
+            assert not resolver.check_resolvable('0005')
+            assert len(resolver.unresolvable) == 0
+
     @pytest.mark.parametrize('head_resolvable', [True, False])
     def test_non_http_rejected_as_not_resolvable(self, head_resolvable):
         config = {
@@ -515,6 +654,48 @@ class TestSimpleHTTPResolver(object):
         resolver = SimpleHTTPResolver(config=config)
         assert resolver.is_resolvable(ident=ident) == expected_resolvable
 
+    @responses.activate
+    def test_requests_share_a_pooled_session(self, mock_responses):
+        config = {
+            'cache_root': '/var/cache/loris',
+            'source_prefix': 'http://sample.sample/',
+            'head_resolvable': True,
+            'pool_size': 4,
+            'retries': 2,
+            'keep_alive': False,
+        }
+        resolver = SimpleHTTPResolver(config=config)
+        assert resolver.is_resolvable(ident='0001')
+        session = resolver._session('0001')
+        assert resolver._session('0004') is session
+
+        adapter = session.get_adapter('http://sample.sample/')
+        assert adapter._pool_maxsize == 4
+        assert adapter.max_retries.total == 2
+        assert session.headers['Connection'] == 'close'
+
+        # Forked workers make their own.
+        with mock.patch('loris.resolver.os.getpid', return_value=-1):
+            assert resolver._session('0001') is not session
+
+    def test_requests_have_timeouts(self):
+        config = {
+            'cache_root': '/var/cache/loris',
+            'source_prefix': 'http://sample.sample/',
+            'head_resolvable': True,
+            'connect_timeout': 2,
+            'read_timeout': 30,
+        }
+        resolver = SimpleHTTPResolver(config=config)
+        with mock.patch.object(requests.Session, 'head') as head:
+            resolver.is_resolvable(ident='0001')
+        assert head.call_args[1]['timeout'] == (2, 30)
+
+        with mock.patch.object(
+            requests.Session, 'head', side_effect=requests.ReadTimeout()
+        ):
+            assert not resolver.is_resolvable(ident='0001')
+
 
 class Test_TemplateHTTPResolver(object):
 
@@ -620,6 +801,11 @@ class Test_TemplateHTTPResolver(object):
         _, options = resolver._web_request_url('a:id1.jpg')
         assert options == expected_options
 
+    def test_each_template_has_a_session(self):
+        resolver = TemplateHTTPResolver(copy.deepcopy(self.config))
+        assert resolver._session('a:foo.jpg') is resolver._session('a:bar.jpg')
+        assert resolver._session('a:foo.jpg') is not resolver._session('b:foo.jpg')
+
     @responses.activate
     @pytest.mark.parametrize('ident, expected_resolvable', [
         ('sample:0001', True),
@@ -0,0 +1,141 @@
+import os
+from os import path
+import struct
+
+from PIL import Image, ImageChops, TiffTags
+from PIL.TiffImagePlugin import ImageFileDirectory_v2
+import pytest
+
+from loris import tiff_pyramid
+from loris.tiff_pyramid import TiffPyramid
+
+IMG_DIR = path.join(path.abspath(path.dirname(__file__)), 'img')
+PYRAMID_FP = path.join(IMG_DIR, 'pyramid.tif')
+
+
+@pytest.fixture
+def pyramid():
+    return TiffPyramid.from_file(PYRAMID_FP)
+
+
+def write_tiled_tiff(fp, im, tile_size, prefix, tags):
+    """Write im as an uncompressed, single level, tiled TIFF."""
+    tiles = []
+    for y in range(0, im.height, tile_size):
+        for x in range(0, im.width, tile_size):
+            tiles.append(im.crop((x, y, x + tile_size, y + tile_size)).tobytes())
+    ifd = ImageFileDirectory_v2(prefix=prefix)
+    for tag, value in tags.items():
+        ifd[tag] = value
+    ifd[256], ifd[257] = im.size
+    ifd[259] = 1
+    ifd[277] = 1
+    ifd[322] = ifd[323] = tile_size
+    for tag in (324, 325):
+        ifd.tagtype[tag] = TiffTags.LONG
+    ifd[325] = tuple(len(tile) for tile in tiles)
+    ifd[324] = (0,) * len(tiles)
+    data_offset = 8 + len(ifd.tobytes(8))
+    ifd[324] = tuple(data_offset + sum(ifd[325][:n]) for n in range(len(tiles)))
+    endian = '>' if prefix == b'MM' else '<'
+    magic = b'MM\x00*' if prefix == b'MM' else b'II*\x00'
+    with open(fp, 'wb') as f:
+        f.write(magic + struct.pack(endian + 'L', 8) + ifd.tobytes(8) + b''.join(tiles))
+
+
+class TestTiffPyramid(object):
+
+    def test_levels_are_largest_first(self, pyramid):
+        sizes = [(level.width, level.height) for level in pyramid.levels]
+        assert sizes == [(1000, 750), (500, 375), (250, 188), (125, 94)]
+        assert pyramid.scale_factors == [1, 2, 4, 8]
+
+    def test_untiled_tiff_is_not_a_pyramid(self):
+        fp = path.join(IMG_DIR, '01', '04', '0001.tif')
+        assert TiffPyramid.from_file(fp) is None
+
+    @pytest.mark.parametrize('region, size, expected_width', [
+        ((1000, 750), (1000, 750), 1000),
+        ((1000, 750), (600, 450), 1000),
+        ((1000, 750), (500, 375), 500),
+        ((1000, 750), (100, 75), 125),
+        ((1000, 750), (2000, 1500), 1000),
+        ((256, 256), (128, 128), 500),
+        ((1024, 752), (128, 94), 125),
+    ])
+    def test_level_for(self, pyramid, region, size, expected_width):
+        level = pyramid.level_for(region[0], region[1], size[0], size[1])
+        assert level.width == expected_width
+
+    @pytest.mark.parametrize('box', [
+        (0, 0, 1000, 750),
+        (300, 200, 700, 500),
+        (900, 700, 1000, 750),
+        (128, 128, 256, 256),
+    ])
+    def test_read_region_matches_full_decode(self, pyramid, box):
+        full = Image.open(PYRAMID_FP)
+        region = pyramid.read_region(pyramid.levels[0], box)
+        expected = full.crop(box)
+        assert region.size == expected.size
+        assert ImageChops.difference(region, expected).getbbox() is None
+
+    def test_read_region_from_reduced_level(self, pyramid):
+        level = pyramid.levels[2]
+        region = pyramid.read_region(level, (0, 0, 1000, 750))
+        assert region.size == (250, 188)
+
+    def test_tile_boxes_are_the_intersecting_tiles(self, pyramid):
+        level = pyramid.levels[0]
+        tiles = list(level.tile_boxes((300, 200, 400, 250)))
+        assert [t[0] for t in tiles] == [(2, 1), (3, 1)]
+
+    def test_big_endian_samples(self, tmpdir):
+        fp = str(tmpdir.join('big-endian.tif'))
+        im = Image.new('I;16B', (40, 30))
+        im.frombytes(struct.pack('>1200H', *((n * 37) % 65536 for n in range(1200))))
+        write_tiled_tiff(fp, im, 16, b'MM', {258: 16, 262: 1})
+        pyramid = TiffPyramid.from_file(fp)
+        region = pyramid.read_region(pyramid.levels[0], (5, 5, 35, 25))
+        assert list(region.getdata()) == list(im.crop((5, 5, 35, 25)).getdata())
+
+    def test_palette_is_kept(self, tmpdir):
+        fp = str(tmpdir.join('palette.tif'))
+        im = Image.new('P', (40, 30))
+        im.putdata([n % 4 for n in range(1200)])
+        colours = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 255)]
+        im.putpalette([c for colour in colours for c in colour])
+        colour_map = tuple(
+            [colours[i][c] * 257 if i < 4 else 0 for c in range(3) for i in range(256)]
+        )
+        write_tiled_tiff(fp, im, 16, b'II', {258: 8, 262: 3, 320: colour_map})
+        pyramid = TiffPyramid.from_file(fp)
+        region = pyramid.read_region(pyramid.levels[0], (0, 0, 40, 30))
+        assert region.mode == 'P'
+        assert list(region.convert('RGB').getdata()) == list(im.convert('RGB').getdata())
+
+
+class TestOpen(object):
+
+    def test_pyramid_is_parsed_once(self):
+        first = TiffPyramid.open(PYRAMID_FP)
+        assert TiffPyramid.open(PYRAMID_FP) is first
+
+    def test_pyramid_is_parsed_again_when_the_file_changes(self, tmpdir):
+        fp = str(tmpdir.join('pyramid.tif'))
+        with open(PYRAMID_FP, 'rb') as src, open(fp, 'wb') as dst:
+            dst.write(src.read())
+        first = TiffPyramid.open(fp)
+        stat_result = os.stat(fp)
+        os.utime(fp, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns + 10**9))
+        second = TiffPyramid.open(fp)
+        assert second is not first
+        assert second.scale_factors == first.scale_factors
+
+    def test_only_the_most_recent_files_are_kept(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(tiff_pyramid, 'PYRAMID_CACHE_SIZE', 1)
+        fp = str(tmpdir.join('untiled.tif'))
+        Image.new('L', (10, 10)).save(fp)
+        first = TiffPyramid.open(PYRAMID_FP)
+        assert TiffPyramid.open(fp) is None
+        assert TiffPyramid.open(PYRAMID_FP) is not first
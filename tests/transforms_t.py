@@ -1,12 +1,20 @@
+from io import BytesIO
 import unittest
 import operator
+from os import path
+import subprocess
+import tempfile
+import time
+import unittest.mock
 
 import pytest
-from PIL import Image
+from PIL import Image, ImageChops, ImageCms, ImageFile, ImageOps, ImageStat, JpegImagePlugin
 
-from loris import transforms
+from loris import img_info, transforms
+from loris.img import ImageRequest
 from loris.loris_exception import ConfigError
-from loris.webapp import get_debug_config
+from loris.utils import icc_profile_digest
+from loris.webapp import get_debug_config, Loris
 from tests import loris_t
 
 
@@ -104,6 +112,114 @@ class Test_AbstractTransformer(object):
         assert 'you need to install Pillow with LittleCMS support' in str(err.value)
 
 
+class TestEncoderProfiles:
+
+    def _transformer(self, encoders=None):
+        config = {
+            'target_formats': ['jpg', 'png'],
+            'dither_bitonal_images': False,
+            'encoders': encoders,
+        }
+        return transforms.PNG_Transformer(config)
+
+    def test_defaults(self):
+        transformer = self._transformer()
+        assert transformer.encoder_options('jpg', 1000) == {'quality': 90}
+        assert transformer.encoder_options('png', 10 ** 9) == {'optimize': True, 'bits': 256}
+        assert transformer.encoder_options('tif', 1000) == {'compression': 'None'}
+
+    @pytest.mark.parametrize('pixels, expected', [
+        (100, {'optimize': True}),
+        (1024, {'optimize': True}),
+        (1025, {'compress_level': 3}),
+        (10 ** 9, {'compress_level': 1}),
+    ])
+    def test_first_matching_size_class(self, pixels, expected):
+        transformer = self._transformer({'png': [
+            (1024, {'optimize': True}),
+            (1000000, {'compress_level': 3}),
+            (None, {'compress_level': 1}),
+        ]})
+        assert transformer.encoder_options('png', pixels) == expected
+        # Other formats keep their defaults
+        assert transformer.encoder_options('jpg', pixels) == {'quality': 90}
+
+    def test_no_matching_size_class_is_no_options(self):
+        transformer = self._transformer({'webp': [(1024, {'method': 6})]})
+        assert transformer.encoder_options('webp', 2048) == {}
+
+    def test_bad_profile_is_configerror(self):
+        with pytest.raises(ConfigError):
+            self._transformer({'png': {'compress_level': 1}})
+
+    def test_encoders_section_is_not_a_source_format(self):
+        config = get_debug_config('kdu')
+        config['transforms']['encoders'] = {'jpg': [(None, {'quality': 75})]}
+        app = Loris(config)
+        assert 'encoders' not in app.transformers
+        assert app.transformers['png'].encoder_options('jpg', 100) == {'quality': 75}
+
+
+class TestColorTransformCache:
+
+    ICC_DIR = path.join(path.dirname(path.abspath(__file__)), 'icc')
+    IMG_DIR = path.join(path.dirname(path.abspath(__file__)), 'img')
+
+    def _image_with_profile(self):
+        im = Image.open(path.join(self.IMG_DIR, 'jpeg_with_p3_profile.jpg'))
+        return im, im.info['icc_profile']
+
+    def _cache(self, size=64):
+        return transforms.ColorTransformCache(
+            path.join(self.ICC_DIR, 'sRGB2014.icc'), size=size
+        )
+
+    def test_matches_profile_to_profile(self):
+        im, profile_bytes = self._image_with_profile()
+        expected = ImageCms.profileToProfile(
+            im, BytesIO(profile_bytes), path.join(self.ICC_DIR, 'sRGB2014.icc')
+        )
+        transform = self._cache().get(profile_bytes, im.mode, im.mode)
+        assert ImageChops.difference(transform.apply(im), expected).getbbox() is None
+
+    def test_transform_is_reused(self):
+        im, profile_bytes = self._image_with_profile()
+        cache = self._cache()
+        first = cache.get(profile_bytes, 'RGB', 'RGB')
+        digest = icc_profile_digest(profile_bytes)
+        assert cache.get(profile_bytes, 'RGB', 'RGB', digest=digest) is first
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_modes_are_part_of_the_key(self):
+        im, profile_bytes = self._image_with_profile()
+        cache = self._cache()
+        cache.get(profile_bytes, 'RGB', 'RGB')
+        cache.get(profile_bytes, 'RGB', 'RGBA')
+        assert (len(cache), cache.misses) == (2, 2)
+
+    def test_least_recently_used_transform_is_dropped(self):
+        im, profile_bytes = self._image_with_profile()
+        cache = self._cache(size=1)
+        cache.get(profile_bytes, 'RGB', 'RGB')
+        cache.get(profile_bytes, 'RGB', 'RGBA')
+        cache.get(profile_bytes, 'RGB', 'RGB')
+        assert (len(cache), cache.hits, cache.misses) == (1, 0, 3)
+
+
+class TestTransposeMethods:
+
+    @pytest.mark.parametrize('mirror, rotation', sorted(transforms.TRANSPOSE_METHODS))
+    def test_transpose_matches_mirror_then_rotate(self, mirror, rotation):
+        im = Image.effect_noise((37, 23), 50).convert('RGB')
+        expected = ImageOps.mirror(im) if mirror else im
+        expected = expected.rotate(-rotation, expand=True)
+
+        method = transforms.TRANSPOSE_METHODS[(mirror, rotation)]
+        transposed = im.transpose(method) if method is not None else im
+        assert transposed.size == expected.size
+        assert ImageChops.difference(transposed, expected).getbbox() is None
+
+
 class UnitTest_KakaduJP2Transformer(unittest.TestCase):
 
     def test_init(self):
@@ -116,6 +232,223 @@ class UnitTest_KakaduJP2Transformer(unittest.TestCase):
         kdu_transformer = transforms.KakaduJP2Transformer(config)
         self.assertEqual(kdu_transformer.transform_timeout, 100)
 
+    def test_stream_decoder_output_is_off_by_default(self):
+        config = {'kdu_expand': '', 'num_threads': 4, 'kdu_libs': '',
+                  'map_profile_to_srgb': False, 'tmp_dp': '/tmp/loris/tmp',
+                  'srgb_profile_fp': '', 'target_formats': [], 'dither_bitonal_images': ''}
+        kdu_transformer = transforms.KakaduJP2Transformer(config)
+        self.assertFalse(kdu_transformer.stream_decoder_output)
+        config['stream_decoder_output'] = True
+        kdu_transformer = transforms.KakaduJP2Transformer(config)
+        self.assertTrue(kdu_transformer.stream_decoder_output)
+
+
+class Test_JP2ReduceArg:
+
+    def _reduce_arg(self, region, size):
+        transformer = transforms.OPJ_JP2Transformer({
+            'opj_decompress': '', 'tmp_dp': '/tmp/loris/tmp',
+            'target_formats': [], 'dither_bitonal_images': '',
+        })
+        info = img_info.ImageInfo()
+        info.width = 8192
+        info.height = 8192
+        info.tiles = [{'width': 256, 'scaleFactors': [1, 2, 4, 8, 16, 32]}]
+        image_request = ImageRequest('id1', region, size, '0', 'default', 'jpg')
+        return transformer._scales_to_reduce_arg(image_request, info)
+
+    @pytest.mark.parametrize('region, size, expected', [
+        ('full', '1024,', '3'),
+        ('full', '1000,', '3'),
+        ('full', 'full', '0'),
+        ('0,0,4096,4096', '512,', '3'),
+        ('0,0,4096,4096', '500,', '3'),
+        ('0,0,4096,4096', '600,', '2'),
+        ('4096,4096,1024,1024', '256,', '2'),
+        ('0,0,4096,4096', 'full', '0'),
+        ('0,0,512,512', '1024,', '0'),
+        ('pct:0,0,50,50', '128,', '5'),
+        # 1,1,1023,1023 is only 255 pixels wide at 1/4
+        ('1,1,1023,1023', '256,', '1'),
+        ('4,4,1024,1024', '256,', '2'),
+    ])
+    def test_reduce_arg_uses_region_size(self, region, size, expected):
+        assert self._reduce_arg(region, size) == expected
+
+    def test_no_scales_is_no_reduce_arg(self):
+        transformer = transforms.OPJ_JP2Transformer({
+            'opj_decompress': '', 'tmp_dp': '/tmp/loris/tmp',
+            'target_formats': [], 'dither_bitonal_images': '',
+        })
+        info = img_info.ImageInfo()
+        info.width = 8192
+        info.height = 8192
+        info.tiles = []
+        image_request = ImageRequest('id1', '0,0,4096,4096', '512,', '0', 'default', 'jpg')
+        assert transformer._scales_to_reduce_arg(image_request, info) is None
+
+
+class Test_DeriveWithPil:
+    '''The region and size are applied the way cropping and then resizing
+    would, whatever the mode of the image.'''
+
+    # Gray images resized as one channel may differ from resizing the colour
+    # image and converting it by this much, from rounding between steps.
+    GRAY_TOLERANCE = 4
+
+    def _derive(self, im, region, size, quality):
+        info = img_info.ImageInfo()
+        info.width, info.height = im.size
+        transformer = transforms.JPG_Transformer({
+            'target_formats': ['png'], 'dither_bitonal_images': False,
+        })
+        image_request = ImageRequest('id1', region, size, '0', quality, 'png')
+        out = BytesIO()
+        transformer._derive_with_pil(im, out, image_request, info)
+        return Image.open(out)
+
+    def _noise(self, mode):
+        # High contrast everywhere, so blending in pixels from outside the
+        # region would show.
+        im = Image.effect_noise((160, 120), 100).convert('RGB')
+        im = Image.merge('RGB', (im.getchannel(0), im.rotate(90).getchannel(0),
+            im.transpose(Image.FLIP_LEFT_RIGHT).getchannel(0)))
+        if mode == 'P':
+            return im.convert('P', palette=Image.ADAPTIVE)
+        return im.convert(mode)
+
+    @pytest.mark.parametrize('mode', ['RGB', 'L', 'CMYK', 'YCbCr', 'P', 'RGBA'])
+    @pytest.mark.parametrize('region, size, box', [
+        ('7,3,101,77', '23,', (7, 3, 108, 80)),
+        ('full', '40,', (0, 0, 160, 120)),
+    ])
+    def test_default_matches_crop_then_resize(self, mode, region, size, box):
+        im = self._noise(mode)
+        image = self._derive(im, region, size, 'default')
+        expected = im.crop(box)
+        expected = expected.resize(image.size, Image.LANCZOS)
+        expected = expected.convert(image.mode)
+        assert ImageChops.difference(image, expected).getbbox() is None
+
+    @pytest.mark.parametrize('mode', ['RGB', 'CMYK', 'YCbCr', 'P'])
+    def test_gray_matches_crop_then_resize(self, mode):
+        im = self._noise(mode)
+        image = self._derive(im, '7,3,101,77', '23,', 'gray')
+        expected = im.crop((7, 3, 108, 80)).resize(image.size, Image.LANCZOS)
+        expected = expected.convert('L')
+        assert ImageChops.difference(image, expected).getextrema()[1] <= self.GRAY_TOLERANCE
+
+
+class Test_JPGDraftScale:
+
+    @pytest.mark.parametrize('region, size, expected_scale', [
+        ('full', 'full', 1),
+        ('full', '1800,', 2),
+        ('full', '1000,', 2),
+        ('full', '900,', 4),
+        ('full', '200,', 8),
+        ('full', '5000,', 1),
+        ('0,0,1000,1000', '250,', 4),
+        ('0,0,1000,500', '300,300', 1),
+    ])
+    def test_jpeg_draft_scale(self, region, size, expected_scale):
+        info = img_info.ImageInfo()
+        info.width = 3600
+        info.height = 2987
+        image_request = ImageRequest('id1', region, size, '0', 'default', 'jpg')
+        transformer = transforms.JPG_Transformer({
+            'target_formats': [], 'dither_bitonal_images': '',
+        })
+        assert transformer._draft_scale(image_request, info) == expected_scale
+
+    @pytest.mark.parametrize('full_size, draft_size, expected_scale', [
+        ((3600, 2987), (3600, 2987), 1),
+        ((3600, 2987), (1800, 1494), 2),
+        ((3600, 2987), (450, 374), 8),
+        ((1001, 7), (126, 1), 8),
+    ])
+    def test_dct_scale(self, full_size, draft_size, expected_scale):
+        assert transforms._dct_scale(full_size, draft_size) == expected_scale
+
+    def test_region_box_is_not_rounded(self, tmpdir):
+        src_fp = str(tmpdir.join('src.jpg'))
+        Image.new('RGB', (3600, 2987)).save(src_fp)
+        info = img_info.ImageInfo()
+        info.src_img_fp = src_fp
+        info.width = 3600
+        info.height = 2987
+        image_request = ImageRequest('id1', '101,201,1500,1000', '150,', '0', 'default', 'jpg')
+        transformer = transforms.JPG_Transformer({
+            'target_formats': [], 'dither_bitonal_images': '',
+        })
+
+        # Pillow before 7.0 returns the image from draft(), rather than
+        # the mode and box.
+        draft = JpegImagePlugin.JpegImageFile.draft
+
+        def draft_returning_image(im, mode, size):
+            draft(im, mode, size)
+            return im
+
+        with unittest.mock.patch.object(
+            JpegImagePlugin.JpegImageFile, 'draft', draft_returning_image
+        ):
+            im, box = transformer._decode_region(image_request, info)
+
+        assert im.size == (450, 374)
+        assert box == (101 / 8, 201 / 8, 1601 / 8, 1201 / 8)
+
+
+class UnitTest_JP2DecodeToFifo(unittest.TestCase):
+    # `cp` stands in for the decoder here: like kdu_expand and
+    # opj_decompress, it just writes a BMP to the path it's given.
+
+    def setUp(self):
+        self.transformer = transforms.OPJ_JP2Transformer({
+            'opj_decompress': '', 'tmp_dp': '/tmp/loris/tmp',
+            'target_formats': [], 'dither_bitonal_images': '',
+            'stream_decoder_output': True,
+        })
+
+    def test_decoder_output_is_parsed_from_fifo(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            src_fp = path.join(tmp, 'src.bmp')
+            expected = Image.new('RGB', (40, 30), (255, 0, 0))
+            expected.paste((0, 0, 255), (0, 0, 20, 10))
+            expected.save(src_fp)
+            fifo_fp = path.join(tmp, 'image.bmp')
+
+            im = self.transformer._decode_to_fifo('cp %s %s' % (src_fp, fifo_fp), fifo_fp)
+
+            assert im.size == (40, 30)
+            assert im.getpixel((0, 0)) == (0, 0, 255)
+            assert im.getpixel((39, 29)) == (255, 0, 0)
+
+    def test_decoder_error_is_raised(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fifo_fp = path.join(tmp, 'image.bmp')
+            missing_fp = path.join(tmp, 'missing.bmp')
+            with pytest.raises(subprocess.CalledProcessError) as err:
+                self.transformer._decode_to_fifo('cp %s %s' % (missing_fp, fifo_fp), fifo_fp)
+            assert b'missing.bmp' in err.value.stderr
+
+    def test_decoder_that_exits_without_opening_the_fifo_is_raised(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fifo_fp = path.join(tmp, 'image.bmp')
+            # Give the decoder time to exit before we start reading.
+            with unittest.mock.patch.object(
+                transforms, 'Parser',
+                side_effect=lambda: time.sleep(0.5) or ImageFile.Parser()
+            ):
+                with pytest.raises(subprocess.CalledProcessError):
+                    self.transformer._decode_to_fifo('false', fifo_fp)
+
+    def test_decoder_that_exits_immediately_is_raised(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fifo_fp = path.join(tmp, 'image.bmp')
+            with pytest.raises(subprocess.CalledProcessError):
+                self.transformer._decode_to_fifo('false', fifo_fp)
+
 
 class Test_KakaduJP2Transformer(loris_t.LorisTest,
                                 ColorConversionMixin,
@@ -142,6 +475,16 @@ class Test_KakaduJP2Transformer(loris_t.LorisTest,
             debug_config='kdu'
         )
 
+    def test_unaligned_region_is_not_upsampled(self):
+        ident = self.test_jp2_color_id
+        request_path = '/%s/1,1,1023,1023/256,/0/default.jpg' % (ident,)
+        with unittest.mock.patch.object(
+            transforms.KakaduJP2Transformer, '_derive_from_decoded'
+        ) as derive:
+            self.request_image_from_client(request_path)
+        decoded = derive.call_args[0][0]
+        assert decoded.size[0] >= 256 and decoded.size[1] >= 256
+
     def test_kdu_expand_error(self):
         config = get_debug_config('kdu')
         config['transforms']['jp2']['kdu_expand'] = 'lorisrandomzzz/kdu_expand'
@@ -153,6 +496,18 @@ class Test_KakaduJP2Transformer(loris_t.LorisTest,
         assert response.status_code == 500
         assert 'Server Side Error: error generating derivative image: see log (500)' in response.data.decode('utf8')
 
+    def test_streamed_decode_matches_temp_file_decode(self):
+        request_path = '/%s/full/300,/0/default.png' % self.ident
+        image_orig = self.request_image_from_client(request_path)
+
+        config = get_debug_config('kdu')
+        config['transforms']['jp2']['stream_decoder_output'] = True
+        config['loris.Loris']['enable_caching'] = False
+        self.build_client_from_config(config)
+        image_streamed = self.request_image_from_client(request_path)
+
+        self.assertEqual(image_orig.histogram(), image_streamed.histogram())
+
 
 class Test_OPJ_JP2Transformer(loris_t.LorisTest, ColorConversionMixin):
 
@@ -183,6 +538,138 @@ class Test_OPJ_JP2Transformer(loris_t.LorisTest, ColorConversionMixin):
         assert response.status_code == 500
         assert 'Server Side Error: error generating derivative image: see log (500)' in response.data.decode('utf8')
 
+    def test_streamed_decode_matches_temp_file_decode(self):
+        config = get_debug_config('opj')
+        self.build_client_from_config(config)
+        request_path = '/%s/full/300,/0/default.png' % self.ident
+        image_orig = self.request_image_from_client(request_path)
+
+        config = get_debug_config('opj')
+        config['transforms']['jp2']['stream_decoder_output'] = True
+        config['loris.Loris']['enable_caching'] = False
+        self.build_client_from_config(config)
+        image_streamed = self.request_image_from_client(request_path)
+
+        self.assertEqual(image_orig.histogram(), image_streamed.histogram())
+
+
+class Test_PillowJP2Transformer(loris_t.LorisTest,
+                                ColorConversionMixin,
+                                _ResizingTestMixin):
+
+    def setUp(self):
+        super(Test_PillowJP2Transformer, self).setUp()
+        self.build_client_from_config(get_debug_config('pillow'))
+        self.ident = self.test_jp2_gray_id
+
+    def test_debug_config_gives_pillow_transformer(self):
+        assert isinstance(self.app.transformers['jp2'], transforms.PillowJP2Transformer)
+
+    def test_reduced_full_region_has_requested_size(self):
+        # 2477 / 4 isn't a whole number of pixels, which catches any
+        # disagreement with OpenJPEG about rounding the reduced size.
+        request_path = '/%s/full/620,/0/default.jpg' % self.ident
+        image = self.request_image_from_client(request_path)
+        assert image.size == (620, 800)
+
+    def test_pillow_reduce_level_agrees_with_openjpeg_rounding(self):
+        transformer = self.app.transformers['jp2']
+        # 2477 / 4 = 619.25: Pillow may make it 619, OpenJPEG 620
+        assert transformer._pillow_reduce_level((2477, 3200), 2) == 1
+        assert transformer._pillow_reduce_level((2477, 3200), 1) == 1
+        assert transformer._pillow_reduce_level((1024, 1024), 3) == 3
+
+    def test_region_matches_full_image_crop(self):
+        # Both at 1/2, which is decoded exactly.
+        full = self.request_image_from_client('/%s/full/1239,/0/default.png' % self.ident)
+        region = self.request_image_from_client('/%s/1024,1024,1024,1024/512,/0/default.png' % self.ident)
+        assert region.size == (512, 512)
+        assert region.histogram() == full.crop((512, 512, 1024, 1024)).histogram()
+
+    def test_full_resolution_region_uses_opj_decompress_if_configured(self):
+        config = dict(self.app.transformers['jp2'].config)
+        config['opj_decompress'] = '/usr/bin/opj_decompress'
+        transformer = transforms.PillowJP2Transformer(config)
+        info = img_info.ImageInfo(
+            app=self.app, src_img_fp=self.test_jp2_gray_fp, src_format='jp2'
+        )
+        region = ImageRequest('gray.jp2', '0,0,256,256', 'full', '0', 'default', 'jpg')
+        reduced = ImageRequest('gray.jp2', 'full', '620,', '0', 'default', 'jpg')
+        with unittest.mock.patch.object(transformer.region_transformer, '_decode') as decode:
+            transformer._decode(region, info)
+            assert decode.call_count == 1
+            transformer._decode(reduced, info)
+            assert decode.call_count == 1
+
+    def test_region_at_image_edge(self):
+        request_path = '/%s/2000,3000,477,200/full/0/default.jpg' % self.ident
+        image = self.request_image_from_client(request_path)
+        assert image.size == (477, 200)
+
+    def test_can_edit_embedded_color_profile(self):
+        self._assert_can_edit_embedded_color_profile(
+            ident=self.test_jp2_with_embedded_profile_id,
+            transformer='jp2',
+            debug_config='pillow'
+        )
+
+    def test_transform_sizes(self):
+        transformer = self.app.transformers['jp2']
+        info = img_info.ImageInfo(
+            app=self.app, src_img_fp=self.test_jp2_gray_fp, src_format='jp2'
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            targets = [
+                (path.join(tmp, '%d.jpg' % size['width']),
+                 ImageRequest('gray.jp2', 'full', '%d,' % size['width'], '0', 'default', 'jpg'))
+                for size in self.test_jp2_gray_sizes[:4]
+            ]
+            transformer.transform_sizes(targets, info)
+            for target_fp, image_request in targets:
+                assert Image.open(target_fp).size[0] == int(image_request.size_value[:-1])
+
+
+class Test_TIFPyramidTransformer(loris_t.LorisTest, _ResizingTestMixin):
+
+    def setUp(self):
+        super(Test_TIFPyramidTransformer, self).setUp()
+        self.ident = self.test_tiff_pyramid_id
+
+    def _request_without_pyramid(self, request_path):
+        config = get_debug_config('kdu')
+        config['transforms']['tif']['tiff_pyramids'] = False
+        config['loris.Loris']['enable_caching'] = False
+        self.build_client_from_config(config)
+        return self.request_image_from_client(request_path)
+
+    def test_full_size_matches_full_decode(self):
+        request_path = '/%s/full/full/0/default.png' % self.ident
+        image = self.request_image_from_client(request_path)
+        expected = self._request_without_pyramid(request_path)
+        assert ImageChops.difference(image, expected).getbbox() is None
+
+    def test_region_matches_full_decode(self):
+        request_path = '/%s/300,200,400,300/full/0/default.png' % self.ident
+        image = self.request_image_from_client(request_path)
+        expected = self._request_without_pyramid(request_path)
+        assert ImageChops.difference(image, expected).getbbox() is None
+
+    def test_reduced_tile_from_smaller_level(self):
+        request_path = '/%s/512,512,488,238/61,/0/default.jpg' % self.ident
+        image = self.request_image_from_client(request_path)
+        expected = self._request_without_pyramid(request_path)
+        assert image.size == expected.size
+
+    def test_thumbnail_is_close_to_full_decode(self):
+        request_path = '/%s/full/100,/0/default.png' % self.ident
+        image = self.request_image_from_client(request_path)
+        expected = self._request_without_pyramid(request_path)
+        assert image.size == expected.size == (100, 75)
+        # The thumbnail is resized from the 125px level rather than the full
+        # image, so the edges of the checkerboard are resampled differently.
+        diff = ImageStat.Stat(ImageChops.difference(image, expected))
+        assert max(diff.mean) < 10
+
 
 class Test_PILTransformer(loris_t.LorisTest,
                           ColorConversionMixin,
@@ -299,6 +786,52 @@ class Test_PILTransformer(loris_t.LorisTest,
         image = self.request_image_from_client(request_path)
         assert image.getpixel((0, 0)) == (255, 255, 255)
 
+    def test_mirrored_right_angle_rotations(self):
+        ident = self.test_jpeg_grid_id
+        full = Image.open(self.test_jpeg_grid_fp)
+        for rotation in ('!0', '!90', '!180', '!270'):
+            request_path = '/%s/full/full/%s/default.png' % (ident, rotation)
+            image = self.request_image_from_client(request_path)
+            expected = ImageOps.mirror(full).rotate(-int(rotation[1:]), expand=True)
+            assert ImageChops.difference(image, expected).getbbox() is None, rotation
+
+    def _request_without_draft_mode(self, request_path):
+        config = get_debug_config('kdu')
+        config['transforms']['jpg']['jpeg_draft_mode'] = False
+        self.build_client_from_config(config)
+        return self.request_image_from_client(request_path)
+
+    def test_region_and_size_together(self):
+        request_path = '/%s/100,200,1500,1000/300,/0/default.png' % self.ident
+        image = self._request_without_draft_mode(request_path)
+        full = Image.open(self.test_jpeg_fp)
+        expected = full.crop((100, 200, 1600, 1200)).resize((300, 200), Image.LANCZOS)
+        assert image.size == expected.size
+        assert ImageChops.difference(image, expected).getbbox() is None
+
+    def test_reducing_gap_is_only_passed_when_configured(self):
+        request_path = '/%s/full/300,/0/default.png' % self.ident
+        with unittest.mock.patch.object(
+            Image.Image, 'resize', autospec=True, side_effect=Image.Image.resize
+        ) as resize:
+            self._request_without_draft_mode(request_path)
+            assert 'reducing_gap' not in resize.call_args[1]
+
+            config = get_debug_config('kdu')
+            config['transforms']['reducing_gap'] = 3.0
+            self.build_client_from_config(config)
+            self.request_image_from_client('/%s/full/200,/0/default.png' % self.ident)
+            assert resize.call_args[1]['reducing_gap'] == 3.0
+
+    def test_gray_is_resized_as_one_channel(self):
+        request_path = '/%s/full/300,/0/gray.png' % self.ident
+        image = self._request_without_draft_mode(request_path)
+        full = Image.open(self.test_jpeg_fp)
+        expected = full.resize(image.size, Image.LANCZOS).convert('L')
+        assert image.mode == 'L'
+        diff = ImageStat.Stat(ImageChops.difference(image, expected))
+        assert max(diff.mean) < 1
+
     def test_can_request_gif_format(self):
         ident = self.test_jpeg_id
         request_path = '/%s/full/full/0/default.gif' % ident
@@ -346,6 +879,34 @@ class Test_PILTransformer(loris_t.LorisTest,
         request_path = '/%s/full/full/0/default.jpg' % ident
         self.request_image_from_client(request_path)
 
+    def _assert_draft_mode_matches_full_decode(self, request_path):
+        image_draft = self.request_image_from_client(request_path)
+
+        config = get_debug_config('kdu')
+        config['transforms']['jpg']['jpeg_draft_mode'] = False
+        config['loris.Loris']['enable_caching'] = False
+        self.build_client_from_config(config)
+        image_full = self.request_image_from_client(request_path)
+
+        assert image_draft.size == image_full.size
+        diff = ImageStat.Stat(ImageChops.difference(image_draft, image_full))
+        assert max(diff.mean) < 5
+
+    def test_jpeg_draft_mode_thumbnail(self):
+        self._assert_draft_mode_matches_full_decode(
+            '/%s/full/200,/0/default.jpg' % self.test_jpeg_id
+        )
+
+    def test_jpeg_draft_mode_pct_size(self):
+        self._assert_draft_mode_matches_full_decode(
+            '/%s/full/pct:25/0/default.jpg' % self.test_jpeg_id
+        )
+
+    def test_jpeg_draft_mode_region(self):
+        self._assert_draft_mode_matches_full_decode(
+            '/%s/100,200,1500,1000/300,/0/default.jpg' % self.test_jpeg_id
+        )
+
     def test_respects_pil_max_image_pixels(self):
         default_max_pixels = Image.MAX_IMAGE_PIXELS
         try:
@@ -2,7 +2,7 @@ import os
 import tempfile
 import unittest
 from configobj import ConfigObj
-from loris import user_commands
+from loris import img, img_info, user_commands
 
 
 class TestCreateFilesAndDirectories(unittest.TestCase):
@@ -22,3 +22,75 @@ class TestCreateFilesAndDirectories(unittest.TestCase):
             for d in [image_cache, info_cache, log_dir, www_dir]:
                 self.assertTrue(os.path.exists(d))
 
+
+
+class TestRebuildImageCacheIndex(unittest.TestCase):
+
+    def test_existing_images_are_indexed(self):
+        config = ConfigObj(user_commands._config_file_path(), unrepr=True, interpolation=False)
+        with tempfile.TemporaryDirectory() as image_cache:
+            os.makedirs(os.path.join(image_cache, 'a'))
+            with open(os.path.join(image_cache, 'a', 'default.jpg'), 'wb') as f:
+                f.write(b'x' * 10)
+            config['img.ImageCache']['cache_dp'] = image_cache
+            user_commands.rebuild_image_cache_index(config)
+            index = img.CacheIndex(image_cache)
+            self.assertEqual(index.total_bytes, 10)
+
+
+class TestMigrateImageCacheSymlinks(unittest.TestCase):
+
+    def test_symlinks_become_aliases(self):
+        config = ConfigObj(user_commands._config_file_path(), unrepr=True, interpolation=False)
+        with tempfile.TemporaryDirectory() as image_cache:
+            fp = os.path.join(image_cache, 'a', 'default.jpg')
+            os.makedirs(os.path.dirname(fp))
+            with open(fp, 'wb') as f:
+                f.write(b'x' * 10)
+            os.symlink(fp, os.path.join(image_cache, 'a', 'color.jpg'))
+            config['img.ImageCache']['cache_dp'] = image_cache
+            user_commands.migrate_image_cache_symlinks(config)
+            aliases = img.AliasIndex(image_cache)
+            self.assertEqual(aliases.get('a/color.jpg'), os.path.realpath(fp))
+            self.assertFalse(os.path.lexists(os.path.join(image_cache, 'a', 'color.jpg')))
+
+
+class TestCompactImageCachePacks(unittest.TestCase):
+
+    def test_removed_images_are_reclaimed(self):
+        config = ConfigObj(user_commands._config_file_path(), unrepr=True, interpolation=False)
+        with tempfile.TemporaryDirectory() as image_cache:
+            packs = img.PackStore(image_cache)
+            temp_fp = os.path.join(image_cache, 'tmp.jpg')
+            with open(temp_fp, 'wb') as f:
+                f.write(b'x' * 10)
+            packs.put('a', 'a/default.jpg', temp_fp)
+            packs.remove('a/default.jpg')
+            config['img.ImageCache']['cache_dp'] = image_cache
+            user_commands.compact_image_cache_packs(config)
+            self.assertEqual(os.listdir(os.path.join(image_cache, 'a')), [])
+
+
+class TestMigrateInfoCache(unittest.TestCase):
+
+    def test_info_files_are_imported(self):
+        config = ConfigObj(user_commands._config_file_path(), unrepr=True, interpolation=False)
+        with tempfile.TemporaryDirectory() as info_cache:
+            files = img_info.InfoCache(info_cache)
+            idents = ['a.jpg', '01%2F02%2Fb.jpg', 'site:c.jpg', 'http://example.org/d.jpg']
+            for ident in idents:
+                info = img_info.ImageInfo(src_img_fp=__file__, src_format='jpg')
+                info.width, info.height, info.tiles, info.sizes = 100, 50, [], []
+                info.profile = img_info.Profile('http://iiif.io/api/image/2/level2.json', {})
+                info.color_profile_bytes = b'icc' if ident == 'a.jpg' else None
+                files[ident] = info
+            config['img_info.InfoCache']['cache_dp'] = info_cache
+            user_commands.migrate_info_cache(config)
+
+            store = img_info.InfoCache(info_cache, storage='sqlite')
+            self.assertEqual(len(store.store), len(idents))
+            for ident in idents:
+                info, lastmod = store[ident]
+                self.assertEqual(info.width, 100)
+                self.assertEqual(lastmod, files[ident][1])
+            self.assertEqual(store['a.jpg'][0].color_profile_bytes, b'icc')
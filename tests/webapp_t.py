@@ -1,7 +1,9 @@
 from datetime import datetime
 import json
+import os
 import os.path
 from os import path, listdir
+import threading
 from time import sleep
 from unittest import TestCase
 from unittest.mock import patch
@@ -13,11 +15,13 @@ from werkzeug.http import http_date
 from werkzeug.test import Client, EnvironBuilder
 from werkzeug.wrappers import BaseResponse, Request
 
-from loris import img_info, webapp
+from loris import img, img_info, webapp
 from loris.authorizer import NullAuthorizer
 from loris.constants import PROTOCOL
 from loris.loris_exception import ConfigError
-from loris.transforms import KakaduJP2Transformer, OPJ_JP2Transformer
+from loris.transforms import (
+    KakaduJP2Transformer, OPJ_JP2Transformer, TIF_Transformer
+)
 from loris.webapp import get_debug_config, Loris
 from tests import loris_t
 
@@ -451,6 +455,41 @@ class InfoRequests(loris_t.LorisTest):
         resp = self.client.get(to_get, headers=headers)
         self.assertEqual(resp.status_code, 304)
 
+    def test_info_sends_304_for_matching_etag(self):
+        to_get = '/%s/info.json' % (self.test_jpeg_id,)
+        resp = self.client.get(to_get)
+        etag = resp.headers['ETag']
+
+        resp = self.client.get(to_get, headers=Headers([('If-None-Match', etag)]))
+        assert resp.status_code == 304
+        assert resp.headers['ETag'] == etag
+        assert resp.data == b''
+
+        # If-None-Match is used instead of If-Modified-Since when both are sent.
+        headers = Headers([
+            ('If-None-Match', '"other"'),
+            ('If-Modified-Since', http_date(datetime.utcnow())),
+        ])
+        resp = self.client.get(to_get, headers=headers)
+        assert resp.status_code == 200
+
+    def test_info_etag_depends_on_content_type(self):
+        to_get = '/%s/info.json' % (self.test_jpeg_id,)
+        json_resp = self.client.get(to_get)
+        ld_resp = self.client.get(
+            to_get, headers=Headers([('Accept', 'application/ld+json')])
+        )
+        assert json_resp.data == ld_resp.data
+        assert json_resp.headers['ETag'] != ld_resp.headers['ETag']
+
+    def test_info_body_is_rendered_once(self):
+        to_get = '/%s/info.json' % (self.test_jpeg_id,)
+        self.client.get(to_get)
+        with patch.object(img_info.ImageInfo, 'to_iiif_json') as to_iiif_json:
+            resp = self.client.get(to_get)
+        assert resp.status_code == 200
+        to_iiif_json.assert_not_called()
+
     def test_info_with_callback_is_wrapped_correctly(self):
         to_get = '/%s/info.json?callback=mycallback' % self.test_jpeg_id
         resp = self.client.get(to_get)
@@ -599,6 +638,25 @@ class ImageRequests(loris_t.LorisTest):
             pass
         self._assert_tmp_has_no_files()
 
+    def test_uncached_image_is_made_in_memory(self):
+        self.app.enable_caching = False
+        to_get = '/%s/full/300,/0/default.jpg' % (self.test_jpeg_id,)
+        with patch('loris.webapp.NamedTemporaryFile') as temp_file:
+            resp = self.client.get(to_get)
+        temp_file.assert_not_called()
+        assert resp.status_code == 200
+        assert int(resp.headers['Content-Length']) == len(resp.data)
+        assert resp.headers['Last-Modified']
+
+    def test_big_uncached_image_goes_through_tmp(self):
+        self.app.enable_caching = False
+        self.app.in_memory_max_bytes = 1024
+        to_get = '/%s/full/300,/0/default.jpg' % (self.test_jpeg_id,)
+        with self.client.get(to_get) as resp:
+            assert resp.status_code == 200
+            assert int(resp.headers['Content-Length']) == len(resp.data)
+        self._assert_tmp_has_no_files()
+
     def test_can_use_tmp_dir_for_transforms(self):
         config = get_debug_config('kdu')
         config["loris.Loris"]["tmp_dp"] = "/tmp/doesnotexist"
@@ -628,6 +686,257 @@ class ImageRequests(loris_t.LorisTest):
         self.assertEqual(resp.status_code, 500)
 
 
+class PrerenderSizes(loris_t.LorisTest):
+    '''Tests for rendering all the advertised sizes from one decode.'''
+
+    def setUp(self):
+        super().setUp()
+        config = get_debug_config('kdu')
+        config['loris.Loris']['prerender_sizes_max'] = 500
+        self.build_client_from_config(config)
+        self.ident = self.test_tiff_pyramid_id
+
+    def _cached_sizes(self, fmt='jpg'):
+        return [
+            size['width'] for size in self.test_tiff_pyramid_sizes
+            if img.ImageRequest(
+                self.ident, 'full', '%d,' % size['width'], '0', 'default', fmt
+            ) in self.app.img_cache
+        ]
+
+    def test_first_size_request_renders_all_sizes(self):
+        with patch.object(
+            TIF_Transformer, '_decode_region', autospec=True,
+            side_effect=TIF_Transformer._decode_region
+        ) as decode:
+            image = self.request_image_from_client(
+                '/%s/full/250,/0/default.jpg' % self.ident
+            )
+            assert image.size == (250, 187)
+            assert self._cached_sizes() == [125, 250, 500]
+            for width in (125, 500):
+                self.request_image_from_client(
+                    '/%s/full/%d,/0/default.jpg' % (self.ident, width)
+                )
+        assert decode.call_count == 1
+
+    def test_sizes_above_limit_are_not_rendered(self):
+        self.request_image_from_client('/%s/full/125,/0/default.png' % self.ident)
+        assert self._cached_sizes(fmt='png') == [125, 250, 500]
+        assert self._cached_sizes(fmt='jpg') == []
+
+    def test_other_requests_are_made_on_their_own(self):
+        self.request_image_from_client('/%s/full/300,/0/default.jpg' % self.ident)
+        self.request_image_from_client('/%s/full/250,/90/default.jpg' % self.ident)
+        assert self._cached_sizes() == []
+
+    def test_sizes_rendered_with_info(self):
+        self.app.prerender_sizes_on_info = True
+        resp = self.client.get('/%s/info.json' % self.ident)
+        assert resp.status_code == 200
+        self.app._prerender_executor.shutdown(wait=True)
+        assert self._cached_sizes() == [125, 250, 500]
+
+    def test_info_does_not_wait_for_sizes(self):
+        self.app.prerender_sizes_on_info = True
+        started = threading.Event()
+        finish = threading.Event()
+
+        def prerender_sizes(*args):
+            started.set()
+            finish.wait(10)
+
+        with patch.object(self.app, '_prerender_sizes', side_effect=prerender_sizes):
+            resp = self.client.get('/%s/info.json' % self.ident)
+            assert resp.status_code == 200
+            assert started.wait(10)
+            # Another info request while it's running isn't queued again.
+            del self.app.info_cache[self.ident]
+            self.client.get('/%s/info.json' % self.ident)
+            finish.set()
+            self.app._prerender_executor.shutdown(wait=True)
+            assert self.app._prerender_sizes.call_count == 1
+
+    def test_off_by_default(self):
+        self.build_client_from_config(get_debug_config('kdu'))
+        self.request_image_from_client('/%s/full/250,/0/default.jpg' % self.ident)
+        assert self._cached_sizes() == [250]
+
+
+class DeriveFromCache(loris_t.LorisTest):
+    '''Tests for making smaller images from cached derivatives.'''
+
+    def setUp(self):
+        super().setUp()
+        self.app.derive_from_cache = True
+        self.ident = self.test_tiff_pyramid_id
+
+    def test_smaller_image_is_derived_from_cached_image(self):
+        self.request_image_from_client('/%s/full/600,/0/default.jpg' % self.ident)
+        with patch.object(TIF_Transformer, 'transform') as transform:
+            image = self.request_image_from_client(
+                '/%s/full/300,/0/default.jpg' % self.ident
+            )
+        assert image.size == (300, 225)
+        transform.assert_not_called()
+
+    def test_derived_image_is_not_used_as_a_source(self):
+        self.request_image_from_client('/%s/full/600,/0/default.jpg' % self.ident)
+        self.request_image_from_client('/%s/full/300,/0/default.jpg' % self.ident)
+        with patch.object(
+            TIF_Transformer, 'transform_from_derivative', autospec=True,
+            side_effect=TIF_Transformer.transform_from_derivative
+        ) as derive:
+            self.request_image_from_client('/%s/full/200,/0/default.jpg' % self.ident)
+        assert derive.call_args[1]['source_fp'].endswith('/600,/0/default.jpg')
+
+    def test_regions_are_made_from_the_source(self):
+        self.request_image_from_client('/%s/full/600,/0/default.jpg' % self.ident)
+        with patch.object(
+            TIF_Transformer, 'transform_from_derivative'
+        ) as derive:
+            self.request_image_from_client(
+                '/%s/0,0,500,500/300,/0/default.jpg' % self.ident
+            )
+            self.request_image_from_client(
+                '/%s/full/300,/90/default.jpg' % self.ident
+            )
+        derive.assert_not_called()
+
+    def test_removed_derivative_falls_back_to_source(self):
+        self.request_image_from_client('/%s/full/600,/0/default.jpg' % self.ident)
+        request = img.ImageRequest(self.ident, 'full', '600,', '0', 'default', 'jpg')
+        os.unlink(self.app.img_cache[request][0])
+        image = self.request_image_from_client('/%s/full/300,/0/default.jpg' % self.ident)
+        assert image.size == (300, 225)
+
+
+class CoalesceRenders(loris_t.LorisTest):
+    '''Tests for making identical concurrent requests only once.'''
+
+    def test_request_waits_for_and_serves_the_image_being_made(self):
+        ident = self.test_tiff_pyramid_id
+        request_path = '/%s/full/!300,300/0/default.jpg' % ident
+        info = self.app._get_info(ident, _get_werkzeug_request(request_path), self.URI_BASE)[0]
+        image_request = img.ImageRequest(ident, 'full', '300,', '0', 'default', 'jpg')
+        canonical_fp = self.app.img_cache.get_canonical_cache_path(image_request, info)
+        responses = []
+
+        def make_request():
+            responses.append(Client(self.app, BaseResponse).get(request_path))
+
+        with self.app.img_cache.render_locks.hold(canonical_fp):
+            waiter = threading.Thread(target=make_request)
+            waiter.start()
+            waiter.join(timeout=0.5)
+            assert not responses
+            self.app._make_image_file(image_request, info)
+            transform = patch.object(TIF_Transformer, 'transform').start()
+            self.addCleanup(patch.stopall)
+        waiter.join()
+
+        assert responses[0].status_code == 200
+        transform.assert_not_called()
+        assert self.app.img_cache.render_locks.metrics() == {
+            'renders': 0, 'renders_saved': 1
+        }
+
+    def test_renders_are_counted(self):
+        self.request_image_from_client(
+            '/%s/full/300,/0/default.jpg' % self.test_tiff_pyramid_id
+        )
+        assert self.app.img_cache.render_locks.metrics()['renders'] == 1
+
+    def test_coalescing_can_be_turned_off(self):
+        self.app.coalesce_renders = False
+        self.request_image_from_client(
+            '/%s/full/300,/0/default.jpg' % self.test_tiff_pyramid_id
+        )
+        assert self.app.img_cache.render_locks.metrics()['renders'] == 0
+
+
+class MemoryTier(loris_t.LorisTest):
+    '''Tests for serving cached images from memory.'''
+
+    def setUp(self):
+        super().setUp()
+        self.app.img_cache.memory = img.MemoryTier(max_bytes=1048576)
+        self.request_path = '/%s/full/300,/0/default.jpg' % self.test_tiff_pyramid_id
+
+    def _cached_fp(self):
+        request = img.ImageRequest(
+            self.test_tiff_pyramid_id, 'full', '300,', '0', 'default', 'jpg'
+        )
+        return self.app.img_cache[request][0]
+
+    def test_image_is_served_from_memory(self):
+        first = self.client.get(self.request_path)
+        os.unlink(self._cached_fp())
+        second = self.client.get(self.request_path)
+        assert second.status_code == 200
+        assert second.data == first.data
+        assert second.headers['Content-Type'] == 'image/jpeg'
+        assert self.app.img_cache.memory.metrics()['hits'] == 1
+
+    def test_image_read_from_disk_is_kept_in_memory(self):
+        self.client.get(self.request_path)
+        self.app.img_cache.memory = img.MemoryTier(max_bytes=1048576)
+        self.client.get(self.request_path)
+        assert len(self.app.img_cache.memory) == 1
+
+    def test_image_in_memory_sends_304(self):
+        first = self.client.get(self.request_path)
+        headers = Headers([('If-Modified-Since', first.headers['Last-Modified'])])
+        resp = self.client.get(self.request_path, headers=headers)
+        assert resp.status_code == 304
+
+    def test_image_in_memory_is_touched_in_the_index(self):
+        self.client.get(self.request_path)
+        self.app.img_cache.index = img.CacheIndex(self.app.img_cache.cache_root)
+        with patch.object(img.CacheIndex, 'touch') as touch:
+            self.client.get(self.request_path)
+        assert self.app.img_cache.memory.metrics()['hits'] == 1
+        touched_fp = touch.call_args[0][0]
+        assert path.realpath(touched_fp) == self._cached_fp()
+
+    def test_big_images_are_served_from_disk(self):
+        self.app.img_cache.memory = img.MemoryTier(max_bytes=1048576, max_item_bytes=10)
+        self.client.get(self.request_path)
+        resp = self.client.get(self.request_path)
+        assert resp.status_code == 200
+        assert len(self.app.img_cache.memory) == 0
+
+
+class PackFiles(loris_t.LorisTest):
+    '''Tests for keeping small images in pack files.'''
+
+    def setUp(self):
+        super().setUp()
+        self.app.img_cache = img.ImageCache(
+            self.app.img_cache.cache_root, pack_max_item_bytes=1048576
+        )
+        self.request_path = '/%s/full/!300,300/0/default.jpg' % self.test_tiff_pyramid_id
+
+    def test_image_is_packed_and_served_from_the_pack(self):
+        first = self.client.get(self.request_path)
+        request = img.ImageRequest(
+            self.test_tiff_pyramid_id, 'full', '!300,300', '0', 'default', 'jpg'
+        )
+        assert not path.lexists(self.app.img_cache.get_request_cache_path(request))
+        with patch.object(TIF_Transformer, 'transform') as transform:
+            second = self.client.get(self.request_path)
+        transform.assert_not_called()
+        assert second.status_code == 200
+        assert second.data == first.data
+        assert second.headers['Content-Type'] == 'image/jpeg'
+
+    def test_packed_image_sends_304(self):
+        first = self.client.get(self.request_path)
+        headers = Headers([('If-Modified-Since', first.headers['Last-Modified'])])
+        resp = self.client.get(self.request_path, headers=headers)
+        assert resp.status_code == 304
+
+
 class SizeRestriction(loris_t.LorisTest):
     '''Tests for restriction of size parameter.'''
 